@@ -0,0 +1,204 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import itertools
+import subprocess
+import numpy as np
+
+'''
+Benchmark of the renderers on parametric scenes (Scene.random_scene). Every
+case (backend x scene x settings) runs in its own process: the kernels come
+from the disk cache, the peak memory is that of the case only, and the CUDA
+simulator ('cudasim') is switched on per process.
+
+    python benchmark.py --output ../output/bench.json
+    python benchmark.py --backends cpu --spheres 16 256 1024 --depth 10 --size 128
+    python benchmark.py --backends cpu --lights 64 256 --light-radius 0 4 --light-samples 0 8
+
+Each case: warm-up renders, then --repeat timed renders of the whole frame,
+one more render with tracemalloc for the peak of host allocations and one in
+the statistics mode for the exact ray and intersection test counts (the
+numpy backend has none, its counts are estimated).
+'''
+
+# amb, lamb, refl, refl_cutoff, rr_depth - the types of main()
+SETTINGS = (0.1, 0.55, 0.4)
+REFL_CUTOFF, RR_DEPTH = 1 / 512, 0
+AA = (8, 16, 0.05)
+
+
+def get_camera(size, extent):
+    from scene import Camera, look_at
+    position = (-1.6 * extent - 3, 0, extent + 2)
+    return Camera(resolution=(size, size), position=position, euler=look_at(position, (0, 0, 0)))
+
+
+def estimate_rays(lights, w, h, extra_rays, bounces):
+    # without the statistics mode: the mean number of reflections of the
+    # centre rays stands for all camera rays. Shadow rays: one per light at
+    # every traced ray - an upper bound, rays that miss the scene cast none
+    camera_rays = w * h + extra_rays
+    reflection = camera_rays * float(bounces.mean())
+    return {'primary': w * h, 'antialiasing': int(extra_rays), 'reflection': int(round(reflection)),
+            'shadow': int(round(lights * (camera_rays + reflection)))}
+
+
+def get_peak_rss():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_case(case):
+    # runs in the child process, returns the result of one case
+    import tracemalloc
+    import main
+    from scene import Scene, SceneBuffer
+
+    backend = 'cuda' if case['backend'] == 'cudasim' else case['backend']
+    if backend == 'cuda':
+        from numba import cuda
+        if not cuda.is_available():
+            return {'skipped': 'no CUDA device'}
+
+    scene = Scene.random_scene(case['spheres'], case['rectangles'], case['paraboloids'], case['lights'], case['seed'],
+                               case['light_radius'])
+    buffer = SceneBuffer(scene)
+    aliasing = case['aa'] != 'none'
+    settings = (*SETTINGS, case['depth'], REFL_CUTOFF, RR_DEPTH, aliasing, case['aa'], AA)
+    start_tile, _ = main.RENDERERS[backend](buffer, *settings, case['light_samples'])
+
+    size = case['size']
+    view = get_camera(size, Scene.get_extent(case['spheres'] + case['rectangles'] + case['paraboloids'])).generate_descriptor()
+
+    st = time.perf_counter()
+    for _ in range(case['warmup']):
+        start_tile(view, size, size)()
+    warmup_time = time.perf_counter() - st
+
+    times = []
+    for _ in range(case['repeat']):
+        st = time.perf_counter()
+        _, bounces, extra_rays, _ = start_tile(view, size, size)()
+        times.append(time.perf_counter() - st)
+
+    tracemalloc.start()
+    start_tile(view, size, size)()
+    peak_host = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    tests = None
+    if backend == 'numpy':
+        rays = estimate_rays(case['lights'], size, size, extra_rays, bounces)
+    else:
+        start_stats, _ = main.RENDERERS[backend](buffer, *settings, case['light_samples'], stats=True)
+        stats = start_stats(view, size, size)()[3]
+        rays = {'primary': size * size, 'antialiasing': stats['rays']['primary'] + stats['rays']['antialiasing'] - size * size,
+                'reflection': stats['rays']['reflection'], 'shadow': stats['rays']['shadow']}
+        tests = stats['tests']
+
+    best = min(times)
+    return {
+        'wall_time': {'min': best, 'median': float(np.median(times)), 'runs': times, 'warmup': warmup_time},
+        'rays': rays,
+        'rays_exact': tests is not None,
+        'intersection_tests': tests,
+        'rays_per_second': {k: v / best for k, v in rays.items()} | {'total': sum(rays.values()) / best},
+        'memory': {'peak_rss': get_peak_rss(), 'peak_traced': peak_host},
+    }
+
+
+def get_skip_reason(case, sim_size):
+    if case['backend'] == 'numpy' and case['aa'] not in ('none', 'fixed'):
+        return "numpy backend supports only 'fixed' antialiasing"
+    if case['backend'] == 'numpy' and case['light_samples']:
+        return 'numpy backend shades all lights'
+    if case['backend'] == 'cudasim' and case['size'] > sim_size:
+        return f'cudasim runs only up to {sim_size}x{sim_size}'
+    return None
+
+
+def spawn_case(case):
+    env = dict(os.environ)
+    if case['backend'] == 'cudasim':
+        env['NUMBA_ENABLE_CUDASIM'] = '1'
+
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), '--case', json.dumps(case)], env=env,
+                         cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    if out.returncode != 0:
+        return {'error': out.stderr.strip().splitlines()[-1] if out.stderr.strip() else f'exit code {out.returncode}'}
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def get_cases(args):
+    keys = ('backend', 'size', 'aa', 'depth', 'spheres', 'rectangles', 'paraboloids', 'lights', 'light_radius', 'light_samples')
+    values = (args.backends, args.size, args.aa, args.depth, args.spheres, args.rectangles, args.paraboloids, args.lights,
+              args.light_radius, args.light_samples)
+    for combination in itertools.product(*values):
+        yield dict(zip(keys, combination), seed=args.seed, warmup=args.warmup, repeat=args.repeat)
+
+
+def get_meta():
+    import numba
+    return {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(), 'numba': numba.__version__,
+            'numpy': np.__version__, 'machine': platform.machine(), 'cpu_count': os.cpu_count()}
+
+
+def print_result(case, result):
+    name = (f"{case['backend']:>7} {case['size']:>4}px aa={case['aa']:<8} depth={case['depth']:<2} "
+            f"s={case['spheres']} r={case['rectangles']} p={case['paraboloids']} l={case['lights']}")
+    if case['light_radius'] or case['light_samples']:
+        name += f" lr={case['light_radius']} ls={case['light_samples']}"
+    if 'wall_time' not in result:
+        print(f"{name}: {result.get('skipped') or result.get('error')}")
+        return
+    rps = result['rays_per_second']
+    print(f"{name}: {1000 * result['wall_time']['min']:,.1f} ms, {rps['total'] / 1e6:.3g} Mrays/s "
+          f"(primary {rps['primary'] / 1e6:.3g}, aa {rps['antialiasing'] / 1e6:.3g}, reflection {rps['reflection'] / 1e6:.3g}, shadow {rps['shadow'] / 1e6:.3g})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='rays per second of the renderers on parametric scenes')
+    parser.add_argument('--backends', nargs='+', default=['cpu', 'numpy', 'cudasim', 'cuda'],
+                        help="cuda, cpu, numpy, cudasim (the CUDA simulator)")
+    parser.add_argument('--size', nargs='+', type=int, default=[16, 64], help='square frame sizes in pixels')
+    parser.add_argument('--aa', nargs='+', default=['none', 'fixed'], help="'none', 'fixed', 'adaptive', 'lattice'")
+    parser.add_argument('--depth', nargs='+', type=int, default=[1, 10], help='reflection depths')
+    parser.add_argument('--spheres', nargs='+', type=int, default=[16, 128])
+    parser.add_argument('--rectangles', nargs='+', type=int, default=[4])
+    parser.add_argument('--paraboloids', nargs='+', type=int, default=[1])
+    parser.add_argument('--lights', nargs='+', type=int, default=[1, 4])
+    parser.add_argument('--light-radius', nargs='+', type=float, default=[0.], help='influence radius of the lights, 0 - none')
+    parser.add_argument('--light-samples', nargs='+', type=int, default=[0], help='shadow rays per shading point, 0 - all lights')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--sim-size', type=int, default=16, help='largest frame for cudasim')
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case is not None:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return 0
+
+    results = []
+    for case in get_cases(args):
+        reason = get_skip_reason(case, args.sim_size)
+        result = {'skipped': reason} if reason else spawn_case(case)
+        print_result(case, result)
+        results.append({'case': case, **result})
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'meta': get_meta(), 'results': results}, f, indent=2)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+'''
+Cold start of a batch job: every run is a new process that imports the
+renderer, renders the first frame (kernels compiled or loaded from the disk
+cache) and a second one (already compiled). The first run after --clear
+compiles everything, the following ones show the time with the cache.
+
+    python cold_start.py --backend cpu --size 64 --runs 3 --clear
+    python cold_start.py --precompile fixed adaptive lattice
+'''
+
+RUN = '''
+import json
+import time
+st = time.perf_counter()
+import main
+from scene import Scene, SceneBuffer, Camera
+import_time = time.perf_counter() - st
+
+backend, w, h = {backend!r}, {w}, {h}
+backend = backend or main.get_default_backend()
+buffer = SceneBuffer(Scene.default_scene())
+start_tile, _ = main.RENDERERS[backend](buffer, *{settings!r}, {aliasing!r}, {aa_mode!r}, {aa!r})
+view = Camera(resolution=(w, h), position=(-5, 2, 3), euler=[0, -30, -40]).generate_descriptor()
+
+frames = []
+for i in range(2):
+    st = time.perf_counter()
+    start_tile(view, w, h)()
+    frames.append(time.perf_counter() - st)
+
+print(json.dumps({{'backend': backend, 'import': import_time, 'first_frame': frames[0], 'second_frame': frames[1]}}))
+'''
+
+# amb, lamb, refl, refl_depth, refl_cutoff, rr_depth - the types of main()
+SETTINGS = (0.1, 0.55, 0.4, 10, 1 / 512, 0)
+AA = (8, 16, 0.05)
+
+
+def measure(backend, size, aliasing, aa_mode):
+    # one fresh interpreter, returns its timings in seconds
+    code = RUN.format(backend=backend, w=size, h=size, settings=SETTINGS, aliasing=aliasing, aa_mode=aa_mode, aa=AA)
+    out = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                         check=True, capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='import + first frame time of a new process')
+    parser.add_argument('--backend', default=None, help='cuda, cpu or numpy (default: cuda if available)')
+    parser.add_argument('--size', type=int, default=64, help='frame size in pixels')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--aa-mode', default='adaptive', help="'fixed', 'adaptive', 'lattice' or 'none'")
+    parser.add_argument('--clear', action='store_true', help='remove the compiled kernels first')
+    parser.add_argument('--precompile', nargs='*', metavar='AA_MODE',
+                        help="only fill the cache for these modes ('none' - without antialiasing)")
+    parser.add_argument('--json', help='also write the timings to this file')
+    args = parser.parse_args()
+
+    if args.clear or args.precompile is not None:
+        from ray_tracing import clear_cache, get_cache_dir
+        if args.clear:
+            clear_cache()
+            print(f'cleared {get_cache_dir()}')
+
+    if args.precompile is not None:
+        import main as renderer
+        from scene import Scene, SceneBuffer
+        backend = args.backend or renderer.get_default_backend()
+        modes = [(mode != 'none', mode) for mode in args.precompile or ['fixed', 'adaptive', 'lattice']]
+        renderer.precompile(backend, SceneBuffer(Scene.default_scene()), modes, *SETTINGS, AA)
+        return 0
+
+    aliasing = args.aa_mode != 'none'
+    results = []
+    print(f"{'run':>4} {'import':>10} {'first frame':>12} {'second frame':>13}")
+    for run in range(args.runs):
+        t = measure(args.backend, args.size, aliasing, args.aa_mode)
+        results.append(t)
+        print(f"{run:>4} {1000 * t['import']:>8,.0f}ms {1000 * t['first_frame']:>10,.0f}ms {1000 * t['second_frame']:>11,.0f}ms")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'size': args.size, 'aa_mode': args.aa_mode, 'runs': results}, f, indent=2)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,2 @@
+from .coordinator import RenderFarm
+from .worker import serve, run_worker
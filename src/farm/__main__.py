@@ -0,0 +1,30 @@
+import os
+import sys
+import argparse
+from .worker import run_worker
+
+'''
+Remote worker of a render farm, run from src on every host:
+
+    FARM_AUTHKEY=secret python -m farm coordinator-host:6000 [--backend cuda] [--threads 8]
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='render farm worker')
+    parser.add_argument('address', help='host:port of the coordinator')
+    parser.add_argument('--backend', default=None, help='cuda, cpu or numpy (default: as the coordinator says)')
+    parser.add_argument('--threads', type=int, default=None, help='numba threads (default: all cores)')
+    args = parser.parse_args()
+
+    authkey = os.environ.get('FARM_AUTHKEY', '').encode()
+    if not authkey:
+        parser.error('set FARM_AUTHKEY to the key of the coordinator')
+
+    host, port = args.address.rsplit(':', 1)
+    run_worker((host, int(port)), authkey, args.backend, args.threads)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
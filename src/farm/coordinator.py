@@ -0,0 +1,259 @@
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from multiprocessing.connection import Listener, wait
+import numpy as np
+from viewer import write_tile
+from scheduler import order_tiles
+from .worker import serve
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerHandle:
+    def __init__(self, conn, process=None):
+        self.conn = conn
+        self.process = process
+        self.name = None
+        self.backend = None
+        self.ready = False
+        self.alive = True
+        self.running = {}       # key -> time the tile was sent
+        self.tiles = 0
+        self.busy = 0.
+
+
+class RenderFarm:
+    '''
+    Coordinator of a tile render farm. Workers are local processes
+    (processes > 0) and workers on other hosts that connect to address
+    (python -m farm host:port, with the same authkey). Every worker gets the
+    scene once and keeps it with its compiled kernels; render() then hands
+    out tiles of the frame and writes the returned ones into the image.
+
+    Workers pull tiles: each has at most in_flight of them, so a worker on
+    expensive (reflective) tiles simply gets fewer. When no tiles are left,
+    idle workers get copies of the ones still running elsewhere (backup),
+    the first result is used. Tiles of a failed worker go back to the queue,
+    a tile that raises is retried max_retries times on any worker.
+
+    settings are the arguments of main.RENDERERS after the scene buffer:
+    (amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, aliasing, aa_mode, aa,
+    light_samples).
+    '''
+    def __init__(self, scene, settings, backend=None, processes=0, address=None, authkey=None, threads=1,
+                 in_flight=2, max_retries=3, backup=True):
+        self.scene = scene
+        self.settings = settings
+        self.backend = backend
+        self.in_flight = in_flight
+        self.max_retries = max_retries
+        self.backup = backup
+        self.workers = []
+        self._frame = 0
+
+        # spawn: a forked numba (its thread pool, a CUDA context) is not safe
+        context = multiprocessing.get_context('spawn')
+        for _ in range(processes):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=serve, args=(child_conn, None, threads), daemon=True)
+            process.start()
+            child_conn.close()
+            self._add_worker(parent_conn, process)
+
+        self._listener = None
+        self._incoming = queue.Queue()
+        if address is not None:
+            if not authkey:
+                raise ValueError('remote workers need an authkey')
+            self._listener = Listener(address, authkey=authkey)
+            threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                self._incoming.put(self._listener.accept())
+            except OSError:
+                # closed listener; a failed handshake only loses that client
+                if self._listener is None:
+                    return
+            except Exception:
+                continue
+
+    def _add_worker(self, conn, process=None):
+        worker = WorkerHandle(conn, process)
+        self.workers.append(worker)
+        self._send(worker, ('setup', self.backend, self.scene, self.settings))
+
+    def _send(self, worker, message):
+        try:
+            worker.conn.send(message)
+        except (OSError, ValueError):
+            worker.alive = False
+
+    def set_scene(self, scene):
+        # the workers build the new scene before the tiles that follow
+        self.scene = scene
+        for worker in self.get_alive():
+            worker.ready = False
+            self._send(worker, ('setup', self.backend, scene, self.settings))
+
+    def get_alive(self):
+        return [w for w in self.workers if w.alive]
+
+    def render(self, camera, tile_size, image, timeout=None, costs=None):
+        '''
+        Renders the frame of camera in tiles of tile_size into image (h, w, 3),
+        e.g. np.memmap of viewer.create_ppm. costs (scheduler.estimate_costs)
+        hand out the most expensive tiles first. Returns the statistics of
+        render_tiled and of the farm, tile_times - (x0, y0, w, h, seconds)
+        of the tiles as the workers report them. timeout: seconds without any
+        worker before giving up (None - only if no worker can connect any more).
+        '''
+        self._frame += 1
+        tiles = {(self._frame, i): tile for i, tile in enumerate(camera.get_tiles(tile_size))}
+        pending = deque(order_tiles(tiles, costs))
+        attempts = dict.fromkeys(tiles, 0)
+        done = set()
+
+        stats = {'extra_rays': 0, 'bounces': None, 'tiles': len(tiles), 'backups': 0, 'retries': 0, 'failed_workers': 0,
+                 'tile_times': []}
+        refl_depth = self.settings[3]
+        stats['bounces'] = np.zeros(refl_depth + 1, dtype=np.int64)
+        idle_since = time.time()
+        for worker in self.workers:
+            worker.tiles, worker.busy = 0, 0.
+
+        def running_elsewhere(key, worker):
+            return any(key in w.running for w in self.get_alive() if w is not worker)
+
+        def requeue(key):
+            if key not in done and not running_elsewhere(key, None):
+                pending.appendleft(key)
+
+        setup_error = None
+
+        def fail(worker):
+            worker.alive = False
+            stats['failed_workers'] += 1
+            keys = list(worker.running)
+            worker.running.clear()
+            for key in keys:
+                if key in tiles:
+                    stats['retries'] += 1
+                    requeue(key)
+
+        def steal(worker):
+            # the oldest tile that runs on one other worker only
+            candidates = {}
+            for w in self.get_alive():
+                for key, sent in w.running.items():
+                    if key in tiles and key not in done and key not in worker.running:
+                        candidates.setdefault(key, []).append(sent)
+            single = [(min(s), key) for key, s in candidates.items() if len(s) == 1]
+            return min(single)[1] if single else None
+
+        while len(done) < len(tiles):
+            while not self._incoming.empty():
+                self._add_worker(self._incoming.get())
+
+            alive = self.get_alive()
+            if alive:
+                idle_since = time.time()
+            elif self._listener is None:
+                raise RuntimeError('all workers of the render farm failed' +
+                                   (f', the last setup error:\n{setup_error}' if setup_error else ''))
+            elif timeout is not None and time.time() - idle_since > timeout:
+                raise RuntimeError(f'no render farm workers for {timeout} s')
+
+            # hand out tiles
+            for worker in alive:
+                while worker.ready and len(worker.running) < self.in_flight:
+                    if pending:
+                        key = pending.popleft()
+                    elif self.backup:
+                        key = steal(worker)
+                        if key is None:
+                            break
+                        stats['backups'] += 1
+                    else:
+                        break
+
+                    x0, y0, w, h = tiles[key]
+                    worker.running[key] = time.time()
+                    self._send(worker, ('tile', key, camera.generate_descriptor((x0, y0)), w, h))
+                    if not worker.alive:
+                        fail(worker)
+
+            # collect results
+            conns = {w.conn: w for w in self.get_alive()}
+            for conn in wait(list(conns), timeout=0.1):
+                worker = conns[conn]
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    fail(worker)
+                    continue
+
+                if message[0] == 'ready':
+                    _, worker.name, worker.backend = message
+                    worker.ready = True
+
+                elif message[0] == 'tile':
+                    _, key, tile, bounces, extra_rays, seconds = message
+                    worker.running.pop(key, None)
+                    worker.busy += seconds
+                    if key not in tiles or key in done:
+                        continue    # a previous frame or the slower copy of a backup
+
+                    x0, y0, _, _ = tiles[key]
+                    write_tile(image, tile, x0, y0)
+                    done.add(key)
+                    worker.tiles += 1
+                    stats['tile_times'].append((*tiles[key], seconds))
+                    stats['extra_rays'] += extra_rays
+                    stats['bounces'] += np.bincount(bounces.ravel(), minlength=refl_depth + 1)
+
+                elif message[0] == 'error':
+                    _, key, error = message
+                    if key is None:
+                        # the worker quits, the others go on with its tiles
+                        logger.warning('render farm worker setup failed:\n%s', error)
+                        setup_error = error
+                        fail(worker)
+                        continue
+
+                    worker.running.pop(key, None)
+                    if key not in tiles or key in done:
+                        continue
+                    attempts[key] += 1
+                    if attempts[key] > self.max_retries:
+                        raise RuntimeError(f'tile {tiles[key]} failed {attempts[key]} times:\n{error}')
+                    stats['retries'] += 1
+                    requeue(key)
+
+        stats['workers'] = {w.name: {'backend': w.backend, 'tiles': w.tiles, 'busy': w.busy} for w in self.workers if w.name}
+        return stats
+
+    def close(self):
+        for worker in self.get_alive():
+            self._send(worker, ('stop',))
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(timeout=5)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+            worker.conn.close()
+
+        if self._listener is not None:
+            listener, self._listener = self._listener, None
+            listener.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,83 @@
+import os
+import time
+import socket
+import traceback
+from multiprocessing.connection import Client
+
+# Messages are tuples, the first item is the kind.
+#   coordinator -> worker: ('setup', backend, scene, settings), ('tile', key, view, w, h), ('stop',)
+#   worker -> coordinator: ('ready', name, backend), ('tile', key, image, bounces, extra_rays, seconds),
+#                          ('error', key, traceback) - key None: the setup failed
+
+
+def create_renderer(backend, scene, settings):
+    import main
+    from scene import SceneBuffer, Camera
+
+    backend = backend or main.get_default_backend()
+    start_tile, _ = main.RENDERERS[backend](SceneBuffer(scene), *settings)
+
+    # kernels are compiled (or loaded from the disk cache) before the first tile
+    camera = Camera(resolution=(16, 16), position=(-7, 0, 4), euler=[0, 0, 0])
+    start_tile(camera.generate_descriptor(), 16, 16)()
+    return backend, start_tile
+
+
+def serve(conn, backend=None, threads=None):
+    '''
+    Worker loop: keeps the scene and the compiled renderer of the last setup
+    and renders the tiles the coordinator sends over conn, a multiprocessing
+    Connection (a Pipe of a local process or a TCP Client). backend overrides
+    the one of the coordinator, threads limits the numba threads.
+    '''
+    if threads:
+        import numba
+        numba.set_num_threads(threads)
+
+    name = f'{socket.gethostname()}:{os.getpid()}'
+    start_tile = None
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+
+        if message[0] == 'stop':
+            conn.close()
+            return
+
+        if message[0] == 'setup':
+            _, default_backend, scene, settings = message
+            try:
+                used_backend, start_tile = create_renderer(backend or default_backend, scene, settings)
+            except Exception:
+                # the worker can't render anything, the coordinator drops it
+                conn.send(('error', None, traceback.format_exc()))
+                conn.close()
+                return
+            conn.send(('ready', name, used_backend))
+
+        elif message[0] == 'tile':
+            _, key, view, w, h = message
+            st = time.perf_counter()
+            try:
+                image, bounces, extra_rays, _ = start_tile(view, w, h)()
+            except Exception:
+                conn.send(('error', key, traceback.format_exc()))
+                continue
+            conn.send(('tile', key, image, bounces, extra_rays, time.perf_counter() - st))
+
+
+def run_worker(address, authkey, backend=None, threads=None, retry_interval=2., attempts=30):
+    # remote worker: connects to the coordinator, waits for it to start
+    for attempt in range(attempts):
+        try:
+            conn = Client(address, authkey=authkey)
+            break
+        except ConnectionRefusedError:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(retry_interval)
+
+    serve(conn, backend, threads)
@@ -0,0 +1,194 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+'''
+Cache of rendered frames (and tiles) on disk. The key is the hash of the
+packed scene arrays, the camera descriptor, the tile size, the settings of
+the renderer, the backend and the source of the kernels, so any change
+renders again. Entries are files <key>.npz in the cache folder: the arrays
+of the result and a JSON description of the rest, read without pickle, so
+a shared folder can't run code in the renderers. The least recently used
+entries are removed when the folder grows over max_bytes.
+'''
+
+
+def hash_arrays(arrays) -> bytes:
+    h = hashlib.blake2b(digest_size=20)
+    for a in arrays:
+        h.update(repr((a.dtype.str, a.shape)).encode())
+        h.update(np.ascontiguousarray(a).data)
+    return h.digest()
+
+
+def hash_scene(buffer) -> bytes:
+    # the primitives, instances and prototypes; the BVH is built from them
+    views = buffer.get_views()
+    return hash_arrays(views[:5] + views[8:])
+
+
+def hash_package(directory: str) -> bytes:
+    # the modules of a package in sorted order, as ray_tracing.get_package_hash
+    h = hashlib.blake2b(digest_size=20)
+    for name in sorted(f for f in os.listdir(directory) if f.endswith('.py')):
+        with open(os.path.join(directory, name), 'rb') as f:
+            h.update(f.read())
+    return h.digest()
+
+
+def get_code_hash(backend: str) -> bytes:
+    # the kernels of ray_tracing, the numpy backend is the wavefront package
+    # and does not need numba for it
+    if backend == 'numpy':
+        return hash_package(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wavefront'))
+    from ray_tracing import get_package_hash
+    return hashlib.blake2b(get_package_hash(), digest_size=20).digest()
+
+
+def encode_result(value, arrays: dict):
+    # JSON of value, its arrays go to arrays and are referenced by name
+    if isinstance(value, np.ndarray):
+        name = f'a{len(arrays)}'
+        arrays[name] = value
+        return {'array': name}
+    if isinstance(value, dict):
+        return {'dict': {k: encode_result(v, arrays) for k, v in value.items()}}
+    if isinstance(value, (tuple, list)):
+        return {'tuple': [encode_result(v, arrays) for v in value]}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def decode_result(value, arrays):
+    if not isinstance(value, dict):
+        return value
+    if 'array' in value:
+        return arrays[value['array']]
+    if 'dict' in value:
+        return {k: decode_result(v, arrays) for k, v in value['dict'].items()}
+    return tuple(decode_result(v, arrays) for v in value['tuple'])
+
+
+class FrameCache:
+    def __init__(self, directory: str, max_bytes: int = 1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # key -> (size, last use), from the files of earlier runs
+        self._entries = {}
+        for f in os.listdir(directory):
+            if f.endswith('.npz'):
+                st = os.stat(os.path.join(directory, f))
+                self._entries[f[:-4]] = (st.st_size, st.st_mtime)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key: str):
+        # the cached result or None; a hit marks the entry as just used
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            try:
+                with np.load(self._path(key), allow_pickle=False) as data:
+                    arrays = {name: data[name] for name in data.files}
+                result = decode_result(json.loads(str(arrays.pop('result'))), arrays)
+                os.utime(self._path(key))
+            except Exception:
+                # removed by another process, written half or not an entry:
+                # rendered again
+                self._entries.pop(key)
+                self.misses += 1
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+                return None
+            self._entries[key] = (self._entries[key][0], os.stat(self._path(key)).st_mtime)
+            self.hits += 1
+            return result
+
+    def put(self, key: str, result):
+        arrays = {}
+        arrays['result'] = np.array(json.dumps(encode_result(result, arrays)))
+        if sum(a.nbytes for a in arrays.values()) > self.max_bytes:
+            return
+        with self._lock:
+            # written under another name first, other processes never read a part
+            tmp = f'{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp, self._path(key))
+            st = os.stat(self._path(key))
+            self._entries[key] = (st.st_size, st.st_mtime)
+            self._evict()
+
+    def _evict(self):
+        size = sum(s for s, _ in self._entries.values())
+        for key in sorted(self._entries, key=lambda k: self._entries[k][1]):
+            if size <= self.max_bytes:
+                break
+            size -= self._entries.pop(key)[0]
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            for key in self._entries:
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+            self._entries = {}
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / requests if requests else 0.,
+                    'evictions': self.evictions, 'entries': len(self._entries),
+                    'bytes': sum(s for s, _ in self._entries.values()), 'max_bytes': self.max_bytes}
+
+    def wrap(self, start_tile, update_scene, buffer, settings, backend):
+        '''
+        (start_tile, update_scene) of main.RENDERERS with the cache in front:
+        start_tile returns the cached (image, bounces, extra_rays, tile_stats)
+        of the same tile without rendering it, a rendered one is stored.
+        settings: the arguments of the renderer after buffer. The scene is
+        hashed again by update_scene, after the changes of buffer.
+        '''
+        prefix = hashlib.blake2b(get_code_hash(backend) + repr((backend, settings)).encode(), digest_size=20).digest()
+        scene_hash = hash_scene(buffer)
+
+        def cached_start_tile(view, w, h, costs=None):
+            key = hashlib.blake2b(prefix + scene_hash + hash_arrays([np.asarray(view, dtype=np.float64)])
+                                  + repr((w, h)).encode(), digest_size=20).hexdigest()
+            result = self.get(key)
+            if result is not None:
+                return lambda: result
+
+            finish = start_tile(view, w, h, costs)
+
+            def finish_and_store():
+                result = finish()
+                self.put(key, tuple(np.asarray(r) if isinstance(r, np.ndarray) else r for r in result))
+                return result
+
+            return finish_and_store
+
+        def cached_update_scene():
+            nonlocal scene_hash
+            changes = update_scene()
+            scene_hash = hash_scene(buffer)
+            return changes
+
+        return cached_start_tile, cached_update_scene
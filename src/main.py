@@ -1,8 +1,9 @@
+import os
+import time
+import threading
 import numpy as np
-from numba import cuda
-from ray_tracing import render
-from scene import Scene, Camera
-from viewer import convert_array_to_image
+from scene import Scene, SceneBuffer, Camera, turntable, load_scene, get_scene_handle, RENDER_SETTINGS
+from viewer import ImageWriter, create_ppm, write_tile, cost_heatmap
 
 
 '''
@@ -14,6 +15,401 @@ from viewer import convert_array_to_image
 '''
 
 
+def allocate_image(w, h):
+    # готовое изображение (h, w, 3), строки сверху вниз - как в файле
+    return np.zeros((h, w, 3), dtype=np.uint8)
+
+
+def allocate_adaptive_buffers(w, h):
+    # base, depth и hit_ids - с рамкой в 1 пиксель вокруг тайла,
+    # для сравнения с соседями на его границе
+    base = np.zeros((3, w + 2, h + 2), dtype=np.float32)
+    depth = np.zeros((w + 2, h + 2), dtype=np.float32)
+    hit_ids = np.zeros((2, w + 2, h + 2), dtype=np.int32)
+    samples = np.zeros((w, h), dtype=np.uint8)
+    return base, depth, hit_ids, samples
+
+
+def allocate_lattice(w, h):
+    # цвета лучей через каждые полпикселя, включая кольцо вокруг изображения
+    return np.zeros((3, 2 * w + 1, 2 * h + 1), dtype=np.float32)
+
+
+def allocate_bounces(w, h, aliasing, aa_mode):
+    # число отражений для каждого луча пикселя (или узла сетки)
+    if aliasing and aa_mode == 'lattice':
+        return np.zeros((2 * w + 1, 2 * h + 1), dtype=np.uint8)
+    return np.zeros((w, h), dtype=np.uint8)
+
+
+def bounce_histogram(bounces, refl_depth):
+    return np.bincount(bounces.ravel(), minlength=refl_depth + 1)
+
+
+def count_extra_rays(view, w, h, aliasing, aa_mode):
+    if not aliasing:
+        return 0
+    if aa_mode == 'lattice':
+        return (2 * w + 1) * (2 * h + 1) - w * h
+
+    # пиксели тайла не на краю изображения
+    x0, y0, width, height = (int(v) for v in view[17:21])
+    inner_w = max(0, min(x0 + w, width - 1) - max(x0, 1))
+    inner_h = max(0, min(y0 + h, height - 1) - max(y0, 1))
+    return 8 * inner_w * inner_h
+
+
+def get_object_counts(buffer):
+    # число сфер, плоскостей, прямоугольников, параболоидов и экземпляров - строки hits в статистике
+    spheres, _, planes, rectangles, parabaloids = buffer.get_counts()[:5]
+    return spheres, planes, rectangles, parabaloids, buffer.get_counts()[8]
+
+
+def collect_stats(counters, hits, object_counts, w, h, refl_depth, aliasing, aa_mode):
+    from ray_tracing import reduce_stats, get_cost_map
+    stats = reduce_stats(counters, hits, object_counts, refl_depth)
+    stats['cost'] = get_cost_map(counters, w, h, aliasing, aa_mode)
+    return stats
+
+
+def get_view_position(view):
+    # позиция камеры из дескриптора - для бликов (V в trace)
+    return (float(view[0]), float(view[1]), float(view[2]))
+
+
+def create_cpu_renderer(buffer, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, aliasing, aa_mode, aa, light_samples=0,
+                        stats=False):
+    # возвращает (start_tile, update_scene): start_tile(view, w, h, costs=None) запускает
+    # рендер тайла и возвращает функцию, которая дожидается его результата
+    # (image, bounces, extra_rays, tile_stats); update_scene() применяет
+    # изменения buffer (SceneBuffer). Здесь ядра читают массивы buffer напрямую.
+    # Бэкенды импортируются только при создании рендера.
+    # stats=True - режим статистики: ядра считают лучи, проверки пересечений и
+    # попадания в объекты (отдельно скомпилированная версия, обычный рендер
+    # не замедляется), tile_stats - словарь из collect_stats, иначе None.
+    # light_samples > 0 - в каждой точке освещения считается столько теневых
+    # лучей к источникам, выбранным по их вкладу (без учёта тени); 0 - точный
+    # расчёт по всем источникам, которые достают до точки.
+    # Ядро делит тайл на блоки и раздаёт их потокам numba само
+    # (scheduler.schedule_blocks): costs - оценка стоимости кадра
+    # (scheduler.estimate_cost_map), дорогие блоки расходятся по разным
+    # потокам; None - блоки по кругу
+    import numba
+    from ray_tracing import render_cpu, render_base_cpu, render_adaptive_cpu, render_lattice_cpu, resolve_lattice_cpu, allocate_stats, cull_bvh
+    from scheduler import schedule_blocks
+
+    def start_tile(view, w, h, costs=None):
+        workers = numba.get_num_threads()
+
+        def blocks(grid_w, grid_h):
+            return schedule_blocks(grid_w, grid_h, workers, view, w, h, costs, columns=stats)
+
+        views = buffer.get_views()
+        object_counts = get_object_counts(buffer)
+        stats_arrays = allocate_stats(w, h, aliasing, aa_mode, object_counts) if stats else ()
+        frustum = cull_bvh(view, w, h, views[5], views[6])
+        common = (get_scene_handle(views, light_samples), amb, lamb, refl, refl_depth, refl_cutoff, rr_depth,
+                  get_view_position(view), *frustum, stats_arrays)
+        result = allocate_image(w, h)
+        bounces = allocate_bounces(w, h, aliasing, aa_mode)
+
+        if aliasing and aa_mode == 'adaptive':
+            base, depth, hit_ids, samples = allocate_adaptive_buffers(w, h)
+            render_base_cpu(view, base, depth, hit_ids, bounces, *common, *blocks(w + 2, h + 2))
+            render_adaptive_cpu(view, base, depth, hit_ids, result, samples, *aa, *common, *blocks(w, h))
+            extra_rays = int(samples.sum())
+        elif aliasing and aa_mode == 'lattice':
+            lattice = allocate_lattice(w, h)
+            render_lattice_cpu(view, lattice, bounces, *common, *blocks(2 * w + 1, 2 * h + 1))
+            resolve_lattice_cpu(lattice, result)
+            extra_rays = count_extra_rays(view, w, h, aliasing, aa_mode)
+        else:
+            render_cpu(view, result, bounces, *common[:7], aliasing, *common[7:], *blocks(w, h))
+            extra_rays = count_extra_rays(view, w, h, aliasing, aa_mode)
+
+        tile_stats = collect_stats(*stats_arrays, object_counts, w, h, refl_depth, aliasing, aa_mode) if stats else None
+        return lambda: (result, bounces, extra_rays, tile_stats)
+
+    def update_scene():
+        return buffer.commit()
+
+    return start_tile, update_scene
+
+
+def create_device_renderer(buffer, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, aliasing, aa_mode, aa, light_samples=0,
+                           stats=False):
+    # сцена (вместе с запасными столбцами buffer) копируется на видеокарту
+    # один раз, потом - только изменившиеся столбцы. Всё идёт в одном stream:
+    # start_tile ставит ядра и копирование результата в очередь и сразу
+    # возвращается, поэтому следующий тайл или кадр рендерится, пока
+    # предыдущий копируется и кодируется
+    from numba import cuda
+    from ray_tracing import render, render_base, render_adaptive, render_lattice, resolve_lattice, scatter_columns, allocate_stats, cull_bvh
+
+    stream = cuda.stream()
+    arrays = [cuda.to_device(a, stream=stream) for a in buffer.get_arrays()]
+    counts = buffer.get_counts()
+    threadsperblock = (16, 16)
+
+    def get_blocks(shape):
+        return (int(np.ceil(shape[0] / threadsperblock[0])), int(np.ceil(shape[1] / threadsperblock[1])))
+
+    def start_tile(view_host, w, h, costs=None):
+        # costs не нужны: блоки раздаёт видеокарта
+        views = [a[:, :c] for a, c in zip(arrays, counts)]
+        object_counts = get_object_counts(buffer)
+        stats_arrays = tuple(cuda.to_device(a, stream=stream) for a in allocate_stats(w, h, aliasing, aa_mode, object_counts)) if stats else ()
+        # BVH обрезается по пирамиде каждого блока 16x16 (один блок CUDA) на
+        # CPU, по копии BVH в памяти хоста
+        frustum = (cuda.to_device(a, stream=stream) for a in cull_bvh(view_host, w, h, *buffer.get_views()[5:7]))
+        common = (get_scene_handle(views, light_samples), amb, lamb, refl, refl_depth, refl_cutoff, rr_depth,
+                  get_view_position(view_host), *frustum, stats_arrays)
+
+        view = cuda.to_device(view_host, stream=stream)
+        result = cuda.device_array((h, w, 3), dtype=np.uint8, stream=stream)
+        bounces = cuda.to_device(allocate_bounces(w, h, aliasing, aa_mode), stream=stream)
+        blockspergrid = get_blocks((w, h))
+        samples = None
+
+        if aliasing and aa_mode == 'adaptive':
+            base, depth, hit_ids, samples = (cuda.to_device(a, stream=stream) for a in allocate_adaptive_buffers(w, h))
+            render_base[get_blocks((w + 2, h + 2)), threadsperblock, stream](view, base, depth, hit_ids, bounces, *common)
+            render_adaptive[blockspergrid, threadsperblock, stream](view, base, depth, hit_ids, result, samples, *aa, *common)
+        elif aliasing and aa_mode == 'lattice':
+            lattice = cuda.device_array((3, 2 * w + 1, 2 * h + 1), dtype=np.float32, stream=stream)
+            render_lattice[get_blocks((2 * w + 1, 2 * h + 1)), threadsperblock, stream](view, lattice, bounces, *common)
+            resolve_lattice[blockspergrid, threadsperblock, stream](lattice, result)
+        else:
+            render[blockspergrid, threadsperblock, stream](view, result, bounces, *common[:7], aliasing, *common[7:])
+
+        # асинхронное копирование возможно только в page-locked память
+        result_host = result.copy_to_host(cuda.pinned_array(result.shape, dtype=np.uint8), stream=stream)
+        bounces_host = bounces.copy_to_host(cuda.pinned_array(bounces.shape, dtype=np.uint8), stream=stream)
+        samples_host = None if samples is None else samples.copy_to_host(stream=stream)
+        stats_host = [a.copy_to_host(stream=stream) for a in stats_arrays]
+        done = cuda.event()
+        done.record(stream)
+
+        def finish():
+            done.synchronize()
+            tile_stats = collect_stats(*stats_host, object_counts, w, h, refl_depth, aliasing, aa_mode) if stats else None
+            if samples_host is None:
+                return result_host, bounces_host, count_extra_rays(view_host, w, h, aliasing, aa_mode), tile_stats
+            return result_host, bounces_host, int(samples_host.sum()), tile_stats
+
+        return finish
+
+    def update_scene():
+        nonlocal counts
+        changes = buffer.commit()
+        arrays_host = buffer.get_arrays()
+
+        # копии идут в stream после уже поставленных ядер
+        for i, columns in changes.items():
+            if arrays[i].shape != arrays_host[i].shape:
+                arrays[i] = cuda.to_device(arrays_host[i], stream=stream)
+            elif columns is None:
+                arrays[i].copy_to_device(arrays_host[i], stream=stream)
+            elif len(columns) > 0:
+                data = cuda.to_device(np.ascontiguousarray(arrays_host[i][:, columns]), stream=stream)
+                index = cuda.to_device(columns, stream=stream)
+                scatter_columns[int(np.ceil(len(columns) / 128)), 128, stream](arrays[i], data, index)
+
+        counts = buffer.get_counts()
+        return changes
+
+    return start_tile, update_scene
+
+
+def create_numpy_renderer(buffer, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, aliasing, aa_mode, aa, light_samples=0,
+                          stats=False):
+    # векторный рендер без numba, BVH не нужен
+    from wavefront import render_wavefront
+
+    if aliasing and aa_mode != 'fixed':
+        raise ValueError(f"numpy backend supports only 'fixed' antialiasing, got '{aa_mode}'")
+    if stats:
+        raise ValueError("numpy backend has no statistics mode")
+    if light_samples:
+        raise ValueError("numpy backend shades all lights, light_samples must be 0")
+
+    def start_tile(view, w, h, costs=None):
+        # costs не нужны: тайлы раздаются потокам целиком (render_scheduled)
+        if buffer.get_counts()[8]:
+            raise ValueError("numpy backend does not render instances")
+        result, bounces = render_wavefront(view, (w, h), buffer.get_views()[:5], amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, aliasing,
+                                           get_view_position(view))
+        return lambda: (result, bounces, count_extra_rays(view, w, h, aliasing, aa_mode), None)
+
+    def update_scene():
+        return buffer.commit()
+
+    return start_tile, update_scene
+
+
+RENDERERS = {'cuda': create_device_renderer, 'cpu': create_cpu_renderer, 'numpy': create_numpy_renderer}
+
+
+def get_default_backend():
+    from numba import cuda
+    return 'cuda' if cuda.is_available() else 'cpu'
+
+
+def warmup(camera, start_tile):
+    # первый вызов компилирует ядра, для этого хватает маленького тайла.
+    # Скомпилированные ядра сохраняются на диск (ray_tracing/__pycache__
+    # или NUMBA_CACHE_DIR), в следующих запусках они только загружаются
+    w, h = camera.resolution
+    st = time.time()
+    start_tile(camera.generate_descriptor(), min(w, 16), min(h, 16))()
+    et = time.time()
+    print(f"warmup: {1000 * (et - st):,.1f} ms")
+
+
+def precompile(backend, buffer, specialisations, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, aa):
+    # заранее заполняет кэш ядрами для каждой пары (aliasing, aa_mode) из
+    # specialisations, например при сборке окружения для пакетных задач.
+    # Типы аргументов должны совпадать с типами при рендере - иначе это
+    # другая специализация и она компилируется заново
+    camera = Camera(resolution=(16, 16), position=(-7, 0, 4), euler=[0, 0, 0])
+    for aliasing, aa_mode in specialisations:
+        start_tile, _ = RENDERERS[backend](buffer, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, aliasing, aa_mode, aa)
+        warmup(camera, start_tile)
+
+
+def print_stats(stats):
+    print(f"rays: {', '.join(f'{k} {v:,}' for k, v in stats['rays'].items())}")
+    print(f"intersection tests: {', '.join(f'{k} {v:,}' for k, v in stats['tests'].items())}")
+    print(f"hits per object: {', '.join(f'{k} {v.tolist()}' for k, v in stats['hits'].items())}")
+    print(f"deepest bounce per ray grid point: {stats['depth'].tolist()}")
+
+
+def print_cache_stats(frame_cache):
+    stats = frame_cache.get_stats()
+    print(f"frame cache: {stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evicted, "
+          f"{stats['entries']} entries, {stats['bytes'] / 2**20:,.1f} of {stats['max_bytes'] / 2**20:,.0f} MB")
+
+
+def render_frame(camera, start_tile, refl_depth):
+    w, h = camera.resolution
+    st = time.time()
+
+    result, bounces, extra_rays, ray_stats = start_tile(camera.generate_descriptor(), w, h)()
+    et = time.time()
+    print(f"time: {1000 * (et - st):,.1f} ms")
+
+    stats = {'extra_rays': extra_rays, 'bounces': bounce_histogram(bounces, refl_depth)}
+    if ray_stats is not None:
+        stats.update(ray_stats)
+    return result, stats
+
+
+def add_tile(totals, tile, bounces, tile_rays, tile_stats, x0, y0, refl_depth, image):
+    # пишет готовый тайл в image и добавляет его статистику к totals
+    # (extra_rays, bounces, статистика лучей и карта стоимости кадра)
+    write_tile(image, tile, x0, y0)
+    totals['extra_rays'] += tile_rays
+    totals['bounces'] += bounce_histogram(bounces, refl_depth)
+
+    # статистика тайлов складывается, карта стоимости собирается как кадр
+    if tile_stats is not None:
+        from ray_tracing import merge_stats
+        first = 'rays' not in totals
+        totals.update(merge_stats(None if first else totals, tile_stats))
+        if first:
+            totals['cost'] = np.zeros(image.shape[:2], dtype=np.int64)
+        h, w = tile_stats['cost'].shape
+        totals['cost'][y0:y0 + h, x0:x0 + w] = tile_stats['cost']
+
+
+def render_tiled(camera, start_tile, refl_depth, tile_size, image):
+    # кадр рендерится тайлами tile_size, каждый готовый тайл сразу пишется
+    # в image (h, w, 3), например np.memmap из create_ppm - памяти нужно
+    # только на пару тайлов: следующий рендерится, пока пишется предыдущий
+    st = time.time()
+    stats = {'extra_rays': 0, 'bounces': np.zeros(refl_depth + 1, dtype=np.int64)}
+
+    def finish_tile(finish, x0, y0):
+        add_tile(stats, *finish(), x0, y0, refl_depth, image)
+
+    pending = None
+    for x0, y0, w, h in camera.get_tiles(tile_size):
+        finish = start_tile(camera.generate_descriptor((x0, y0)), w, h)
+        if pending is not None:
+            finish_tile(*pending)
+        pending = (finish, x0, y0)
+    finish_tile(*pending)
+
+    et = time.time()
+    print(f"time: {1000 * (et - st):,.1f} ms")
+    return stats
+
+
+def render_scheduled(camera, start_tile, refl_depth, tile_size, image, threads=None, cost_preview=0, backend=None):
+    # распределение работы для CPU и numpy. cost_preview > 0 - сначала кадр
+    # рендерится в cost_preview раз меньше, это оценка стоимости каждой его
+    # точки: тайлы идут от самых дорогих (отражения, параболоид) к дешёвым, а
+    # ядра CPU по ней же раздают блоки тайла потокам numba (tile_size = весь
+    # кадр - один тайл, всё распределяет ядро; работает и со слоем потоков
+    # workqueue). В numpy threads потоков (None - по числу ядер, без импорта
+    # numba) берут следующий тайл, как только закончили предыдущий.
+    # В stats['tile_times'] - (x0, y0, w, h, секунды) каждого тайла
+    from scheduler import get_threads, estimate_cost_map, estimate_costs, order_tiles, run_dynamic
+
+    st = time.time()
+    tiles = list(camera.get_tiles(tile_size))
+    cost_map = estimate_cost_map(camera, start_tile, cost_preview) if cost_preview else None
+    costs = None if cost_map is None else estimate_costs(camera, start_tile, tile_size, cost_map=cost_map)
+    et = time.time()
+
+    stats = {'extra_rays': 0, 'bounces': np.zeros(refl_depth + 1, dtype=np.int64)}
+    lock = threading.Lock()
+
+    def run(tile):
+        x0, y0, w, h = tile
+        result = start_tile(camera.generate_descriptor((x0, y0)), w, h, cost_map)()
+        with lock:
+            add_tile(stats, *result, x0, y0, refl_depth, image)
+
+    timings = run_dynamic(order_tiles(tiles, costs), run, get_threads(threads, backend))
+    stats['tile_times'] = [(*tile, seconds) for tile, seconds in timings]
+
+    if cost_preview:
+        print(f"cost preview: {1000 * (et - st):,.1f} ms")
+    print(f"time: {1000 * (time.time() - st):,.1f} ms")
+    return stats
+
+
+def render_sequence(cameras, buffer, animate, start_tile, update_scene, writer, output_pattern):
+    # анимация: камера на кадре i - cameras[i], animate(buffer, i) (если есть)
+    # двигает объекты через buffer.update / add / remove. Сцена загружается
+    # один раз, на каждом кадре обновляются только изменившиеся столбцы;
+    # кадр i сохраняется в output_pattern.format(i), пока рендерится кадр i + 1
+    st = time.time()
+
+    def finish_frame(finish, i):
+        result = finish()[0]
+        writer.save(result, output_pattern.format(i))
+
+    pending = None
+    for i, camera in enumerate(cameras):
+        if animate is not None:
+            animate(buffer, i)
+            update_scene()
+
+        w, h = camera.resolution
+        finish = start_tile(camera.generate_descriptor(), w, h)
+        if pending is not None:
+            finish_frame(*pending)
+        pending = (finish, i)
+    finish_frame(*pending)
+    writer.wait()
+
+    et = time.time()
+    fps = len(cameras) / (et - st)
+    print(f"{len(cameras)} frames: {1000 * (et - st):,.1f} ms, {fps:.2f} fps")
+    return fps
+
 
 def main():
     w, h = 2000, 2000
@@ -21,50 +417,169 @@ def main():
     amb, lamb, refl, refl_depth = 0.1, 0.55, 0.4, 10
     aliasing = True
 
-    scene = Scene.default_scene()
-    spheres_host, light_host, planes_host,r_h ,p_h = scene.generate_scene()
+    # отражения прекращаются, когда их вклад refl**i меньше refl_cutoff
+    # (1/512 - меньше полушага 8-битного цвета); rr_depth > 0 - русская
+    # рулетка начиная с этого отражения, для больших refl_depth
+    refl_cutoff, rr_depth = 1 / 512, 0
+
+    # сглаживание:
+    #   'fixed'    - 9 лучей на пиксель
+    #   'adaptive' - доп. лучи только на границах объектов,
+    #                aa = (число доп. лучей 1..8, порог контраста 0..255, порог разницы глубины)
+    #   'lattice'  - общая сетка лучей через полпикселя, ~4 луча на пиксель
+    aa_mode = 'adaptive'
+    aa = (8, 16, 0.05)
+
+    # для больших изображений: кадр рендерится тайлами tile_size и сразу
+    # пишется в ../output/img.ppm; None - весь кадр сразу в output_path
+    tile_size = None
+
+    # на CPU кадр (или тайл) делится на блоки 16x16, и ядро раздаёт их
+    # потокам numba по оценке стоимости, в numpy тайлы берут потоки;
+    # cost_preview > 0 - оценка: кадр сначала рендерится в cost_preview раз
+    # меньше, дорогие блоки и тайлы идут первыми и расходятся по разным
+    # потокам. На видеокарте тайлы идут по порядку, блоки распределяет она сама
+    cost_preview = 8
+
+    # .png (compress_level 0..9) или .ppm - без сжатия, быстрее всего
+    output_path, compress_level = '../output/img.png', 6
+
+    # frame_count > 0 - анимация: камера облетает target, кадры сохраняются
+    # в frame_pattern, в конце печатается число кадров в секунду
+    frame_count, target, frame_pattern = 0, (0, 0, 0), '../output/frame_{:04d}.png'
+
+    # режим статистики: число лучей, проверок пересечений, попаданий в каждый
+    # объект и глубина отражений; карта числа проверок на пиксель
+    # сохраняется в heatmap_path. Рендер при этом медленнее
+    statistics, heatmap_path = False, '../output/cost.png'
+
+    # много источников света: у Light(origin, radius) с radius > 0 свет
+    # затухает к radius, дальше не светит - такие источники лежат в своём
+    # BVH, и точка проверяет только те, до которых достаёт. light_samples > 0 -
+    # теневые лучи только к light_samples источникам, выбранным случайно по
+    # вкладу (быстро, но с шумом); 0 - точно, ко всем
+    light_samples = 0
+
+    # рендер-ферма: farm_processes > 0 - локальные процессы-воркеры,
+    # farm_address = ('0.0.0.0', 6000) - к нему подключаются воркеры с других
+    # машин (FARM_AUTHKEY=ключ python -m farm host:6000, тот же ключ в
+    # FARM_AUTHKEY здесь). Кадр делится на тайлы farm_tile, свободные воркеры
+    # берут их из общей очереди
+    farm_processes, farm_address, farm_tile = 0, None, (64, 64)
+
+    # кэш кадров на диске: кадр (или тайл) с той же сценой, камерой,
+    # настройками и кодом ядер берётся из frame_cache_dir без рендера; при
+    # переполнении frame_cache_size байт удаляются давно не использованные.
+    # None - без кэша
+    frame_cache_dir, frame_cache_size = None, 2 << 30
+
+    # сцена из файла (scene.save_scene): JSON с камерой, источниками света и
+    # настройками рендера, таблицы примитивов .npy рядом с ним читаются через
+    # memmap. Камера и настройки из файла заменяют заданные выше;
+    # None - Scene.default_scene()
+    scene_path = None
 
-    spheres = cuda.to_device(spheres_host)
-    lights = cuda.to_device(light_host)
-    planes = cuda.to_device(planes_host)
-    rectangles = cuda.to_device(r_h)
-    parabaloids = cuda.to_device(p_h)
-    
     camera = Camera(resolution=(w, h), position=CAMERA, euler=[0, -30, -40])
+    if scene_path is None:
+        scene = Scene.default_scene()
+    else:
+        scene, file_camera, render = load_scene(scene_path)
+        if file_camera is not None:
+            camera = file_camera
+            w, h = camera.resolution
+            CAMERA = tuple(camera.position)
+        settings = (amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, aliasing, aa_mode, aa, light_samples)
+        amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, aliasing, aa_mode, aa, light_samples = (
+            render.get(k, v) for k, v in zip(RENDER_SETTINGS, settings))
+    buffer = SceneBuffer(scene)
 
-    camera_origin = cuda.to_device(camera.position)
-    camera_rotation = cuda.to_device(camera.rotation)
-    pixel_loc = cuda.to_device(camera.generate_pixel_locations())
+    # 'cuda' на видеокарте, 'cpu' - многопоточный рендер на процессоре,
+    # 'numpy' - векторный рендер без numba (только aa_mode = 'fixed');
+    # None - 'cuda', если она доступна, иначе 'cpu'
+    backend = None
 
-    result = cuda.to_device(np.zeros((3, w, h), dtype=np.uint8))
+    # кодирование идёт в отдельном потоке, пока можно рендерить следующий кадр
+    writer = ImageWriter(compress_level)
 
-    threadsperblock = (16, 16)
-    blockspergrid_x = int(np.ceil(result.shape[1] / threadsperblock[0]))
-    blockspergrid_y = int(np.ceil(result.shape[2] / threadsperblock[1]))
-    blockspergrid = (blockspergrid_x, blockspergrid_y)
-
-    render[blockspergrid, threadsperblock](pixel_loc, result, camera_origin, camera_rotation,
-                                           spheres, lights, planes, amb, lamb, refl, refl_depth, aliasing,rectangles,parabaloids,CAMERA)
-    
-    print ('compile_end')
-    import time
-    st = time.time()
+    if farm_processes > 0 or farm_address is not None:
+        from farm import RenderFarm
+        settings = (amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, aliasing, aa_mode, aa, light_samples)
+        authkey = os.environ.get('FARM_AUTHKEY', '').encode() or None
+        with RenderFarm(scene, settings, backend, farm_processes, farm_address, authkey) as farm:
+            image = allocate_image(w, h)
+            st = time.time()
+            stats = farm.render(camera, farm_tile, image)
+            et = time.time()
+        writer.save(image, output_path)
 
-    render[blockspergrid, threadsperblock](pixel_loc, result, camera_origin, camera_rotation,
-                                           spheres, lights, planes, amb, lamb, refl, refl_depth, aliasing,rectangles,parabaloids,CAMERA)
-    result = result.copy_to_host()
-    et = time.time()
-    print(f"time: {1000 * (et - st):,.1f} ms")
+        # время включает запуск воркеров и загрузку ядер
+        print(f"time: {1000 * (et - st):,.1f} ms")
+        print(f"tiles: {stats['tiles']}, backups: {stats['backups']}, retries: {stats['retries']}, failed workers: {stats['failed_workers']}")
+        for name, worker in stats['workers'].items():
+            print(f"{name} ({worker['backend']}): {worker['tiles']} tiles, {1000 * worker['busy']:,.1f} ms")
+        writer.close()
+        return 0
+
+    if backend is None:
+        backend = get_default_backend()
+    start_tile, update_scene = RENDERERS[backend](buffer, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, aliasing, aa_mode, aa,
+                                                  light_samples, statistics)
+
+    frame_cache = None
+    if frame_cache_dir is not None:
+        from frame_cache import FrameCache
+        frame_cache = FrameCache(frame_cache_dir, frame_cache_size)
+        settings = (amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, aliasing, aa_mode, aa, light_samples, statistics)
+        start_tile, update_scene = frame_cache.wrap(start_tile, update_scene, buffer, settings, backend)
+
+    # компиляция ядер (или загрузка из кэша) - до замера времени рендера.
+    # С кэшем кадров тайл warmup тоже берётся из кэша, и если кадр там
+    # есть, ядра не компилируются вовсе
+    warmup(camera, start_tile)
+
+    if frame_count > 0:
+        offset = np.subtract(CAMERA, target)
+        cameras = turntable(target, np.hypot(offset[0], offset[1]), offset[2], frame_count, (w, h),
+                            start_angle=np.arctan2(offset[1], offset[0]))
+        render_sequence(cameras, buffer, None, start_tile, update_scene, writer, frame_pattern)
+        if frame_cache is not None:
+            print_cache_stats(frame_cache)
+        writer.close()
+        return 0
+
+    if tile_size is None and backend == 'cuda':
+        result, stats = render_frame(camera, start_tile, refl_depth)
+        writer.save(result, output_path)
+    elif tile_size is None:
+        # CPU и numpy: весь кадр одним тайлом, блоки по оценке стоимости
+        result = allocate_image(w, h)
+        stats = render_scheduled(camera, start_tile, refl_depth, (w, h), result, cost_preview=cost_preview, backend=backend)
+        writer.save(result, output_path)
+    else:
+        image = create_ppm('../output/img.ppm', w, h)
+        if backend == 'cuda':
+            stats = render_tiled(camera, start_tile, refl_depth, tile_size, image)
+        else:
+            stats = render_scheduled(camera, start_tile, refl_depth, tile_size, image, cost_preview=cost_preview,
+                                     backend=backend)
+            times = sorted(t[4] for t in stats['tile_times'])
+            print(f"tiles: {len(times)}, median {1000 * times[len(times) // 2]:,.1f} ms, slowest {1000 * times[-1]:,.1f} ms")
+        image.flush()
 
+    extra_rays = stats['extra_rays']
+    print(f"antialiasing rays: {extra_rays:,} ({extra_rays / (w * h):.2f} per pixel)")
+    print(f"reflection depth histogram: {stats['bounces'].tolist()}")
+    if 'rays' in stats:
+        print_stats(stats)
+        writer.save(cost_heatmap(stats['cost']), heatmap_path)
+    if frame_cache is not None:
+        print_cache_stats(frame_cache)
     print ('render end')
 
-    
-   
-    image = convert_array_to_image(result)
-    image.save('../output/img.png')
+    writer.close()
 
     return 0
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
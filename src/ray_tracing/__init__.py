@@ -1 +1,23 @@
-from .kernels import render
+# backends are imported on first use: numba (and numba.cuda for the kernels)
+# takes a while to import, a CPU run does not need the CUDA part at all
+_modules = {
+    'render': 'kernels', 'render_base': 'kernels', 'render_adaptive': 'kernels', 'render_lattice': 'kernels',
+    'resolve_lattice': 'kernels', 'scatter_columns': 'kernels',
+    'render_cpu': 'cpu', 'render_base_cpu': 'cpu', 'render_adaptive_cpu': 'cpu', 'render_lattice_cpu': 'cpu',
+    'resolve_lattice_cpu': 'cpu',
+    'cull_bvh': 'culling',
+    'clear_cache': 'cache', 'get_cache_dir': 'cache', 'get_package_hash': 'cache',
+    'allocate_stats': 'stats', 'reduce_stats': 'stats', 'merge_stats': 'stats', 'get_cost_map': 'stats',
+}
+
+__all__ = list(_modules)
+
+
+def __getattr__(name):
+    if name not in _modules:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    from importlib import import_module
+    value = getattr(import_module(f'.{_modules[name]}', __name__), name)
+    globals()[name] = value
+    return value
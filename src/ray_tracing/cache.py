@@ -0,0 +1,114 @@
+import os
+import sys
+import hashlib
+import warnings
+from functools import lru_cache
+from numba.core import caching, config
+from numba.core.dispatcher import Dispatcher
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@lru_cache(maxsize=None)
+def hash_sources(stamps: tuple) -> bytes:
+    # stamps: (path, mtime, size) of every module, files are read again only
+    # when one of them changes
+    sha = hashlib.sha256()
+    for path, _, _ in stamps:
+        with open(path, 'rb') as f:
+            sha.update(f.read())
+    return sha.digest()
+
+
+def get_package_hash() -> bytes:
+    paths = sorted(os.path.join(PACKAGE_DIR, f) for f in os.listdir(PACKAGE_DIR) if f.endswith('.py'))
+    return hash_sources(tuple((p, os.stat(p).st_mtime, os.stat(p).st_size) for p in paths))
+
+
+class PackageCacheLocator(caching.InTreeCacheLocator):
+    '''
+    Disk cache of the compiled kernels of this package. numba keeps one cache
+    entry per signature and checks only the source of the kernel's own file;
+    here the stamp is the hash of all modules of the package, so a change in
+    any device function recompiles the kernels that inline it.
+    Cache files go to NUMBA_CACHE_DIR if it is set, else to __pycache__.
+    '''
+    def __init__(self, py_func, py_file):
+        super().__init__(py_func, py_file)
+        if config.CACHE_DIR:
+            self._cache_path = os.path.join(config.CACHE_DIR, self.get_suitable_cache_subpath(py_file))
+
+    def get_source_stamp(self):
+        return get_package_hash()
+
+    @classmethod
+    def from_function(cls, py_func, py_file):
+        if os.path.dirname(os.path.abspath(py_file)) != PACKAGE_DIR:
+            return None
+        return super().from_function(py_func, py_file)
+
+
+def get_cache_dir() -> str:
+    if config.CACHE_DIR:
+        return os.path.join(config.CACHE_DIR, PackageCacheLocator.get_suitable_cache_subpath(__file__))
+    return os.path.join(PACKAGE_DIR, '__pycache__')
+
+
+def clear_cache():
+    # removes the compiled kernels, the next run compiles them again
+    cache_dir = get_cache_dir()
+    if not os.path.isdir(cache_dir):
+        return
+    for f in os.listdir(cache_dir):
+        if f.endswith('.nbi') or f.endswith('.nbc'):
+            os.remove(os.path.join(cache_dir, f))
+
+
+class PackageCacheImpl(caching.CompileResultCacheImpl):
+    _locator_classes = [PackageCacheLocator]
+
+
+class PackageFunctionCache(caching.FunctionCache):
+    _impl_class = PackageCacheImpl
+
+
+def get_cuda_cache_class():
+    # numba.cuda is imported only by the CUDA kernels
+    from numba.cuda.dispatcher import CUDACache, CUDACacheImpl
+
+    class PackageCUDACacheImpl(CUDACacheImpl):
+        _locator_classes = [PackageCacheLocator]
+
+    class PackageCUDACache(CUDACache):
+        _impl_class = PackageCUDACacheImpl
+
+    return PackageCUDACache
+
+
+def cached(dispatcher):
+    '''
+    Decorator over njit / cuda.jit (in place of cache=True): the dispatcher
+    keeps its compiled code on disk with PackageCacheLocator, through
+    subclasses of numba's cache classes. The locator is checked on the new
+    cache: if a numba release stops using these classes, the function is left
+    without a disk cache (and a warning) - never with numba's default one,
+    which would load kernels of changed device functions.
+    '''
+    if not isinstance(dispatcher, Dispatcher):
+        return dispatcher       # the CUDA simulator has no cache
+    cuda_dispatcher = sys.modules.get('numba.cuda.dispatcher')
+    if cuda_dispatcher is not None and isinstance(dispatcher, cuda_dispatcher.CUDADispatcher):
+        cache_class = get_cuda_cache_class()
+    else:
+        cache_class = PackageFunctionCache
+
+    try:
+        cache = cache_class(dispatcher.py_func)
+        valid = isinstance(cache._impl.locator, PackageCacheLocator)
+    except Exception:
+        valid = False
+    if valid:
+        dispatcher._cache = cache
+    else:
+        warnings.warn(f'{dispatcher.py_func.__name__}: numba cache classes changed, compiled without a disk cache')
+    return dispatcher
@@ -1,18 +1,97 @@
-from numba import cuda
-from math import sqrt
+from numba import config, njit
+from numba.core.extending import overload
+from math import sqrt, sin, floor
 from scene.common import Vector3D
-from scene.scene import *
 
 import numpy as np
 
 CAMERA_COORD = [-7,0,4]
 
-@cuda.jit(device=True)
+# Device functions are plain @njit: CUDA kernels compile them as device
+# functions on first use, and the CPU backend calls them directly.
+# The simulator runs kernels as Python and can't pass its arrays to @njit.
+if config.ENABLE_CUDASIM:
+    from numba import cuda
+    from threading import Lock
+    _hit_lock = Lock()
+    device_jit = cuda.jit(device=True)
+else:
+    device_jit = njit
+
+
+# Statistics mode. The kernels take stats = () or (counters, hits) from
+# ray_tracing.stats.allocate_stats; get_stats turns it into None or
+# (counters, hits, x, y) for the grid point (x, y). The functions below check
+# "stats is not None", numba removes that code when stats is None, so the
+# normal render is compiled without it.
+
+def get_stats(stats, x, y):
+    if len(stats) == 0:
+        return None
+    return (stats[0], stats[1], x, y)
+
+
+@overload(get_stats)
+def _get_stats(stats, x, y):
+    # chosen by the type of stats, a tuple can't be compared to None
+    if len(stats) == 0:
+        return lambda stats, x, y: None
+    return lambda stats, x, y: (stats[0], stats[1], x, y)
+
+
+def add_hit(hits, row, column):
+    # CUDA threads of one column share the slot: atomic in the kernels
+    # (overloaded in kernels.py), a lock in the simulator - its threads swap
+    # the cuda module of this file in and out, cuda.atomic may be missing
+    with _hit_lock:
+        hits[row, column] += 1
+
+
+@overload(add_hit, target='cpu')
+def _add_hit(hits, row, column):
+    # in the statistics mode a CPU task renders whole columns
+    # (scheduler.schedule_blocks), nobody else writes its slot
+    def add_hit_cpu(hits, row, column):
+        hits[row, column] += 1
+    return add_hit_cpu
+
+
+@device_jit
+def count_stat(stats, row, value):
+    if stats is not None:
+        counters, _, x, y = stats
+        counters[row, x, y] += value
+
+
+@device_jit
+def max_stat(stats, row, value):
+    if stats is not None:
+        counters, _, x, y = stats
+        counters[row, x, y] = max(counters[row, x, y], value)
+
+
+@device_jit
+def count_hit(stats, obj_type, obj_index, spheres, planes, rectangles, parabaloids):
+    # hits rows: spheres, planes, rectangles, paraboloids, instances
+    if stats is not None:
+        _, hits, x, _ = stats
+        row = obj_index
+        if obj_type > 0:
+            row += spheres.shape[1]
+        if obj_type > 1:
+            row += planes.shape[1]
+        if obj_type > 2:
+            row += rectangles.shape[1]
+        if obj_type > 3:
+            row += parabaloids.shape[1]
+        add_hit(hits, row, x)
+
+@device_jit
 def to_tuple3(array):
     return (array[0], array[1], array[2])
 
 
-@cuda.jit(device=True)
+@device_jit
 def linear_comb(a, b, c1, c2):
     p0 = c1 * a[0] + c2 * b[0]
     p1 = c1 * a[1] + c2 * b[1]
@@ -20,26 +99,26 @@ def linear_comb(a, b, c1, c2):
     return (p0, p1, p2)
 
 
-@cuda.jit(device=True)
+@device_jit
 def vector_difference(fromm, to):
     f0, f1, f2 = fromm
     t0, t1, t2 = to
     return (t0 - f0, t1 - f1, t2 - f2)
 
 
-@cuda.jit(device=True)
+@device_jit
 def normalize(vector):
     (X, Y, Z) = vector
     norm = sqrt(X * X + Y * Y + Z * Z)
     return (X / norm, Y / norm, Z / norm)
 
 
-@cuda.jit(device=True)
+@device_jit
 def dot(a, b):
     return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
 
 
-@cuda.jit(device=True)
+@device_jit
 def matmul(A, x):
 
     A0, A1, A2 = A
@@ -49,99 +128,133 @@ def matmul(A, x):
     return (b0, b1, b2)
 
 
-@cuda.jit(device=True)
+@device_jit
 def clip_color(color):
 
     return min(max(0, int(round(color))), 255)
 
 
-@cuda.jit(device=True)
+@device_jit
 def clip_color_vector(color3):
     (R, G, B) = color3
-    return clip_color(R), clip_color(B), clip_color(G)
+    return clip_color(R), clip_color(G), clip_color(B)
 
 
-@cuda.jit(device=True)
+@device_jit
 def get_sphere_color(index, spheres):
 
     (R, G, B) = spheres[4:7, index]
     return (R, G, B)
 
 
-@cuda.jit(device=True)
+@device_jit
 def get_plane_color(index, planes):
 
     (R, G, B) = planes[6:9, index]
     return (R, G, B)
 
-@cuda.jit(device=True)
+@device_jit
 def get_rectangle_color(index, rectangles):
     (R, G, B) = rectangles[9:12, index]
     return (R, G, B)
 
-@cuda.jit(device=True)
+@device_jit
 def get_parabaloid_color(index, parabaloids):
     (R, G, B) = parabaloids[5:8, index]
     return (R, G, B)
 
-@cuda.jit(device=True)
+@device_jit
+def get_triangle_color(index, triangles, mesh_colors):
+    # the colour of the mesh of the triangle
+    (R, G, B) = mesh_colors[0:3, triangles[3, index]]
+    return (R, G, B)
+
+@device_jit
 def get_vector_to_light(P, lights, light_index):
 
     L = lights[0:3, light_index]
     P_L = vector_difference(P, L)
     return normalize(P_L)
 
-@cuda.jit(device=True)
+@device_jit
+def get_distance_to_light(P, lights, light_index):
+
+    L = lights[0:3, light_index]
+    P_L = vector_difference(P, L)
+    return sqrt(dot(P_L, P_L))
+
+@device_jit
+def get_light_falloff(distance, radius):
+    # smooth window (1 - (d / r)^2)^2: 1 at the light, 0 from radius on,
+    # radius 0 - the light does not fade
+    if radius <= 0:
+        return 1.0
+    x = distance / radius
+    if x >= 1:
+        return 0.0
+    f = 1 - x * x
+    return f * f
+
+@device_jit
 def get_vector_to_camera(P,CAMERA):
     
     P_C = vector_difference(P, CAMERA)
     return normalize(P_C)
 
-@cuda.jit(device=True)
+@device_jit
 def get_sphere_normal(P, sphere_index, spheres):
     sphere_origin = spheres[0:3, sphere_index]
     N = vector_difference(sphere_origin, P)
     return normalize(N)
 
 
-@cuda.jit(device=True)
+@device_jit
 def get_plane_normal(plane_index, planes):
-    return normalize(planes[3:6, plane_index])
+    return to_tuple3(planes[3:6, plane_index])
 
-@cuda.jit(device=True)
+@device_jit
 def get_rect_normal(rec_idx,rectangles):
-    # [u,v] = n
-    # 
-    N = normalize(cross_product(rectangles[3:6, rec_idx],rectangles[6:9, rec_idx]))
-
-    return N
-
-@cuda.jit(device=True)
+    # precomputed normalize(u x v)
+    return to_tuple3(rectangles[13:16, rec_idx])
+
+@device_jit
+def get_triangle_normal(tri_idx, triangles, vertices):
+    # flat shading: normalize((B - A) x (C - A))
+    A = to_tuple3(vertices[:, triangles[0, tri_idx]])
+    B = to_tuple3(vertices[:, triangles[1, tri_idx]])
+    C = to_tuple3(vertices[:, triangles[2, tri_idx]])
+    return normalize(cross_product(vector_difference(A, B), vector_difference(A, C)))
+
+@device_jit
 def get_parabaloid_normal(P,p_idx, parabaloids):
-    a = parabaloids[3,p_idx]
-    b = parabaloids[4,p_idx]
     orient = parabaloids[8,p_idx] 
     C = parabaloids[0:3,p_idx]
     
-    ksi = (b/a)**2
-    eta = (a/b)**2
+    ksi = parabaloids[11,p_idx]
+    eta = parabaloids[12,p_idx]
 
     N = (2*ksi*(((P[0] - C[0]))), 2*eta*(((P[1] - C[1]))), (-1 * orient))
    
     
     return normalize(N)
  
-@cuda.jit(device=True)
+@device_jit
+def random_from_vector(v, i) -> float:
+    # deterministic pseudo random number in [0, 1) from a point and a counter
+    s = sin(v[0] * 12.9898 + v[1] * 78.233 + v[2] * 37.719 + i * 4.1414) * 43758.5453
+    return s - floor(s)
+
+@device_jit
 def get_reflection(ray_dir, normal):
     k = dot(ray_dir, normal)
     R = linear_comb(ray_dir, normal, 1.0, -2.0 * k)
     return R
 
-@cuda.jit(device=True)
+@device_jit
 def cross_product(a: Vector3D, b: Vector3D) -> Vector3D:
     return (a[1]*b[2] - a[2]*b[1], a[2]*b[0] - a[0]*b[2],a[0]*b[1] - a[1]*b[0])
 
-@cuda.jit(device=True)
+@device_jit
 def is_ligth_inside_parabaloid(p_origin: tuple, l_origin: tuple, a: float, b:float, p_orinet):
     x_p, y_p, z_p = p_origin
     x_l, y_l, z_l = l_origin
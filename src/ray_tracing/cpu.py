@@ -0,0 +1,83 @@
+from numba import config, njit, prange
+from .cache import cached
+from .trace import render_pixel, render_pixel_base, render_pixel_adaptive, render_lattice_point, resolve_lattice_pixel
+
+
+# same per-pixel code as the CUDA kernels. The grid is split into blocks,
+# one task per numba thread renders the blocks order[starts[t]:starts[t + 1]]
+# (scheduler.schedule_blocks), so expensive blocks are spread over the
+# threads whatever the threading layer. nogil lets the image encoder thread
+# run during a render. A parallel loop does not take nested tuples: the
+# scene handle is split before it and put together again in it
+
+
+@njit
+def get_block(b, block_w, block_h, grid_w, grid_h):
+    # grid points [x0, x1) x [y0, y1) of block b, column major
+    rows = (grid_h + block_h - 1) // block_h
+    x0, y0 = (b // rows) * block_w, (b % rows) * block_h
+    return x0, min(x0 + block_w, grid_w), y0, min(y0 + block_h, grid_h)
+
+
+@cached
+@njit(parallel=True, nogil=True)
+def render_cpu(camera, result, bounces, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, aliasing, CAMERA, frustum_bounds, frustum_nodes, frustum_tiles, stats_arrays, order, starts, block_w, block_h):
+    arrays, instancing, lighting = scene[:9], scene[9], scene[10]
+    for t in prange(starts.size - 1):
+        for k in range(starts[t], starts[t + 1]):
+            x0, x1, y0, y1 = get_block(order[k], block_w, block_h, result.shape[1], result.shape[0])
+            for x in range(x0, x1):
+                for y in range(y0, y1):
+                    render_pixel(x, y, camera, result, bounces, arrays + (instancing, lighting), amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, aliasing, CAMERA, frustum_bounds, frustum_nodes, frustum_tiles, stats_arrays)
+
+
+@cached
+@njit(parallel=True, nogil=True)
+def render_base_cpu(camera, base, depth, hit_ids, bounces, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, frustum_tiles, stats_arrays, order, starts, block_w, block_h):
+    arrays, instancing, lighting = scene[:9], scene[9], scene[10]
+    for t in prange(starts.size - 1):
+        for k in range(starts[t], starts[t + 1]):
+            x0, x1, y0, y1 = get_block(order[k], block_w, block_h, base.shape[1], base.shape[2])
+            for x in range(x0, x1):
+                for y in range(y0, y1):
+                    render_pixel_base(x, y, camera, base, depth, hit_ids, bounces, arrays + (instancing, lighting), amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, frustum_tiles, stats_arrays)
+
+
+@cached
+@njit(parallel=True, nogil=True)
+def render_adaptive_cpu(camera, base, depth, hit_ids, result, samples, aa_samples, aa_contrast, aa_depth, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, frustum_tiles, stats_arrays, order, starts, block_w, block_h):
+    arrays, instancing, lighting = scene[:9], scene[9], scene[10]
+    for t in prange(starts.size - 1):
+        for k in range(starts[t], starts[t + 1]):
+            x0, x1, y0, y1 = get_block(order[k], block_w, block_h, result.shape[1], result.shape[0])
+            for x in range(x0, x1):
+                for y in range(y0, y1):
+                    render_pixel_adaptive(x, y, camera, base, depth, hit_ids, result, samples, aa_samples, aa_contrast, aa_depth, arrays + (instancing, lighting), amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, frustum_tiles, stats_arrays)
+
+
+@cached
+@njit(parallel=True, nogil=True)
+def render_lattice_cpu(camera, lattice, bounces, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, frustum_tiles, stats_arrays, order, starts, block_w, block_h):
+    arrays, instancing, lighting = scene[:9], scene[9], scene[10]
+    for t in prange(starts.size - 1):
+        for k in range(starts[t], starts[t + 1]):
+            i0, i1, j0, j1 = get_block(order[k], block_w, block_h, lattice.shape[1], lattice.shape[2])
+            for i in range(i0, i1):
+                for j in range(j0, j1):
+                    render_lattice_point(i, j, camera, lattice, bounces, arrays + (instancing, lighting), amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, frustum_tiles, stats_arrays)
+
+
+@cached
+@njit(parallel=True, nogil=True)
+def resolve_lattice_cpu(lattice, result):
+    for x in prange(result.shape[1]):
+        for y in range(result.shape[0]):
+            resolve_lattice_pixel(x, y, lattice, result)
+
+
+if config.ENABLE_CUDASIM:
+    render_cpu = render_cpu.py_func
+    render_base_cpu = render_base_cpu.py_func
+    render_adaptive_cpu = render_adaptive_cpu.py_func
+    render_lattice_cpu = render_lattice_cpu.py_func
+    resolve_lattice_cpu = resolve_lattice_cpu.py_func
@@ -0,0 +1,133 @@
+import numpy as np
+from numba import njit, prange
+from .cache import cached
+
+# culling tiles of CULL_TILE x CULL_TILE pixels, one CUDA block each
+CULL_TILE = 16
+
+
+@cached
+@njit
+def get_camera_dir(x, y, camera):
+    # unnormalised direction of the ray through tile pixel coordinates (x, y),
+    # as get_pixel_location and get_camera_ray build it
+    P = (camera[12], (x + camera[17]) * camera[14] + camera[13], (y + camera[18]) * camera[16] + camera[15])
+    return np.array([camera[3] * P[0] + camera[4] * P[1] + camera[5] * P[2],
+                     camera[6] * P[0] + camera[7] * P[1] + camera[8] * P[2],
+                     camera[9] * P[0] + camera[10] * P[1] + camera[11] * P[2]])
+
+
+@cached
+@njit
+def get_frustum_planes(camera, xa, xb, ya, yb):
+    # inward normals of the four side planes through the camera position
+    # that bound the rays through pixel coordinates [xa, xb] x [ya, yb]
+    corners = (get_camera_dir(xa, ya, camera), get_camera_dir(xb, ya, camera),
+               get_camera_dir(xb, yb, camera), get_camera_dir(xa, yb, camera))
+    centre = get_camera_dir((xa + xb) / 2, (ya + yb) / 2, camera)
+
+    normals = np.zeros((4, 3))
+    for i in range(4):
+        a = corners[i]
+        b = corners[(i + 1) % 4]
+        n = np.array([a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0]])
+        if (n * centre).sum() < 0:
+            n = -n
+        normals[i] = n
+    return normals
+
+
+@cached
+@njit
+def box_outside(bounds, node, normals, apex) -> bool:
+    # the box is entirely behind one of the planes: its corner farthest
+    # along the normal is behind it
+    for i in range(normals.shape[0]):
+        s = 0.
+        for k in range(3):
+            v = bounds[3 + k, node] if normals[i, k] > 0 else bounds[k, node]
+            s += normals[i, k] * (v - apex[k])
+        if s < 0:
+            return True
+    return False
+
+
+@cached
+@njit
+def walk_frustum(bvh_bounds, bvh_nodes, normals, apex, kept, offset) -> int:
+    # depth first over the nodes whose boxes reach into the frustum, a missed
+    # box skips its subtree. Writes the nodes to kept[offset:] (if kept is
+    # not empty) and returns their number
+    count = 0
+    node = 0
+    while node < bvh_nodes.shape[1]:
+        if box_outside(bvh_bounds, node, normals, apex):
+            node = bvh_nodes[2, node]
+            continue
+        if kept.shape[0] > 0:
+            kept[offset + count] = node
+        count += 1
+        node += 1
+    return count
+
+
+@cached
+@njit(parallel=True, nogil=True)
+def cull_bvh(camera, w, h, bvh_bounds, bvh_nodes):
+    '''
+    The BVH culled to the view frustum of every CULL_TILE x CULL_TILE block
+    of a (w, h) tile: only nodes whose boxes reach into the frustum are kept,
+    in the same depth first order with skip indices into the kept ones.
+
+    frustum_bounds: float32 (6, n), frustum_nodes: int32 (3, n) - the kept
+    nodes of all blocks one after another, skip indices are absolute
+    frustum_tiles:  int32 (2, blocks x, blocks y) - first node and node count
+    of every block
+
+    A block's frustum covers one pixel around it: the border rays of
+    adaptive antialiasing, sub-pixel and lattice rays of its pixels.
+    Children boxes lie in their parent's, so a culled node takes its
+    subtree with it and the traversal finds the same hits as with the
+    whole BVH.
+    '''
+    nx = (w + CULL_TILE - 1) // CULL_TILE
+    ny = (h + CULL_TILE - 1) // CULL_TILE
+    apex = camera[0:3].copy()
+    frustum_tiles = np.zeros((2, nx, ny), dtype=np.int32)
+    normals = np.zeros((nx * ny, 4, 3))
+    empty = np.zeros(0, dtype=np.int64)
+
+    for t in prange(nx * ny):
+        tx = t // ny
+        ty = t % ny
+        xa = tx * CULL_TILE - 1.
+        xb = min((tx + 1) * CULL_TILE, w) + 0.
+        ya = ty * CULL_TILE - 1.
+        yb = min((ty + 1) * CULL_TILE, h) + 0.
+        normals[t] = get_frustum_planes(camera, xa, xb, ya, yb)
+        frustum_tiles[1, tx, ty] = walk_frustum(bvh_bounds, bvh_nodes, normals[t], apex, empty, 0)
+
+    total = 0
+    for t in range(nx * ny):
+        frustum_tiles[0, t // ny, t % ny] = total
+        total += frustum_tiles[1, t // ny, t % ny]
+
+    kept = np.zeros(total, dtype=np.int64)
+    frustum_bounds = np.zeros((6, total), dtype=np.float32)
+    frustum_nodes = np.zeros((3, total), dtype=np.int32)
+
+    for t in prange(nx * ny):
+        start = frustum_tiles[0, t // ny, t % ny]
+        end = start + frustum_tiles[1, t // ny, t % ny]
+        walk_frustum(bvh_bounds, bvh_nodes, normals[t], apex, kept, start)
+
+        for k in range(start, end):
+            node = kept[k]
+            for r in range(6):
+                frustum_bounds[r, k] = bvh_bounds[r, node]
+            frustum_nodes[0, k] = bvh_nodes[0, node]
+            frustum_nodes[1, k] = bvh_nodes[1, node]
+            # the first kept node after the subtree
+            frustum_nodes[2, k] = start + np.searchsorted(kept[start:end], bvh_nodes[2, node])
+
+    return frustum_bounds, frustum_nodes, frustum_tiles
@@ -1,14 +1,10 @@
-from numba import cuda
 from math import sqrt
 from .common import *
-from scene.scene import *
 
 
 
-@cuda.jit(device=True)
-def intersect_ray_parabaloid(ray_origin: tuple, ray_dir: tuple, parabaloid_origin: tuple, a: float, b: float, p_orient: float,h:float):
-    k = (b/a)**2
-    e = (a/b)**2
+@device_jit
+def intersect_ray_parabaloid(ray_origin: tuple, ray_dir: tuple, parabaloid_origin: tuple, k: float, e: float, p_orient: float,h:float):
     
     
     rx = ray_origin[0]
@@ -65,8 +61,8 @@ def intersect_ray_parabaloid(ray_origin: tuple, ray_dir: tuple, parabaloid_origi
     return -999.0
     
 
-@cuda.jit(device=True)
-def intersect_ray_sphere(ray_origin: tuple, ray_dir: tuple, sphere_origin: tuple, sphere_radius: float) -> float:
+@device_jit
+def intersect_ray_sphere(ray_origin: tuple, ray_dir: tuple, sphere_origin: tuple, sphere_radius_sq: float) -> float:
    
     R = normalize(ray_dir)
 
@@ -74,7 +70,7 @@ def intersect_ray_sphere(ray_origin: tuple, ray_dir: tuple, sphere_origin: tuple
 
     a = dot(R, R)
     b = 2 * dot(L, R)
-    c = dot(L, L) - sphere_radius * sphere_radius
+    c = dot(L, L) - sphere_radius_sq
 
     discriminant = b * b - 4 * a * c
 
@@ -94,37 +90,30 @@ def intersect_ray_sphere(ray_origin: tuple, ray_dir: tuple, sphere_origin: tuple
             return -999.0
 
 
-@cuda.jit(device=True)
-def intersect_ray_plane(ray_origin: tuple, ray_dir: tuple, plane_origin: tuple, plane_normal: tuple) -> float:
+@device_jit
+def intersect_ray_plane(ray_origin: tuple, ray_dir: tuple, plane_normal: tuple, D: float) -> float:
     EPS = 0.0001
 
-    N = plane_normal[0:3]
-
     denom = dot(ray_dir, plane_normal)
 
     if abs(denom) <= EPS:
         return -999.9
 
-    LP = vector_difference(ray_origin, plane_origin)
-
-    nominator = dot(LP, N)
-
-    dist = nominator / denom
+    dist = (D - dot(ray_origin, plane_normal)) / denom
 
     if dist > 0:
         return dist
     else:
         return -999.0
     
-@cuda.jit(device=True)
-def intersect_ray_rectangle(ray_origin: tuple, ray_dir: tuple, rect_origin:tuple,u:tuple,v:tuple, N: tuple) -> float:
+@device_jit
+def intersect_ray_rectangle(ray_origin: tuple, ray_dir: tuple, rect_origin:tuple,u:tuple,v:tuple, N: tuple, w: tuple, D: float) -> float:
     EPS = 0.001
     denom = dot(N,ray_dir)
     
     if(abs(denom) <= EPS):
         return -999.0
 
-    D = dot(N,rect_origin)
     t = (D-dot(N,ray_origin)) / denom
 
     inter0 = ray_origin[0] + t*ray_dir[0]
@@ -134,11 +123,6 @@ def intersect_ray_rectangle(ray_origin: tuple, ray_dir: tuple, rect_origin:tuple
     intersection:tuple = (inter0,inter1,inter2)
     hit_vector = vector_difference(intersection, rect_origin)
     
-
-    NN = cross_product(u,v)
-    s = dot(NN,NN)
-    w = (NN[0] * 1/s, NN[1] * 1/s, NN[2] * 1/s)
-    
     a = dot(w,cross_product(hit_vector, v))
     b = dot(w,cross_product(u , hit_vector))
     
@@ -151,3 +135,99 @@ def intersect_ray_rectangle(ray_origin: tuple, ray_dir: tuple, rect_origin:tuple
     else:
         return -999.0
     
+
+
+@device_jit
+def get_component(v: tuple, axis: int) -> float:
+    if axis == 0:
+        return v[0]
+    if axis == 1:
+        return v[1]
+    return v[2]
+
+
+@device_jit
+def intersect_ray_triangle(ray_origin: tuple, ray_dir: tuple, A: tuple, B: tuple, C: tuple) -> float:
+    # watertight test (Woop, Benthin, Wald 2013): the corners are sheared into
+    # a space where the ray starts at 0 and runs along z, its largest axis.
+    # There the 2D edge functions of two triangles agree on their shared edge,
+    # rays can't slip between them. Both sides are hit
+    dx = abs(ray_dir[0])
+    dy = abs(ray_dir[1])
+    dz = abs(ray_dir[2])
+    kz = 2
+    if dx >= dy and dx >= dz:
+        kz = 0
+    elif dy >= dz:
+        kz = 1
+    kx = (kz + 1) % 3
+    ky = (kx + 1) % 3
+
+    Sz = 1.0 / get_component(ray_dir, kz)
+    Sx = get_component(ray_dir, kx) * Sz
+    Sy = get_component(ray_dir, ky) * Sz
+
+    a = vector_difference(ray_origin, A)
+    b = vector_difference(ray_origin, B)
+    c = vector_difference(ray_origin, C)
+    az = get_component(a, kz)
+    bz = get_component(b, kz)
+    cz = get_component(c, kz)
+    ax = get_component(a, kx) - Sx * az
+    ay = get_component(a, ky) - Sy * az
+    bx = get_component(b, kx) - Sx * bz
+    by = get_component(b, ky) - Sy * bz
+    cx = get_component(c, kx) - Sx * cz
+    cy = get_component(c, ky) - Sy * cz
+
+    U = cx * by - cy * bx
+    V = ax * cy - ay * cx
+    W = bx * ay - by * ax
+    if (U < 0 or V < 0 or W < 0) and (U > 0 or V > 0 or W > 0):
+        return -999.0
+
+    det = U + V + W
+    if det == 0:
+        return -999.0
+
+    t = Sz * (U * az + V * bz + W * cz) / det
+    if t > 0:
+        return t
+    return -999.0
+
+
+@device_jit
+def safe_inverse(d: float) -> float:
+    EPS = 1e-12
+    if abs(d) < EPS:
+        d = EPS if d >= 0 else -EPS
+    return 1.0 / d
+
+
+@device_jit
+def get_inverse_dir(ray_dir: tuple) -> tuple:
+    return (safe_inverse(ray_dir[0]), safe_inverse(ray_dir[1]), safe_inverse(ray_dir[2]))
+
+
+@device_jit
+def intersect_ray_box(ray_origin: tuple, inv_dir: tuple, bounds, node: int, t_max: float) -> bool:
+    t_near = 0.0
+    t_far = t_max
+
+    for i in range(3):
+        t0 = (bounds[i, node] - ray_origin[i]) * inv_dir[i]
+        t1 = (bounds[i + 3, node] - ray_origin[i]) * inv_dir[i]
+        if t0 > t1:
+            t0, t1 = t1, t0
+        t_near = max(t_near, t0)
+        t_far = min(t_far, t1)
+
+    return t_near <= t_far
+
+
+@device_jit
+def point_in_box(P: tuple, bounds, node: int) -> bool:
+    for i in range(3):
+        if P[i] < bounds[i, node] or P[i] > bounds[i + 3, node]:
+            return False
+    return True
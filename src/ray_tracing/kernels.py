@@ -1,62 +1,69 @@
 from numba import cuda
-from .trace import sample
-from .common import matmul, normalize, linear_comb, clip_color_vector
+from numba.core.extending import overload
+from .cache import cached
+from .common import add_hit
+from .trace import render_pixel, render_pixel_base, render_pixel_adaptive, render_lattice_point, resolve_lattice_pixel
 
 
+@overload(add_hit, target='cuda')
+def _add_hit(hits, row, column):
+    # statistics mode: threads of one column count hits into the same slot
+    def add_hit_cuda(hits, row, column):
+        cuda.atomic.add(hits, (row, column), 1)
+    return add_hit_cuda
+
+
+@cached
 @cuda.jit
-def render(pixel_loc, result, camera_origin, camera_rotation, spheres, lights, planes, amb, lamb, refl, refl_depth, aliasing,rectangles,parabaloids,CAMERA):
-    R = camera_rotation
-    (R0, R1, R2) = R[0, :], R[1, :], R[2, :]
+def render(camera, result, bounces, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, aliasing, CAMERA, frustum_bounds, frustum_nodes, frustum_tiles, stats_arrays):
     x, y = cuda.grid(2)
 
-    if x <= pixel_loc.shape[1] and y <= pixel_loc.shape[2]:
+    if x < result.shape[1] and y < result.shape[0]:
+        render_pixel(x, y, camera, result, bounces, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, aliasing, CAMERA, frustum_bounds, frustum_nodes, frustum_tiles, stats_arrays)
 
-        ray_origin = camera_origin[0], camera_origin[1], camera_origin[2]
 
-        P = pixel_loc[0:3, x, y]
+@cached
+@cuda.jit
+def render_base(camera, base, depth, hit_ids, bounces, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, frustum_tiles, stats_arrays):
+    x, y = cuda.grid(2)
 
-        ray_dir = matmul((R0, R1, R2), P)
-        ray_dir = normalize(ray_dir)
+    if x < base.shape[1] and y < base.shape[2]:
+        render_pixel_base(x, y, camera, base, depth, hit_ids, bounces, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, frustum_tiles, stats_arrays)
 
-        (R, G, B) = sample(ray_origin, ray_dir, spheres, lights, planes, amb, lamb, refl, refl_depth,rectangles,parabaloids,CAMERA)
 
-        if aliasing and x+1 <= pixel_loc.shape[1] and x-1 >= 0 and y+1 <= pixel_loc.shape[2] and y-1 >= 0:
+@cached
+@cuda.jit
+def render_adaptive(camera, base, depth, hit_ids, result, samples, aa_samples, aa_contrast, aa_depth, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, frustum_tiles, stats_arrays):
+    x, y = cuda.grid(2)
 
-            P_left = pixel_loc[0:3, x-1, y]
-            P_right = pixel_loc[0:3, x+1, y]
-            P_top = pixel_loc[0:3, x, y+1]
-            P_bot = pixel_loc[0:3, x, y-1]
+    if x < result.shape[1] and y < result.shape[0]:
+        render_pixel_adaptive(x, y, camera, base, depth, hit_ids, result, samples, aa_samples, aa_contrast, aa_depth, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, frustum_tiles, stats_arrays)
 
-            P_topleft = pixel_loc[0:3, x-1, y+1]
-            P_topright = pixel_loc[0:3, x+1, y+1]
-            P_bottomleft = pixel_loc[0:3, x-1, y-1]
-            P_bottomright = pixel_loc[0:3, x+1, y-1]
 
-            P_left = linear_comb(P, P_left, 0.5, 0.5)
-            P_right = linear_comb(P, P_right, 0.5, 0.5)
-            P_top = linear_comb(P, P_top, 0.5, 0.5)
-            P_bot = linear_comb(P, P_bot, 0.5, 0.5)
-            P_topleft = linear_comb(P, P_topleft, 0.5, 0.5)
-            P_topright = linear_comb(P, P_topright, 0.5, 0.5)
-            P_bottomleft = linear_comb(P, P_bottomleft, 0.5, 0.5)
-            P_bottomright = linear_comb(P, P_bottomright, 0.5, 0.5)
+@cached
+@cuda.jit
+def render_lattice(camera, lattice, bounces, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, frustum_tiles, stats_arrays):
+    i, j = cuda.grid(2)
 
-            for P in [P_left, P_right, P_top, P_bot, P_topleft, P_topright, P_bottomleft, P_bottomright]:
-                ray_dir = matmul((R0, R1, R2), P)
-                ray_dir = normalize(ray_dir)
-                (R_s, G_s, B_s) = sample(ray_origin, ray_dir, spheres, lights, planes, amb, lamb, refl, refl_depth,rectangles,parabaloids,CAMERA)
+    if i < lattice.shape[1] and j < lattice.shape[2]:
+        render_lattice_point(i, j, camera, lattice, bounces, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, frustum_tiles, stats_arrays)
 
-                R += R_s
-                G += B_s
-                B += G_s
 
-            R = R / 9
-            G = G / 9
-            B = B / 9
+@cached
+@cuda.jit
+def resolve_lattice(lattice, result):
+    x, y = cuda.grid(2)
 
+    if x < result.shape[1] and y < result.shape[0]:
+        resolve_lattice_pixel(x, y, lattice, result)
 
-        (R, G, B) = clip_color_vector((R, G, B))
 
-        result[0, x, y] = R
-        result[1, x, y] = G
-        result[2, x, y] = B
\ No newline at end of file
+@cached
+@cuda.jit
+def scatter_columns(data, columns, index):
+    # data[:, index[i]] = columns[:, i], uploads single primitives of a scene array
+    i = cuda.grid(1)
+
+    if i < index.shape[0]:
+        for r in range(data.shape[0]):
+            data[r, index[i]] = columns[r, i]
@@ -0,0 +1,84 @@
+import numpy as np
+
+# rows of the per ray grid point counters, filled by the kernels in statistics
+# mode. A grid point is a pixel, a pixel of the adaptive base buffers (with
+# their one pixel border) or a lattice point, as the pass traces them
+STAT_PRIMARY_RAYS = 0
+STAT_AA_RAYS = 1
+STAT_REFLECTION_RAYS = 2
+STAT_SHADOW_RAYS = 3
+STAT_TESTS = 4          # + object type: sphere, plane, rectangle, paraboloid,
+                        # instance (rays moved into it), triangle
+STAT_BOX_TESTS = 10
+STAT_DEPTH = 11         # the deepest bounce of the rays of the grid point
+STAT_ROWS = 12
+
+RAY_NAMES = ('primary', 'antialiasing', 'reflection', 'shadow')
+TEST_NAMES = ('sphere', 'plane', 'rectangle', 'paraboloid', 'instance', 'triangle', 'box')
+OBJECT_NAMES = ('spheres', 'planes', 'rectangles', 'paraboloids', 'instances')
+
+
+def get_stats_grid(w, h, aliasing, aa_mode):
+    # size of the grid the render passes of a (w, h) tile trace
+    if aliasing and aa_mode == 'adaptive':
+        return w + 2, h + 2
+    if aliasing and aa_mode == 'lattice':
+        return 2 * w + 1, 2 * h + 1
+    return w, h
+
+
+def allocate_stats(w, h, aliasing, aa_mode, object_counts):
+    '''
+    Buffers of the statistics mode for a (w, h) tile: uint32 counters
+    (STAT_ROWS, grid w, grid h), one column per grid point, and hits
+    (objects, grid w) - hits of every object (spheres, planes, rectangles,
+    paraboloids, instances in this order, object_counts of each) per grid
+    column.
+    The kernels take them as the stats tuple, () renders without statistics.
+    '''
+    grid_w, grid_h = get_stats_grid(w, h, aliasing, aa_mode)
+    counters = np.zeros((STAT_ROWS, grid_w, grid_h), dtype=np.uint32)
+    hits = np.zeros((sum(object_counts), grid_w), dtype=np.uint32)
+    return counters, hits
+
+
+def get_cost_map(counters, w, h, aliasing, aa_mode):
+    # intersection tests (primitives and BVH boxes) spent on every pixel,
+    # (h, w) like the image; a lattice point counts for the pixel it starts
+    cost = counters[STAT_TESTS:STAT_BOX_TESTS + 1].sum(axis=0, dtype=np.int64)
+
+    if aliasing and aa_mode == 'adaptive':
+        cost = cost[1:-1, 1:-1]
+    elif aliasing and aa_mode == 'lattice':
+        x = np.clip((np.arange(2 * w + 1) - 1) // 2, 0, w - 1)
+        y = np.clip((np.arange(2 * h + 1) - 1) // 2, 0, h - 1)
+        pixels = np.zeros((w, h), dtype=np.int64)
+        np.add.at(pixels, (x[:, None], y[None, :]), cost)
+        cost = pixels
+
+    return cost.T
+
+
+def reduce_stats(counters, hits, object_counts, refl_depth):
+    # sums the per grid point counters of one render into totals
+    totals = counters.sum(axis=(1, 2), dtype=np.int64)
+    object_hits = np.split(hits.sum(axis=1, dtype=np.int64), np.cumsum(object_counts)[:-1])
+
+    return {
+        'rays': dict(zip(RAY_NAMES, totals[STAT_PRIMARY_RAYS:STAT_SHADOW_RAYS + 1].tolist())),
+        'tests': dict(zip(TEST_NAMES, totals[STAT_TESTS:STAT_BOX_TESTS + 1].tolist())),
+        'hits': dict(zip(OBJECT_NAMES, object_hits)),
+        'depth': np.bincount(counters[STAT_DEPTH].ravel(), minlength=refl_depth + 1),
+    }
+
+
+def merge_stats(a, b):
+    # totals of two tiles of the same scene
+    if a is None:
+        return b
+    return {
+        'rays': {k: a['rays'][k] + b['rays'][k] for k in RAY_NAMES},
+        'tests': {k: a['tests'][k] + b['tests'][k] for k in TEST_NAMES},
+        'hits': {k: a['hits'][k] + b['hits'][k] for k in OBJECT_NAMES},
+        'depth': a['depth'] + b['depth'],
+    }
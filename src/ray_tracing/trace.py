@@ -1,64 +1,398 @@
-from numba import cuda
 from .intersections import *
 from .common import *
+from .culling import CULL_TILE
+from .stats import STAT_PRIMARY_RAYS, STAT_AA_RAYS, STAT_REFLECTION_RAYS, STAT_SHADOW_RAYS, STAT_TESTS, STAT_BOX_TESTS, STAT_DEPTH
 import math
-
-@cuda.jit(device=True)
-def get_intersection(ray_origin: tuple, ray_dir: tuple, spheres, planes,rectangles,parabaloids) -> (float, int, int):
-    intersect_dist = 999.0
+import numpy as np
+
+@device_jit
+def closer_hit(dist, obj_index, obj_type, intersect_dist, best_index, best_type) -> bool:
+    # ties go to the lower (type, index), as in a loop over the scene arrays
+    if dist <= 0 or dist > intersect_dist:
+        return False
+    if dist < intersect_dist:
+        return True
+    if best_type == 404:
+        return False
+    return obj_type < best_type or (obj_type == best_type and obj_index < best_index)
+
+
+@device_jit
+def intersect_primitive(ray_origin: tuple, ray_dir: tuple, obj_type: int, i: int, primitives) -> float:
+    # column i of a packed primitive table (pack_primitives), type 5 - a mesh triangle
+    if obj_type == 0:
+        return intersect_ray_sphere(ray_origin, ray_dir, primitives[0:3, i], primitives[3, i])
+
+    if obj_type == 2:
+        return intersect_ray_rectangle(ray_origin, ray_dir, primitives[0:3, i], primitives[3:6, i], primitives[6:9, i],
+                                       primitives[9:12, i], primitives[12:15, i], primitives[15, i])
+
+    if obj_type == 5:
+        return intersect_ray_triangle(ray_origin, ray_dir, to_tuple3(primitives[0:3, i]), to_tuple3(primitives[3:6, i]),
+                                      to_tuple3(primitives[6:9, i]))
+
+    return intersect_ray_parabaloid(ray_origin, ray_dir, primitives[0:3, i], primitives[3, i], primitives[4, i], primitives[5, i],
+                                    primitives[6, i])
+
+
+@device_jit
+def to_object(P, idx, instances) -> tuple:
+    # world point in the object space of instance idx
+    M0 = (instances[11, idx], instances[12, idx], instances[13, idx])
+    M1 = (instances[14, idx], instances[15, idx], instances[16, idx])
+    M2 = (instances[17, idx], instances[18, idx], instances[19, idx])
+    d = vector_difference((instances[1, idx], instances[2, idx], instances[3, idx]), P)
+    s = instances[7, idx]
+    return (dot(M0, d) / s, dot(M1, d) / s, dot(M2, d) / s)
+
+
+@device_jit
+def to_world(P, idx, instances) -> tuple:
+    # object space point of instance idx in the world
+    D = to_world_dir(P, idx, instances)
+    s = instances[7, idx]
+    return (instances[1, idx] + s * D[0], instances[2, idx] + s * D[1], instances[3, idx] + s * D[2])
+
+
+@device_jit
+def to_object_dir(D, idx, instances) -> tuple:
+    # only rotated: object space distances are the world ones / scale
+    M0 = (instances[11, idx], instances[12, idx], instances[13, idx])
+    M1 = (instances[14, idx], instances[15, idx], instances[16, idx])
+    M2 = (instances[17, idx], instances[18, idx], instances[19, idx])
+    return (dot(M0, D), dot(M1, D), dot(M2, D))
+
+
+@device_jit
+def to_world_dir(D, idx, instances) -> tuple:
+    # R = (R^T)^T, the columns of the stored rows
+    M0 = (instances[11, idx], instances[14, idx], instances[17, idx])
+    M1 = (instances[12, idx], instances[15, idx], instances[18, idx])
+    M2 = (instances[13, idx], instances[16, idx], instances[19, idx])
+    return (dot(M0, D), dot(M1, D), dot(M2, D))
+
+
+@device_jit
+def intersect_instance(ray_origin: tuple, ray_dir: tuple, idx: int, t_max: float, instancing, stats) -> (float, int, int):
+    # nearest hit closer than t_max in the BVH of the prototype of instance
+    # idx: world distance, index and type of the prototype primitive
+    instances, prototypes, _, _, _, bounds, nodes, prims, _, _, _, primitives = instancing
+    s = instances[7, idx]
+    origin = to_object(ray_origin, idx, instances)
+    direction = to_object_dir(ray_dir, idx, instances)
+    inv_dir = get_inverse_dir(direction)
+
+    intersect_dist = t_max / s
     obj_index = -999
     obj_type = 404
+    prototype = int(instances[0, idx])
+    node = prototypes[0, prototype]
+    while node < prototypes[1, prototype]:
+        count_stat(stats, STAT_BOX_TESTS, 1)
+        if not intersect_ray_box(origin, inv_dir, bounds, node, intersect_dist):
+            node = nodes[2, node]
+            continue
 
-    for idx in range(spheres.shape[1]):
-        dist = intersect_ray_sphere(ray_origin, ray_dir, spheres[0:3, idx], spheres[3, idx])
+        first = nodes[0, node]
+        for i in range(first, first + nodes[1, node]):
+            p_type = prims[0, i]
+            p_idx = prims[1, i]
+            count_stat(stats, STAT_TESTS + p_type, 1)
+            dist = intersect_primitive(origin, direction, p_type, i, primitives)
 
-        if intersect_dist > dist > 0:
-            intersect_dist = dist
-            obj_index = idx
-            obj_type = 0
+            if closer_hit(dist, p_idx, p_type, intersect_dist, obj_index, obj_type):
+                intersect_dist = dist
+                obj_index = p_idx
+                obj_type = p_type
+
+        node += 1
+
+    if obj_type == 404:
+        return -999.0, obj_index, obj_type
+    return intersect_dist * s, obj_index, obj_type
+
+
+@device_jit
+def instance_occludes(ray_origin: tuple, ray_dir: tuple, t_max: float, idx: int, instancing, lights, light_index: int,
+                      inside_parabaloid: bool, stats) -> bool:
+    # occluded() inside instance idx
+    instances, prototypes, _, _, parabaloids, bounds, nodes, prims, _, _, _, primitives = instancing
+    s = instances[7, idx]
+    origin = to_object(ray_origin, idx, instances)
+    direction = to_object_dir(ray_dir, idx, instances)
+    inv_dir = get_inverse_dir(direction)
+    t_obj = t_max / s
+
+    prototype = int(instances[0, idx])
+    node = prototypes[0, prototype]
+    while node < prototypes[1, prototype]:
+        count_stat(stats, STAT_BOX_TESTS, 1)
+        if not intersect_ray_box(origin, inv_dir, bounds, node, t_obj):
+            node = nodes[2, node]
+            continue
 
+        first = nodes[0, node]
+        for i in range(first, first + nodes[1, node]):
+            p_type = prims[0, i]
+            p_idx = prims[1, i]
+            count_stat(stats, STAT_TESTS + p_type, 1)
+            dist = intersect_primitive(origin, direction, p_type, i, primitives)
+
+            if t_obj > dist > 0 and is_instance_occluder(p_type, p_idx, idx, instances, parabaloids, lights, light_index,
+                                                         inside_parabaloid):
+                return True
+
+        node += 1
+
+    return False
+
+
+@device_jit
+def get_instance_surface(P, idx: int, prim_index: int, prim_type: int, instancing) -> (tuple, tuple):
+    # colour and world normal at P on primitive prim_index of the prototype
+    # of instance idx
+    instances, _, spheres, rectangles, parabaloids, _, _, _, vertices, triangles, mesh_colors, _ = instancing
+    P_obj = to_object(P, idx, instances)
+
+    if prim_type == 0:
+        RGB_obj = get_sphere_color(prim_index, spheres)
+        N = get_sphere_normal(P_obj, prim_index, spheres)
+    elif prim_type == 2:
+        RGB_obj = get_rectangle_color(prim_index, rectangles)
+        N = get_rect_normal(prim_index, rectangles)
+    elif prim_type == 5:
+        RGB_obj = get_triangle_color(prim_index, triangles, mesh_colors)
+        N = get_triangle_normal(prim_index, triangles, vertices)
+    else:
+        RGB_obj = get_parabaloid_color(prim_index, parabaloids)
+        N = get_parabaloid_normal(P_obj, prim_index, parabaloids)
+
+    if instances[8, idx] >= 0:
+        RGB_obj = (instances[8, idx], instances[9, idx], instances[10, idx])
+    return RGB_obj, to_world_dir(N, idx, instances)
+
+
+@device_jit
+def get_intersection(ray_origin: tuple, ray_dir: tuple, scene, bvh_bounds, bvh_nodes, first_node, end_node, stats) -> (float, int, int, int, int):
+    # (distance, index, type) of the nearest hit; for an instance (type 4)
+    # also the index and type of the primitive of its prototype
+    _, _, planes, _, _, _, _, bvh_prims, primitives, instancing, _ = scene
+    intersect_dist = 999.0
+    obj_index = -999
+    obj_type = 404
+    prim_index = -999
+    prim_type = 404
+
+    count_stat(stats, STAT_TESTS + 1, planes.shape[1])
     for idx in range(planes.shape[1]):
-        dist = intersect_ray_plane(ray_origin, ray_dir, planes[0:3, idx], planes[3:6, idx])
+        dist = intersect_ray_plane(ray_origin, ray_dir, planes[3:6, idx], planes[9, idx])
 
         if intersect_dist > dist > 0:
             intersect_dist = dist
             obj_index = idx
             obj_type = 1
 
-    for idx in range(rectangles.shape[1]):
-        norm = get_rect_normal(idx,rectangles)
+    # spheres, rectangles and parabaloids are found through the BVH, nodes
+    # first_node..end_node of it (a frustum culled BVH holds several trees)
+    inv_dir = get_inverse_dir(ray_dir)
+    node = first_node
+    while node < end_node:
+        count_stat(stats, STAT_BOX_TESTS, 1)
+        if not intersect_ray_box(ray_origin, inv_dir, bvh_bounds, node, intersect_dist):
+            node = bvh_nodes[2, node]
+            continue
 
-        dist = intersect_ray_rectangle(ray_origin, ray_dir, rectangles[0:3,idx],rectangles[3:6,idx],rectangles[6:9,idx],norm)
+        first = bvh_nodes[0, node]
+        for i in range(first, first + bvh_nodes[1, node]):
+            p_type = bvh_prims[0, i]
+            p_idx = bvh_prims[1, i]
+            count_stat(stats, STAT_TESTS + p_type, 1)
+            if p_type == 4:
+                dist, sub_index, sub_type = intersect_instance(ray_origin, ray_dir, p_idx, intersect_dist, instancing, stats)
+            else:
+                dist = intersect_primitive(ray_origin, ray_dir, p_type, i, primitives)
+                sub_index = -999
+                sub_type = 404
+
+            if closer_hit(dist, p_idx, p_type, intersect_dist, obj_index, obj_type):
+                intersect_dist = dist
+                obj_index = p_idx
+                obj_type = p_type
+                prim_index = sub_index
+                prim_type = sub_type
 
-        if intersect_dist > dist > 0:
-            intersect_dist = dist
-            obj_index = idx
-            obj_type = 2
-            
-    for idx in range(parabaloids.shape[1]):
-            dist = intersect_ray_parabaloid(ray_origin,ray_dir,parabaloids[0:3,idx],parabaloids[3,idx],parabaloids[4,idx],parabaloids[8,idx],parabaloids[9,idx])
+        node += 1
 
-            if intersect_dist > dist > 0:
-                intersect_dist = dist
-                obj_index = idx
-                obj_type = 3
+    return intersect_dist, obj_index, obj_type, prim_index, prim_type
 
-    return intersect_dist, obj_index, obj_type
 
+@device_jit
+def is_occluder(obj_type: int, obj_index: int, parabaloids, lights, light_index: int, inside_parabaloid: bool) -> bool:
+    # the inner side of a parabaloid is lit by a light inside it
+    if obj_type == 3 and inside_parabaloid:
+        p_orig = parabaloids[0:3,obj_index]
+        a = parabaloids[3,obj_index]
+        b = parabaloids[4,obj_index]
+        p_orient = parabaloids[8,obj_index]
+        l_orig = lights[0:3,light_index]
 
-@cuda.jit(func_or_sig=None, device=True)
-def trace(ray_origin: tuple, ray_dir: tuple, spheres, lights, planes, ambient_int: float, lambert_int: float,rectangles,parabaloids,CAMERA, prev_rgb,prev_type) -> (tuple, tuple, tuple,int):
+        return not is_ligth_inside_parabaloid(p_orig,l_orig,a,b,p_orient)
+    return True
 
 
+@device_jit
+def is_instance_occluder(obj_type: int, obj_index: int, idx: int, instances, parabaloids, lights, light_index: int,
+                         inside_parabaloid: bool) -> bool:
+    # is_occluder of the copy of the prototype primitive in the world
+    if obj_type == 3 and inside_parabaloid:
+        s = instances[7, idx]
+        p_orig = to_world(parabaloids[0:3, obj_index], idx, instances)
+        l_orig = lights[0:3, light_index]
+
+        return not is_ligth_inside_parabaloid(p_orig, l_orig, s * parabaloids[3, obj_index], s * parabaloids[4, obj_index],
+                                              parabaloids[8, obj_index])
+    return True
+
+
+@device_jit
+def occluded(ray_origin: tuple, ray_dir: tuple, t_max: float, scene, light_index: int, inside_parabaloid: bool, stats) -> bool:
+    # any hit closer than t_max blocks the light, the nearest one is not needed
+    _, lights, planes, _, parabaloids, bvh_bounds, bvh_nodes, bvh_prims, primitives, instancing, _ = scene
+
+    for idx in range(planes.shape[1]):
+        count_stat(stats, STAT_TESTS + 1, 1)
+        dist = intersect_ray_plane(ray_origin, ray_dir, planes[3:6, idx], planes[9, idx])
+
+        if t_max > dist > 0:
+            return True
+
+    inv_dir = get_inverse_dir(ray_dir)
+    node = 0
+    while node < bvh_nodes.shape[1]:
+        count_stat(stats, STAT_BOX_TESTS, 1)
+        if not intersect_ray_box(ray_origin, inv_dir, bvh_bounds, node, t_max):
+            node = bvh_nodes[2, node]
+            continue
+
+        first = bvh_nodes[0, node]
+        for i in range(first, first + bvh_nodes[1, node]):
+            p_type = bvh_prims[0, i]
+            p_idx = bvh_prims[1, i]
+            count_stat(stats, STAT_TESTS + p_type, 1)
+            if p_type == 4:
+                if instance_occludes(ray_origin, ray_dir, t_max, p_idx, instancing, lights, light_index, inside_parabaloid, stats):
+                    return True
+                continue
+
+            dist = intersect_primitive(ray_origin, ray_dir, p_type, i, primitives)
+
+            if t_max > dist > 0 and is_occluder(p_type, p_idx, parabaloids, lights, light_index, inside_parabaloid):
+                return True
+
+        node += 1
+
+    return False
+
+
+@device_jit
+def get_light_intensity(P, N, L, light_dist, lights, light_index: int, lambert_int: float, CAMERA) -> float:
+    # diffuse and specular intensity of the light at P without shadows
+    V = get_vector_to_camera(P,CAMERA)
+    H = normalize(linear_comb(L,V,1,1))
+
+    I_d = lambert_int * max(0, dot(L, N))
+
+    spec_coeff = 0.6
+    spec_power = 30
+
+    I_s = spec_coeff *  (max(0,dot(H,N))**spec_power)
+
+    return (I_d + I_s) * get_light_falloff(light_dist, lights[3, light_index])
+
+
+@device_jit
+def shade_light(RGB, RGB_obj, P, N, light_index: int, mode: int, step: float, offset: float, before: float, lambert_int: float, CAMERA,
+                scene, flag, stats) -> (tuple, float):
+    # mode 0 adds the light if it is not occluded, 1 only returns its
+    # intensity, 2 adds step for every sample point (offset + j) * step in
+    # before..before + intensity. No shadow ray for a light that adds nothing
+    lights = scene[1]
+    L = get_vector_to_light(P, lights, light_index)
+    light_dist = get_distance_to_light(P, lights, light_index)
+    intensity = get_light_intensity(P, N, L, light_dist, lights, light_index, lambert_int, CAMERA)
+    if intensity <= 0 or mode == 1:
+        return RGB, intensity
+
+    weight = intensity
+    if mode == 2:
+        weight = step * (math.ceil((before + intensity) / step - offset) - math.ceil(before / step - offset))
+        if weight <= 0:
+            return RGB, intensity
+
+    count_stat(stats, STAT_SHADOW_RAYS, 1)
+    if occluded(P, L, light_dist, scene, light_index, flag, stats):
+        return RGB, intensity
+    return linear_comb(RGB, RGB_obj, 1.0, weight), intensity
+
+
+@device_jit
+def shade_lights(RGB, RGB_obj, P, N, mode: int, step: float, offset: float, lambert_int: float, CAMERA, scene, flag, stats) -> (tuple, float, int):
+    # shade_light for every light that reaches P: the ones without a radius
+    # in order, then those of the light BVH whose boxes hold P. Returns the
+    # colour, the sum and the number of the intensities > 0. Mode 2 stops
+    # after the last sample point
+    light_samples, unbounded, light_bounds, light_nodes, light_prims = scene[10]
+    last = (offset + light_samples - 1) * step if mode == 2 else math.inf
+    total = 0.0
+    count = 0
+
+    for i in range(unbounded.shape[1]):
+        if total > last:
+            return RGB, total, count
+        RGB, intensity = shade_light(RGB, RGB_obj, P, N, unbounded[0, i], mode, step, offset, total, lambert_int, CAMERA,
+                                     scene, flag, stats)
+        if intensity > 0:
+            total += intensity
+            count += 1
+
+    node = 0
+    while node < light_nodes.shape[1]:
+        if not point_in_box(P, light_bounds, node):
+            node = light_nodes[2, node]
+            continue
+
+        first = light_nodes[0, node]
+        for i in range(first, first + light_nodes[1, node]):
+            if total > last:
+                return RGB, total, count
+            RGB, intensity = shade_light(RGB, RGB_obj, P, N, light_prims[1, i], mode, step, offset, total, lambert_int, CAMERA,
+                                         scene, flag, stats)
+            if intensity > 0:
+                total += intensity
+                count += 1
+
+        node += 1
+
+    return RGB, total, count
+
+
+@device_jit
+def trace(ray_origin: tuple, ray_dir: tuple, scene, ambient_int: float, lambert_int: float, CAMERA,
+          hit_bounds, hit_nodes, first_node, end_node, prev_rgb,prev_type, stats) -> (tuple, tuple, tuple,int,tuple):
+    # the hit is searched in nodes first_node..end_node of hit_bounds, hit_nodes,
+    # the shadow rays go through the whole BVH
+    spheres, _, planes, rectangles, parabaloids, _, _, _, _, instancing, lighting = scene
+
     RGB = (0.0, 0.0, 0.0)
 
-    intersect_dist, obj_index, obj_type = get_intersection(ray_origin, ray_dir, spheres, planes,rectangles,parabaloids)
+    intersect_dist, obj_index, obj_type, prim_index, prim_type = get_intersection(ray_origin, ray_dir, scene, hit_bounds, hit_nodes, first_node, end_node, stats)
 
     if obj_type == 404:
         if prev_type == 3:
-            return prev_rgb, (404., 404., 404.), (404, 404., 404.),0
-        return RGB, (404., 404., 404.), (404, 404., 404.),0
+            return prev_rgb, (404., 404., 404.), (404, 404., 404.),0, (intersect_dist, obj_index, obj_type)
+        return RGB, (404., 404., 404.), (404, 404., 404.),0, (intersect_dist, obj_index, obj_type)
 
+    count_hit(stats, obj_type, obj_index, spheres, planes, rectangles, parabaloids)
     P = linear_comb(ray_origin, ray_dir, 1.0, intersect_dist)
 
     if obj_type == 0:         
@@ -83,10 +417,16 @@ def trace(ray_origin: tuple, ray_dir: tuple, spheres, lights, planes, ambient_in
         N = get_parabaloid_normal(P,obj_index,parabaloids)
         prev_type = 3
 
+    elif obj_type == 4:
+
+        RGB_obj, N = get_instance_surface(P, obj_index, prim_index, prim_type, instancing)
+        if prim_type == 3:
+            prev_type = 3
+
     flag = False
     if dot(N,ray_dir) > 0:
         N = (-N[0],-N[1], -N[2])
-        if obj_type == 3:
+        if obj_type == 3 or prim_type == 3:
             flag = True
     
 
@@ -96,64 +436,281 @@ def trace(ray_origin: tuple, ray_dir: tuple, spheres, lights, planes, ambient_in
     BIAS = 0.002
     P = linear_comb(P, N, 1.0, BIAS)
 
-    for light_index in range(lights.shape[1]):
-
-        L = get_vector_to_light(P, lights, light_index)
-        V = get_vector_to_camera(P,CAMERA)
-        H = normalize(linear_comb(L,V,1,1))
-        V = normalize((-V[0],-V[1],-V[2]))
-        R = normalize(get_reflection(L,N))
-        
-        _, obj_index, obj_type = get_intersection(P, L, spheres, planes,rectangles,parabaloids)
-        
-        inside = False
-        if obj_type == 3:
-            p_orig = parabaloids[0:3,obj_index]
-            a = parabaloids[3,obj_index]
-            b = parabaloids[4,obj_index]
-            p_orient = parabaloids[8,obj_index]
-            l_orig = lights[0:3,light_index]
-            
-            normal_flag = parabaloids[10,obj_index]    
-            
-            inside = is_ligth_inside_parabaloid(p_orig,l_orig,a,b,p_orient) and flag
-            
-        if obj_type != 404 and not inside:
-                continue
-        
-        I_d = lambert_int * max(0, dot(L, N))
-           
-        spec_coeff = 0.6
-        spec_power = 30
-
-        I_s = spec_coeff *  (max(0,dot(H,N))**spec_power)
-
-        intensity =  I_d + I_s
-
-        if intensity >= 0:
-            RGB = linear_comb(RGB, RGB_obj, 1.0, intensity)
-
+    # light_samples > 0: with more lights than that reaching P, shadow rays
+    # go only to light_samples of them, picked in proportion to their
+    # intensity by systematic sampling; every sample adds the mean intensity
+    light_samples = lighting[0]
+    mode = 0
+    step = 0.0
+    offset = 0.0
+    if light_samples > 0:
+        _, total, count = shade_lights(RGB, RGB_obj, P, N, 1, step, offset, lambert_int, CAMERA, scene, flag, stats)
+        if count > light_samples:
+            mode = 2
+            step = total / light_samples
+            offset = random_from_vector(P, -1)
+
+    RGB, _, _ = shade_lights(RGB, RGB_obj, P, N, mode, step, offset, lambert_int, CAMERA, scene, flag, stats)
 
     R = get_reflection(ray_dir, N)
     
     P = linear_comb(P, R, 1.0, BIAS)
     
-    return RGB, P, R,prev_type
+    return RGB, P, R,prev_type, (intersect_dist, obj_index, obj_type)
 
 
-@cuda.jit(device=True)
-def sample(ray_origin: tuple, ray_dir: tuple, spheres, lights, planes, ambient_int, lambert_int,
-           reflection_int, refl_depth,rectangles,parabaloids,CAMERA) -> (tuple, tuple, tuple):
+@device_jit
+def sample_hit(ray_origin: tuple, ray_dir: tuple, scene, ambient_int, lambert_int, reflection_int, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, first_node, end_node, stats) -> (tuple, tuple, int):
+    # colour of the ray, (distance, index, type) of its first hit and the
+    # number of reflections traced. The bounce loop stops when the ray escapes
+    # or the reflection weight drops below refl_cutoff; from bounce rr_depth on
+    # (if rr_depth > 0) rays are also terminated by russian roulette.
+    # The first hit of a camera ray is searched in the BVH culled to the
+    # frustum of its block (nodes first_node..end_node of frustum_bounds,
+    # frustum_nodes), the reflections in the whole BVH.
+    bvh_bounds, bvh_nodes = scene[5], scene[6]
 
     prev_type = 0
-    RGB, POINT, REFLECTION_DIR,prev_type = trace(ray_origin, ray_dir, spheres, lights, planes, ambient_int, lambert_int,rectangles,parabaloids,CAMERA,(0,0,0),0)
+    RGB, POINT, REFLECTION_DIR,prev_type, hit = trace(ray_origin, ray_dir, scene, ambient_int, lambert_int, CAMERA, frustum_bounds, frustum_nodes, first_node, end_node,(0,0,0),0, stats)
     prev_rgb = RGB
+    rr_scale = 1.0
+    depth = 0
     for i in range(refl_depth):
         if (POINT[0] == 404.) or (REFLECTION_DIR[0] == 404.):
-            continue
+            break
+
+        weight = reflection_int**(i+1)
+        if weight < refl_cutoff:
+            break
+
+        if rr_depth > 0 and i >= rr_depth:
+            if random_from_vector(POINT, i) >= reflection_int:
+                break
+            rr_scale = rr_scale / reflection_int
 
-        RGB_refl, POINT, REFLECTION_DIR,prev_type = trace(POINT, REFLECTION_DIR, spheres, lights, planes, ambient_int, lambert_int,rectangles,parabaloids,CAMERA,prev_rgb,prev_type)
+        count_stat(stats, STAT_REFLECTION_RAYS, 1)
+        RGB_refl, POINT, REFLECTION_DIR,prev_type, _ = trace(POINT, REFLECTION_DIR, scene, ambient_int, lambert_int, CAMERA, bvh_bounds, bvh_nodes, 0, bvh_nodes.shape[1],prev_rgb,prev_type, stats)
        
-        RGB = linear_comb(RGB, RGB_refl, 1.0, reflection_int**(i+1))
+        RGB = linear_comb(RGB, RGB_refl, 1.0, weight * rr_scale)
+        depth = i + 1
         
-    return RGB
\ No newline at end of file
+    max_stat(stats, STAT_DEPTH, depth)
+    return RGB, hit, depth
+
+
+@device_jit
+def sample(ray_origin: tuple, ray_dir: tuple, scene, ambient_int, lambert_int, reflection_int, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, first_node, end_node, stats) -> tuple:
+
+    RGB, _, _ = sample_hit(ray_origin, ray_dir, scene, ambient_int, lambert_int, reflection_int, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, first_node, end_node, stats)
+    return RGB
+
+
+@device_jit
+def get_pixel_location(x, y, camera) -> tuple:
+    # (x, y) is relative to the tile at camera[17:19]; same values as
+    # Camera.generate_pixel_locations()[:, x0 + x, y0 + y], also outside the image
+    return (camera[12], (x + camera[17]) * camera[14] + camera[13], (y + camera[18]) * camera[16] + camera[15])
+
+
+@device_jit
+def get_camera_ray(P, camera) -> tuple:
+    R0 = (camera[3], camera[4], camera[5])
+    R1 = (camera[6], camera[7], camera[8])
+    R2 = (camera[9], camera[10], camera[11])
+
+    ray_dir = matmul((R0, R1, R2), P)
+    return normalize(ray_dir)
+
+
+@device_jit
+def get_primary_ray(x, y, camera) -> tuple:
+    return get_camera_ray(get_pixel_location(x, y, camera), camera)
+
+
+@device_jit
+def get_subpixel_ray(x, y, i, camera) -> tuple:
+    # i-th of the 8 points halfway to the neighbouring pixels, diagonals first
+    dx = (-1, 1, -1, 1, -1, 1, 0, 0)[i]
+    dy = (1, 1, -1, -1, 0, 0, 1, -1)[i]
+
+    P = linear_comb(get_pixel_location(x, y, camera), get_pixel_location(x + dx, y + dy, camera), 0.5, 0.5)
+    return get_camera_ray(P, camera)
+
+
+@device_jit
+def can_supersample(x, y, camera) -> bool:
+    # the pixel is not on the border of the whole image
+    X = x + camera[17]
+    Y = y + camera[18]
+    return X+1 < camera[19] and X-1 >= 0 and Y+1 < camera[20] and Y-1 >= 0
+
+
+@device_jit
+def supersample(x, y, count, RGB, camera, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, first_node, end_node, stats) -> tuple:
+    # average of the pixel colour RGB and count sub-pixel samples
+    ray_origin = camera[0], camera[1], camera[2]
+    (R, G, B) = RGB
+
+    for i in range(count):
+        count_stat(stats, STAT_AA_RAYS, 1)
+        ray_dir = get_subpixel_ray(x, y, i, camera)
+        (R_s, G_s, B_s) = sample(ray_origin, ray_dir, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, first_node, end_node, stats)
+
+        R += R_s
+        G += G_s
+        B += B_s
+
+    return (R / (count + 1), G / (count + 1), B / (count + 1))
+
+
+@device_jit
+def get_frustum_nodes(x, y, frustum_tiles) -> (int, int):
+    # nodes of the culled BVH of the block of tile pixel (x, y); the pixels
+    # of the one pixel border and the lattice ring go to the nearest block
+    # signed: the prange index of the CPU kernels is unsigned
+    bx = min(max(np.int64(x), 0) // CULL_TILE, frustum_tiles.shape[1] - 1)
+    by = min(max(np.int64(y), 0) // CULL_TILE, frustum_tiles.shape[2] - 1)
+    first_node = frustum_tiles[0, bx, by]
+    return first_node, first_node + frustum_tiles[1, bx, by]
+
+
+@device_jit
+def write_pixel(x, y, RGB, result):
+    # result is the (h, w, 3) uint8 image, rows top to bottom like the saved file
+    (R, G, B) = clip_color_vector(RGB)
+
+    result[y, x, 0] = R
+    result[y, x, 1] = G
+    result[y, x, 2] = B
+
+
+@device_jit
+def render_pixel(x, y, camera, result, bounces, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, aliasing, CAMERA, frustum_bounds, frustum_nodes, frustum_tiles, stats_arrays):
+    stats = get_stats(stats_arrays, x, y)
+    count_stat(stats, STAT_PRIMARY_RAYS, 1)
+    first_node, end_node = get_frustum_nodes(x, y, frustum_tiles)
+    ray_origin = camera[0], camera[1], camera[2]
+    ray_dir = get_primary_ray(x, y, camera)
+
+    RGB, _, depth = sample_hit(ray_origin, ray_dir, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, first_node, end_node, stats)
+    bounces[x, y] = depth
+
+    if aliasing and can_supersample(x, y, camera):
+        RGB = supersample(x, y, 8, RGB, camera, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, first_node, end_node, stats)
+
+    write_pixel(x, y, RGB, result)
+
+
+@device_jit
+def render_pixel_base(x, y, camera, base, depth, hit_ids, bounces, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, frustum_tiles, stats_arrays):
+    # first pass of adaptive antialiasing: one sample, its colour and first hit.
+    # The buffers have a one pixel border around the tile, (x, y) = (1, 1) is
+    # its first pixel
+    stats = get_stats(stats_arrays, x, y)
+    count_stat(stats, STAT_PRIMARY_RAYS, 1)
+    first_node, end_node = get_frustum_nodes(x - 1, y - 1, frustum_tiles)
+    ray_origin = camera[0], camera[1], camera[2]
+    ray_dir = get_primary_ray(x - 1, y - 1, camera)
+
+    RGB, hit, refl_count = sample_hit(ray_origin, ray_dir, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, first_node, end_node, stats)
+    (R, G, B) = RGB
+    (dist, obj_index, obj_type) = hit
+    if 0 < x < base.shape[1] - 1 and 0 < y < base.shape[2] - 1:
+        bounces[x - 1, y - 1] = refl_count
+
+    base[0, x, y] = R
+    base[1, x, y] = G
+    base[2, x, y] = B
+    depth[x, y] = dist
+    hit_ids[0, x, y] = obj_type
+    hit_ids[1, x, y] = obj_index
+
+
+@device_jit
+def is_edge(x, y, nx, ny, base, depth, hit_ids, contrast, depth_ratio) -> bool:
+    if hit_ids[0, x, y] != hit_ids[0, nx, ny] or hit_ids[1, x, y] != hit_ids[1, nx, ny]:
+        return True
+
+    for c in range(3):
+        if abs(clip_color(base[c, x, y]) - clip_color(base[c, nx, ny])) > contrast:
+            return True
+
+    d = depth[x, y]
+    d_n = depth[nx, ny]
+    return abs(d - d_n) > depth_ratio * min(d, d_n)
+
+
+@device_jit
+def render_pixel_adaptive(x, y, camera, base, depth, hit_ids, result, samples, aa_samples, aa_contrast, aa_depth, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, frustum_tiles, stats_arrays):
+    # second pass: supersample only pixels that differ from a neighbour in
+    # hit object, colour or depth. (bx, by) is the pixel in the base buffers
+    bx = x + 1
+    by = y + 1
+    stats = get_stats(stats_arrays, bx, by)
+    RGB = (base[0, bx, by], base[1, bx, by], base[2, bx, by])
+    count = 0
+
+    if can_supersample(x, y, camera):
+        if (is_edge(bx, by, bx-1, by, base, depth, hit_ids, aa_contrast, aa_depth) or
+                is_edge(bx, by, bx+1, by, base, depth, hit_ids, aa_contrast, aa_depth) or
+                is_edge(bx, by, bx, by-1, base, depth, hit_ids, aa_contrast, aa_depth) or
+                is_edge(bx, by, bx, by+1, base, depth, hit_ids, aa_contrast, aa_depth)):
+            count = aa_samples
+
+    if count > 0:
+        first_node, end_node = get_frustum_nodes(x, y, frustum_tiles)
+        RGB = supersample(x, y, count, RGB, camera, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, first_node, end_node, stats)
+
+    write_pixel(x, y, RGB, result)
+    samples[x, y] = count
+
+
+@device_jit
+def get_lattice_ray(i, j, camera) -> tuple:
+    # lattice point (i, j) sits at tile pixel coordinates ((i - 1) / 2, (j - 1) / 2)
+    x = (i - 1) // 2
+    y = (j - 1) // 2
+    dx = (i - 1) % 2
+    dy = (j - 1) % 2
+
+    P = get_pixel_location(x, y, camera)
+    if dx or dy:
+        P = linear_comb(P, get_pixel_location(x + dx, y + dy, camera), 0.5, 0.5)
+
+    return get_camera_ray(P, camera)
+
+
+@device_jit
+def render_lattice_point(i, j, camera, lattice, bounces, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, frustum_tiles, stats_arrays):
+    # lattice points at pixel centres are the primary rays
+    stats = get_stats(stats_arrays, i, j)
+    count_stat(stats, STAT_PRIMARY_RAYS if i % 2 == 1 and j % 2 == 1 else STAT_AA_RAYS, 1)
+    first_node, end_node = get_frustum_nodes((i - 1) // 2, (j - 1) // 2, frustum_tiles)
+    ray_origin = camera[0], camera[1], camera[2]
+    ray_dir = get_lattice_ray(i, j, camera)
+
+    RGB, _, depth = sample_hit(ray_origin, ray_dir, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA, frustum_bounds, frustum_nodes, first_node, end_node, stats)
+    (R, G, B) = RGB
+    bounces[i, j] = depth
+
+    lattice[0, i, j] = R
+    lattice[1, i, j] = G
+    lattice[2, i, j] = B
+
+
+@device_jit
+def resolve_lattice_pixel(x, y, lattice, result):
+    # pixel (x, y) is the box filter over its 3x3 lattice neighbourhood,
+    # summed in the same order as supersample
+    i = 2 * x + 1
+    j = 2 * y + 1
+
+    (R, G, B) = (lattice[0, i, j], lattice[1, i, j], lattice[2, i, j])
+    for k in range(8):
+        di = (-1, 1, -1, 1, -1, 1, 0, 0)[k]
+        dj = (1, 1, -1, -1, 0, 0, 1, -1)[k]
+        R += lattice[0, i + di, j + dj]
+        G += lattice[1, i + di, j + dj]
+        B += lattice[2, i + di, j + dj]
+
+    write_pixel(x, y, (R / 9, G / 9, B / 9), result)
@@ -1,3 +1,8 @@
-from .scene import Scene, Light, Plane, Sphere
+from .scene import Scene, Light, Plane, Sphere, Instance, Prototype
 from .rotation import euler_rotation
 from .camera import Camera
+from .bvh import build_bvh
+from .animation import look_at, camera_path, turntable
+from .buffer import SceneBuffer, get_scene_handle
+from .mesh import Mesh, load_obj, save_mesh, load_mesh
+from .scene_file import load_scene, save_scene, RENDER_SETTINGS
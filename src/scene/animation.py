@@ -0,0 +1,53 @@
+from typing import List, Tuple
+import numpy as np
+from .common import Vector3D
+from .camera import Camera
+
+
+def look_at(position: Vector3D, target: Vector3D) -> np.ndarray:
+    # euler angles (roll, pitch, yaw) in degrees of a camera at position looking
+    # at target; the camera looks along the first column of its rotation
+    d = np.asarray(target, dtype=np.float64) - np.asarray(position, dtype=np.float64)
+    yaw = np.arctan2(d[1], d[0])
+    pitch = np.arctan2(d[2], np.hypot(d[0], d[1]))
+    return np.degrees([0.0, pitch, yaw])
+
+
+def catmull_rom(p0: np.ndarray, p1: np.ndarray, p2: np.ndarray, p3: np.ndarray, t: float) -> np.ndarray:
+    return 0.5 * ((2 * p1) + (p2 - p0) * t + (2 * p0 - 5 * p1 + 4 * p2 - p3) * t ** 2 +
+                  (3 * p1 - p0 - 3 * p2 + p3) * t ** 3)
+
+
+def interpolate_keyframes(keyframes: List[np.ndarray], frame_count: int) -> List[np.ndarray]:
+    # frame_count points of the Catmull-Rom spline through the keyframes,
+    # the first and the last frame are the first and the last keyframe
+    points = [np.asarray(k, dtype=np.float64) for k in keyframes]
+    if len(points) == 1 or frame_count == 1:
+        return [points[0]] * frame_count
+
+    # the end keyframes are repeated so the curve passes through them
+    points = [points[0]] + points + [points[-1]]
+    segments = len(points) - 3
+
+    frames = []
+    for s in np.linspace(0, segments, frame_count):
+        i = min(int(s), segments - 1)
+        frames.append(catmull_rom(points[i], points[i + 1], points[i + 2], points[i + 3], s - i))
+    return frames
+
+
+def camera_path(keyframes: List[Tuple[Vector3D, Vector3D]], frame_count: int, resolution: Tuple[int, int],
+                fov: float = 45.) -> List[Camera]:
+    # keyframes are (position, euler) pairs, both interpolated by the spline
+    path = interpolate_keyframes([np.concatenate([p, e]) for p, e in keyframes], frame_count)
+    return [Camera(resolution=resolution, position=k[0:3], euler=k[3:6], fov=fov) for k in path]
+
+
+def turntable(target: Vector3D, radius: float, height: float, frame_count: int, resolution: Tuple[int, int],
+              start_angle: float = 0., fov: float = 45.) -> List[Camera]:
+    # one full circle around target at the given height above it
+    cameras = []
+    for angle in start_angle + np.linspace(0, 2 * np.pi, frame_count, endpoint=False):
+        position = np.asarray(target, dtype=np.float64) + [radius * np.cos(angle), radius * np.sin(angle), height]
+        cameras.append(Camera(resolution=resolution, position=position, euler=look_at(position, target), fov=fov))
+    return cameras
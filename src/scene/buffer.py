@@ -0,0 +1,251 @@
+import numpy as np
+from .scene import Scene, Sphere, Light, Plane, Rectangle, Paraboloid, Instance, pack, pack_prototypes
+from .bvh import (build_bvh, get_bvh_links, refit_bvh, build_prototype_bvh, get_prototype_boxes, build_light_bvh,
+                  pack_primitives)
+
+# same order as Scene.generate_scene, then the instances; ARRAYS - their
+# array numbers, 5..7 are the BVH arrays
+KINDS = ('spheres', 'lights', 'planes', 'rectangles', 'paraboloids', 'instances')
+TYPES = (Sphere, Light, Plane, Rectangle, Paraboloid, Instance)
+ARRAYS = (0, 1, 2, 3, 4, 8)
+BVH_TYPES = {'spheres': 0, 'rectangles': 2, 'paraboloids': 3, 'instances': 4}
+
+MIN_CAPACITY = 8
+GROWTH = 2
+
+
+def get_capacity(count: int) -> int:
+    # always at least one spare column: the views then have the same strided
+    # layout at every count and the kernels are not compiled again
+    return max(MIN_CAPACITY, GROWTH * count + 1)
+
+
+def get_instancing(views) -> tuple:
+    return (*views[8:19], views[24])
+
+
+def get_lighting(views) -> tuple:
+    return tuple(views[19:23])
+
+
+def get_scene_handle(views, light_samples: int = 0) -> tuple:
+    '''
+    The scene as the kernels take it, one tuple of the SceneBuffer views
+    (get_views, or their copies on the device): (spheres, lights, planes,
+    rectangles, paraboloids, BVH bounds, nodes, prims, packed primitives,
+    instancing, lighting) - instancing as get_instancing, lighting
+    (light_samples, *get_lighting()).
+    '''
+    return (*views[0:8], views[23], get_instancing(views), (light_samples, *get_lighting(views)))
+
+
+class SceneBuffer:
+    '''
+    Scene arrays and BVH with spare columns, kept between frames.
+
+    update / add / remove change single primitives and mark their columns
+    dirty; commit() then refits the BVH and returns what a renderer has to
+    upload: {array number: changed columns, or None for the whole array}.
+    Array numbers are 0..4 for the scene (Scene.generate_scene order),
+    5..7 for the BVH bounds, nodes and prims, 8 for the instances and 9..18
+    for the prototypes and their meshes (get_instancing), 19..22 for the
+    light BVH (get_lighting), 23 and 24 for the packed primitive tables of the
+    BVH and of the prototype BVH (pack_primitives). Only the first
+    get_counts() columns of every array are in use. The prototypes are
+    fixed, instances are changed like the primitives. get_scene_handle()
+    groups the arrays the way the kernels take them.
+    '''
+    def __init__(self, scene: Scene):
+        self.scene = scene
+        self.arrays = [None] * 25
+        self.counts = [0] * 25
+        for kind, k in zip(KINDS, ARRAYS):
+            self._set_array(k, self._pack(kind, getattr(scene, kind)))
+
+        self._build_prototypes()
+        self._build_bvh(scene.bvh)
+        self._build_lights()
+
+        self._dirty = {k: set() for k in ARRAYS}
+        self._resized = set()
+        self._rebuild = False
+
+    def get_arrays(self) -> tuple:
+        # all arrays with their spare columns
+        return tuple(self.arrays)
+
+    def get_counts(self) -> tuple:
+        return tuple(self.counts)
+
+    def get_views(self) -> tuple:
+        # the used columns of every array, what the kernels get
+        return tuple(a[:, :c] for a, c in zip(self.arrays, self.counts))
+
+    def get_instancing(self) -> tuple:
+        # what the kernels get for the instances, arrays 8..18 and 24:
+        # (instances, prototypes, prototype spheres, rectangles, paraboloids,
+        # prototype BVH bounds, nodes, prims, mesh vertices, triangles,
+        # colours, packed primitives); prototypes (2, P) - the node range of
+        # every prototype's BVH (build_prototype_bvh), the meshes as in
+        # pack_meshes
+        return get_instancing(self.get_views())
+
+    def get_lighting(self) -> tuple:
+        # the light BVH for the kernels, arrays 19..22: (unbounded, bounds,
+        # nodes, prims) of build_light_bvh
+        return get_lighting(self.get_views())
+
+    def get_scene_handle(self, light_samples: int = 0) -> tuple:
+        return get_scene_handle(self.get_views(), light_samples)
+
+    def update(self, kind: str, index: int, **fields):
+        # changes fields of the primitive, e.g. update('spheres', 0, origin=[0, 0, 1])
+        k = ARRAYS[KINDS.index(kind)]
+        objects = getattr(self.scene, kind)
+        obj = objects[index]
+        for name, value in fields.items():
+            setattr(obj, name, value)
+        # a PrimitiveTable item is a copy of its column
+        objects[index] = obj
+
+        self.arrays[k][:, index] = self._pack(kind, [obj])[:, 0]
+        self._dirty[k].add(index)
+
+    def add(self, kind: str, obj) -> int:
+        k = ARRAYS[KINDS.index(kind)]
+        data = self._pack(kind, [obj])
+        objects = getattr(self.scene, kind)
+        objects.append(obj)
+        index = len(objects) - 1
+
+        if index + 1 == self.arrays[k].shape[1]:
+            grown = np.zeros((self.arrays[k].shape[0], get_capacity(index + 1)), dtype=np.float32)
+            grown[:, :index] = self.arrays[k][:, :index]
+            self.arrays[k] = grown
+            self._resized.add(k)
+
+        self.arrays[k][:, index] = data[:, 0]
+        self.counts[k] = index + 1
+        self._dirty[k].add(index)
+        self._rebuild |= kind in BVH_TYPES
+        return index
+
+    def remove(self, kind: str, index: int):
+        # the last primitive takes the place of the removed one
+        k = ARRAYS[KINDS.index(kind)]
+        objects = getattr(self.scene, kind)
+        last = len(objects) - 1
+        objects[index] = objects[last]
+        objects.pop()
+
+        self.arrays[k][:, index] = self.arrays[k][:, last]
+        self.counts[k] = last
+        self._dirty[k].discard(last)
+        if index < last:
+            self._dirty[k].add(index)
+        self._rebuild |= kind in BVH_TYPES
+
+    def refresh(self):
+        # repacks every primitive from the scene objects and marks the columns
+        # that differ, for code that changes the objects directly
+        for kind, k in zip(KINDS, ARRAYS):
+            data = self._pack(kind, getattr(self.scene, kind))
+            if data.shape[1] != self.counts[k]:
+                raise ValueError(f'{kind}: use add / remove to change the number of primitives')
+
+            used = self.arrays[k][:, :self.counts[k]]
+            changed = np.flatnonzero((used != data).any(axis=0))
+            used[:, changed] = data[:, changed]
+            self._dirty[k].update(changed.tolist())
+
+    def commit(self) -> dict:
+        changes = {}
+        for k in ARRAYS:
+            if k in self._resized:
+                changes[k] = None
+            elif self._dirty[k]:
+                changes[k] = np.array(sorted(self._dirty[k]), dtype=np.int64)
+
+        if self._rebuild:
+            self._build_bvh()
+            changes.update({5: None, 6: None, 7: None, 23: None})
+        else:
+            positions = [self._prim_slots[BVH_TYPES[kind]][list(self._dirty[ARRAYS[KINDS.index(kind)]])]
+                         for kind in BVH_TYPES if self._dirty[ARRAYS[KINDS.index(kind)]]]
+            if positions:
+                spheres, _, _, rectangles, parabaloids, bounds, nodes, prims, instances = self.get_views()[:9]
+                positions = np.concatenate(positions)
+                updated = refit_bvh(bounds, nodes, prims, self._parents, self._prim_leaf,
+                                    positions, spheres, rectangles, parabaloids,
+                                    instances, self._prototype_boxes)
+                changes[5] = updated
+
+                # instances have no columns of data in the packed table
+                positions = positions[prims[0, positions] != BVH_TYPES['instances']]
+                self.arrays[23][:, positions] = pack_primitives(prims, spheres, rectangles, parabaloids, columns=positions)
+                changes[23] = np.sort(positions)
+
+        # lights are few next to the primitives, their BVH is built again; a
+        # removed last light changes only the count
+        if 1 in changes or self.counts[1] != self._light_count:
+            self._build_lights()
+            changes.update({19: None, 20: None, 21: None, 22: None})
+
+        self._dirty = {k: set() for k in ARRAYS}
+        self._resized = set()
+        self._rebuild = False
+        return changes
+
+    def _pack(self, kind, objects) -> np.ndarray:
+        data = pack(TYPES[KINDS.index(kind)], objects)
+        if kind == 'instances':
+            prototypes = data[0]
+            if ((prototypes < 0) | (prototypes >= len(self.scene.prototypes)) | (prototypes % 1 != 0)).any():
+                raise ValueError(f'instances: prototype out of range, the scene has {len(self.scene.prototypes)}')
+        return data
+
+    def _set_array(self, k, a, fixed=False):
+        # a goes to the first columns of array k, grown if it is too small;
+        # fixed arrays (the prototypes) only need the one spare column
+        if self.arrays[k] is None or self.arrays[k].shape[1] <= a.shape[1] or self.arrays[k].shape[0] != a.shape[0]:
+            capacity = a.shape[1] + 1 if fixed else get_capacity(a.shape[1])
+            self.arrays[k] = np.zeros((a.shape[0], capacity), dtype=a.dtype)
+        self.arrays[k][:, :a.shape[1]] = a
+        self.counts[k] = a.shape[1]
+
+    def _build_prototypes(self):
+        spheres, rectangles, parabaloids, vertices, triangles, colors, starts = pack_prototypes(self.scene.prototypes)
+        # a prototype of one mesh keeps the BVH of the mesh, loaded with it
+        mesh_bvhs = [p.meshes[0].get_bvh() if len(p.meshes) == 1 and not (p.spheres or p.rectangles or p.paraboloids)
+                     else None for p in self.scene.prototypes]
+        prototypes, *bvh = build_prototype_bvh(spheres, rectangles, parabaloids, starts, vertices, triangles, mesh_bvhs)
+        for k, a in enumerate((prototypes, spheres, rectangles, parabaloids, *bvh, vertices, triangles, colors), 9):
+            self._set_array(k, a, fixed=True)
+        self._set_array(24, pack_primitives(bvh[2], spheres, rectangles, parabaloids, triangles, vertices), fixed=True)
+        self._prototype_boxes = get_prototype_boxes(prototypes, bvh[0])
+
+    def _build_lights(self):
+        for k, a in enumerate(build_light_bvh(self.arrays[1][:, :self.counts[1]]), 19):
+            self._set_array(k, a)
+        self._light_count = self.counts[1]
+
+    def _build_bvh(self, bvh=None):
+        if bvh is None:
+            spheres, _, _, rectangles, parabaloids = (self.arrays[k][:, :self.counts[k]] for k in range(5))
+            instances = self.arrays[8][:, :self.counts[8]]
+            bvh = build_bvh(spheres, rectangles, parabaloids, instances, self._prototype_boxes)
+
+        for i, a in enumerate(bvh):
+            self._set_array(5 + i, a)
+
+        bounds, nodes, prims = bvh
+        self._set_array(23, pack_primitives(prims, *(self.arrays[k][:, :self.counts[k]] for k in (0, 3, 4))))
+        self._parents, self._prim_leaf = get_bvh_links(nodes, prims.shape[1])
+
+        # position in prims of every (type, index)
+        self._prim_slots = {}
+        for obj_type in BVH_TYPES.values():
+            m = prims[0] == obj_type
+            slots = np.zeros(m.sum(), dtype=np.int64)
+            slots[prims[1, m]] = np.flatnonzero(m)
+            self._prim_slots[obj_type] = slots
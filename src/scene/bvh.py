@@ -0,0 +1,378 @@
+import numpy as np
+from functools import lru_cache
+
+# Primitive types, same codes as trace.get_intersection
+SPHERE = 0
+RECTANGLE = 2
+PARABOLOID = 3
+INSTANCE = 4
+TRIANGLE = 5           # meshes, only in the BVH of a prototype
+
+LEAF_SIZE = 4
+# rows of the packed primitive table (pack_primitives) of every type
+PACKED_ROWS = {SPHERE: 4, RECTANGLE: 16, PARABOLOID: 7, INSTANCE: 0, TRIANGLE: 9}
+BOUNDS_EPS = 1e-4
+
+
+def sphere_bounds(spheres: np.ndarray) -> (np.ndarray, np.ndarray):
+    C = spheres[0:3, :]
+    r = np.abs(spheres[3, :])
+    return C - r, C + r
+
+
+def rectangle_bounds(rectangles: np.ndarray) -> (np.ndarray, np.ndarray):
+    # intersect_ray_rectangle accepts points origin - a*u - b*v, 0 < a, b < 1
+    O = rectangles[0:3, :]
+    u = rectangles[3:6, :]
+    v = rectangles[6:9, :]
+    corners = np.stack([O, O - u, O - v, O - u - v])
+    return corners.min(axis=0), corners.max(axis=0)
+
+
+def paraboloid_bounds(parabaloids: np.ndarray) -> (np.ndarray, np.ndarray):
+    # k*(x-xc)^2 + e*(y-yc)^2 = orient*(z-zc), capped by the plane z = h
+    C = parabaloids[0:3, :]
+    a = parabaloids[3, :]
+    b = parabaloids[4, :]
+    h = parabaloids[9, :]
+    depth = np.abs(h - C[2])
+
+    k = (b / a) ** 2
+    e = (a / b) ** 2
+    dx = np.sqrt(depth / k)
+    dy = np.sqrt(depth / e)
+
+    lo = np.stack([C[0] - dx, C[1] - dy, np.minimum(C[2], h)])
+    hi = np.stack([C[0] + dx, C[1] + dy, np.maximum(C[2], h)])
+    return lo, hi
+
+
+def instance_bounds(instances: np.ndarray, prototype_boxes: np.ndarray) -> (np.ndarray, np.ndarray):
+    # the corners of the box of the prototype, moved to the world
+    box = prototype_boxes[:, instances[0].astype(np.int64)]
+    corners = np.stack([np.where(np.array(bits)[:, None] > 0, box[3:6], box[0:3])
+                        for bits in np.ndindex(2, 2, 2)])
+
+    # world = origin + scale * R p, the rows of R^T are stored
+    M = instances[11:20].reshape(3, 3, -1)
+    world = instances[1:4] + instances[7] * np.einsum('kin,ckn->cin', M, corners)
+    return world.min(axis=0), world.max(axis=0)
+
+
+def triangle_bounds(triangles: np.ndarray, vertices: np.ndarray) -> (np.ndarray, np.ndarray):
+    # triangles: corner vertex indices in rows 0..2
+    corners = vertices[:, triangles[0:3].astype(np.int64)].astype(np.float64)
+    return corners.min(axis=1), corners.max(axis=1)
+
+
+def get_prototype_boxes(prototypes: np.ndarray, bounds: np.ndarray) -> np.ndarray:
+    # (6, P) float64 root box of the BVH of every prototype, an empty
+    # prototype gets an empty box at its origin
+    boxes = np.zeros((6, prototypes.shape[1]))
+    filled = prototypes[1] > prototypes[0]
+    boxes[:, filled] = bounds[:, prototypes[0, filled]]
+    return boxes
+
+
+def get_parts(spheres, rectangles, parabaloids, instances, prototype_boxes, triangles=None, vertices=None) -> list:
+    parts = [(SPHERE, spheres, sphere_bounds),
+             (RECTANGLE, rectangles, rectangle_bounds),
+             (PARABOLOID, parabaloids, paraboloid_bounds)]
+    if instances is not None:
+        parts.append((INSTANCE, instances, lambda data: instance_bounds(data, prototype_boxes)))
+    if triangles is not None:
+        parts.append((TRIANGLE, triangles, lambda data: triangle_bounds(data, vertices)))
+    return parts
+
+
+def get_primitive_bounds(prims: np.ndarray, spheres: np.ndarray, rectangles: np.ndarray, parabaloids: np.ndarray,
+                         instances: np.ndarray = None, prototype_boxes: np.ndarray = None) -> (np.ndarray, np.ndarray):
+    # padded boxes of the (type, index) columns of prims, in float64
+    parts = get_parts(spheres, rectangles, parabaloids, instances, prototype_boxes)
+
+    lo = np.zeros((3, prims.shape[1]))
+    hi = np.zeros((3, prims.shape[1]))
+    for obj_type, data, get_bounds in parts:
+        m = prims[0] == obj_type
+        if m.any():
+            lo[:, m], hi[:, m] = get_bounds(data[:, prims[1, m]].astype(np.float64))
+
+    return lo - BOUNDS_EPS, hi + BOUNDS_EPS
+
+
+def get_bvh_links(nodes: np.ndarray, prim_count: int) -> (np.ndarray, np.ndarray):
+    '''
+    parents:   int32 (n_nodes,) - parent of every node, -1 for the root
+    prim_leaf: int32 (n_prims,) - leaf holding every position of prims
+
+    The left child of an inner node i is i + 1, the right one is the skip
+    index of the left child.
+    '''
+    n = nodes.shape[1]
+    parents = np.full(n, -1, dtype=np.int32)
+    prim_leaf = np.zeros(prim_count, dtype=np.int32)
+
+    inner = np.flatnonzero(nodes[1] == 0)
+    parents[inner + 1] = inner
+    parents[nodes[2, inner + 1]] = inner
+
+    # the leaves hold consecutive runs of prims
+    leaves = np.flatnonzero(nodes[1] > 0)
+    leaves = leaves[np.argsort(nodes[0, leaves], kind='stable')]
+    prim_leaf[:] = np.repeat(leaves, nodes[1, leaves])
+
+    return parents, prim_leaf
+
+
+def refit_bvh(bounds: np.ndarray, nodes: np.ndarray, prims: np.ndarray, parents: np.ndarray, prim_leaf: np.ndarray,
+              positions: np.ndarray, spheres: np.ndarray, rectangles: np.ndarray, parabaloids: np.ndarray,
+              instances: np.ndarray = None, prototype_boxes: np.ndarray = None) -> np.ndarray:
+    '''
+    Updates in place the boxes of the leaves holding the prims positions and
+    of their ancestors; the tree itself is kept. Returns the updated nodes.
+    Refitting everything gives the same bounds as build_bvh.
+    '''
+    changed = set()
+    for leaf in np.unique(prim_leaf[positions]):
+        node = leaf
+        while node >= 0 and node not in changed:
+            changed.add(node)
+            node = parents[node]
+
+    # children are stored after their parent
+    changed = np.array(sorted(changed, reverse=True), dtype=np.int64)
+    for node in changed:
+        if nodes[1, node] > 0:
+            first = nodes[0, node]
+            lo, hi = get_primitive_bounds(prims[:, first:first + nodes[1, node]], spheres, rectangles, parabaloids,
+                                          instances, prototype_boxes)
+            bounds[0:3, node] = lo.min(axis=1)
+            bounds[3:6, node] = hi.max(axis=1)
+        else:
+            left = node + 1
+            right = nodes[2, left]
+            bounds[0:3, node] = np.minimum(bounds[0:3, left], bounds[0:3, right])
+            bounds[3:6, node] = np.maximum(bounds[3:6, left], bounds[3:6, right])
+
+    return changed[::-1].copy()
+
+
+@lru_cache(maxsize=None)
+def count_nodes(count: int) -> int:
+    # nodes of the build_bvh tree over count primitives
+    if count <= LEAF_SIZE:
+        return 1
+    return 1 + count_nodes(count // 2) + count_nodes(count - count // 2)
+
+
+def get_node_counts(counts: np.ndarray) -> np.ndarray:
+    # count_nodes of every item, a tree level has few different counts
+    values, inverse = np.unique(counts, return_inverse=True)
+    return np.array([count_nodes(int(v)) for v in values], dtype=np.int64)[inverse]
+
+
+def build_bvh(spheres: np.ndarray, rectangles: np.ndarray, parabaloids: np.ndarray, instances: np.ndarray = None,
+              prototype_boxes: np.ndarray = None, triangles: np.ndarray = None,
+              vertices: np.ndarray = None) -> (np.ndarray, np.ndarray, np.ndarray):
+    '''
+    BVH over the bounded primitives, planes are not included. Instances
+    (with the boxes of their prototypes, get_prototype_boxes) are leaves too,
+    and the triangles of meshes (corners in vertices) in a prototype BVH.
+
+    bounds: float32 (6, n_nodes) - box min [0:3] and max [3:6]
+    nodes:  int32 (3, n_nodes)   - [0] first primitive, [1] primitive count (0 for inner nodes),
+                                   [2] skip index: the node after this subtree
+    prims:  int32 (2, n_prims)   - [0] primitive type, [1] index in its scene array
+
+    Nodes are stored in depth first order, so the traversal goes to node + 1 when
+    a box is hit and jumps to the skip index when it is missed. No stack needed.
+    '''
+    parts = get_parts(spheres, rectangles, parabaloids, instances, prototype_boxes, triangles, vertices)
+
+    types, indices, lows, highs = [], [], [], []
+    for obj_type, data, get_bounds in parts:
+        count = data.shape[1]
+        if count == 0:
+            continue
+        lo, hi = get_bounds(data.astype(np.float64))
+        types.append(np.full(count, obj_type, dtype=np.int32))
+        indices.append(np.arange(count, dtype=np.int32))
+        lows.append(lo)
+        highs.append(hi)
+
+    if not types:
+        return np.zeros((6, 0), dtype=np.float32), np.zeros((3, 0), dtype=np.int32), np.zeros((2, 0), dtype=np.int32)
+
+    types = np.concatenate(types)
+    indices = np.concatenate(indices)
+    lo = np.concatenate(lows, axis=1) - BOUNDS_EPS
+    hi = np.concatenate(highs, axis=1) + BOUNDS_EPS
+    centers = (lo + hi) / 2
+
+    n = types.shape[0]
+    node_count = count_nodes(n)
+    bounds = np.zeros((6, node_count), dtype=np.float32)
+    nodes = np.zeros((3, node_count), dtype=np.int32)
+
+    # median split: a node of more than LEAF_SIZE primitives gives the half
+    # with the lower centres on its longest axis to the left child (node + 1).
+    # Built one tree level at a time, all nodes of a level in whole arrays:
+    # node owns positions start..end of every sorted_prims[axis], where its
+    # primitives are ordered by the centre on that axis. A split moves the
+    # left half to the front in all three, keeping that order
+    sorted_prims = [np.argsort(centers[axis], kind='stable') for axis in range(3)]
+    goes_left = np.zeros(n, dtype=bool)
+    start = np.array([0])
+    end = np.array([n])
+    node = np.array([0])
+    levels = []
+    while node.size:
+        size = end - start
+        leaf = size <= LEAF_SIZE
+        nodes[0, node[leaf]] = start[leaf]
+        nodes[1, node[leaf]] = size[leaf]
+        nodes[2, node] = node + get_node_counts(size)
+
+        inner = ~leaf
+        start, end, node, size = start[inner], end[inner], node[inner], size[inner]
+        if not node.size:
+            break
+        levels.append(node)
+
+        offsets = np.concatenate([[0], np.cumsum(size)[:-1]])
+        segment = np.repeat(np.arange(node.size), size)
+        first = start[segment]
+        positions = np.arange(segment.size) + first - offsets[segment]
+        rank = positions - first
+        mid = size // 2
+        left_size = mid[segment]
+
+        extent = np.stack([centers[axis, sorted_prims[axis][end - 1]] - centers[axis, sorted_prims[axis][start]]
+                           for axis in range(3)])
+        split_axis = np.argmax(extent, axis=0)[segment]
+        for axis in range(3):
+            m = split_axis == axis
+            goes_left[sorted_prims[axis][positions[m]]] = rank[m] < left_size[m]
+
+        for axis in range(3):
+            moved = sorted_prims[axis][positions]
+            left = goes_left[moved]
+            left_rank = np.cumsum(left) - left
+            left_rank -= left_rank[offsets][segment]
+            sorted_prims[axis][first + np.where(left, left_rank, left_size + rank - left_rank)] = moved
+
+        start, end, node = (np.concatenate([start, start + mid]), np.concatenate([start + mid, end]),
+                            np.concatenate([node + 1, node + 1 + get_node_counts(mid)]))
+
+    # boxes from the leaves up, a parent's box holds its children's
+    order = sorted_prims[0]
+    leaves = np.flatnonzero(nodes[1] > 0)
+    leaves = leaves[np.argsort(nodes[0, leaves])]
+    # the primitives of a leaf by type: tests of one type follow each other
+    order = order[np.lexsort((types[order], np.repeat(np.arange(leaves.size), nodes[1, leaves])))]
+    bounds[0:3, leaves] = np.minimum.reduceat(lo.T[order], nodes[0, leaves], axis=0).T
+    bounds[3:6, leaves] = np.maximum.reduceat(hi.T[order], nodes[0, leaves], axis=0).T
+    for node in reversed(levels):
+        left = bounds[:, node + 1]
+        right = bounds[:, nodes[2, node + 1]]
+        bounds[0:3, node] = np.minimum(left[0:3], right[0:3])
+        bounds[3:6, node] = np.maximum(left[3:6], right[3:6])
+
+    prims = np.stack([types[order], indices[order]]).astype(np.int32)
+    return bounds, nodes, prims
+
+
+def pack_primitives(prims: np.ndarray, spheres: np.ndarray, rectangles: np.ndarray, parabaloids: np.ndarray,
+                    triangles: np.ndarray = None, vertices: np.ndarray = None, columns: np.ndarray = None) -> np.ndarray:
+    '''
+    What the intersection tests read of the BVH primitives, in one float32
+    table in the order of prims: the primitives of a leaf are neighbouring
+    columns instead of columns of a table per type. Rows of every type:
+
+    sphere:     [0:3] centre, [3] radius^2
+    rectangle:  [0:3] origin, [3:6] u, [6:9] v, [9:12] normal, [12:15] (u x v) / |u x v|^2, [15] plane offset
+    paraboloid: [0:3] origin, [3] k, [4] e, [5] orientation, [6] height
+    triangle:   [0:3], [3:6], [6:9] corners
+
+    Instances have no columns of data. The table has the rows of the largest
+    type in prims. columns: only these columns of prims, (rows, len(columns)).
+    '''
+    if columns is None:
+        columns = np.arange(prims.shape[1])
+    types, indices = prims[0, columns], prims[1, columns]
+    rows = max([PACKED_ROWS[t] for t in np.unique(prims[0])] + [PACKED_ROWS[SPHERE]])
+    packed = np.zeros((rows, columns.size), dtype=np.float32)
+
+    for obj_type, data, rows in ((SPHERE, spheres, [0, 1, 2, 7]),
+                                 (RECTANGLE, rectangles, [*range(9), *range(13, 20)]),
+                                 (PARABOLOID, parabaloids, [0, 1, 2, 11, 12, 8, 9])):
+        m = types == obj_type
+        if m.any():
+            packed[:len(rows), m] = data[np.ix_(rows, indices[m])]
+
+    m = types == TRIANGLE
+    if m.any():
+        packed[0:9, m] = vertices[:, triangles[0:3, indices[m]]].transpose(1, 0, 2).reshape(9, -1)
+    return packed
+
+
+def build_prototype_bvh(spheres: np.ndarray, rectangles: np.ndarray, parabaloids: np.ndarray, starts: np.ndarray,
+                        vertices: np.ndarray = None, triangles: np.ndarray = None,
+                        mesh_bvhs: list = None) -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+    '''
+    BVH of every prototype in object space, over its columns of the
+    pack_prototypes tables, all in one node array. mesh_bvhs: per prototype
+    None or the BVH of its triangles (Mesh.get_bvh), used instead of a new
+    one for a prototype of a single mesh.
+
+    prototypes: int32 (2, P) - first node and the node after the prototype's tree
+    bounds, nodes, prims as in build_bvh, prims index the whole tables and
+    skip indices are absolute
+    '''
+    count = starts.shape[1] - 1
+    prototypes = np.zeros((2, count), dtype=np.int32)
+    all_bounds, all_nodes, all_prims = [], [], []
+    node_count = prim_count = 0
+
+    for p in range(count):
+        (s0, r0, q0, t0), (s1, r1, q1, t1) = starts[:, p], starts[:, p + 1]
+        if mesh_bvhs is not None and mesh_bvhs[p] is not None:
+            bounds, nodes, prims = (np.array(a) for a in mesh_bvhs[p])
+        else:
+            bounds, nodes, prims = build_bvh(spheres[:, s0:s1], rectangles[:, r0:r1], parabaloids[:, q0:q1],
+                                             triangles=None if triangles is None else triangles[:, t0:t1],
+                                             vertices=vertices)
+
+        nodes[0] += prim_count
+        nodes[2] += node_count
+        for obj_type, start in ((SPHERE, s0), (RECTANGLE, r0), (PARABOLOID, q0), (TRIANGLE, t0)):
+            prims[1, prims[0] == obj_type] += start
+
+        prototypes[:, p] = node_count, node_count + nodes.shape[1]
+        node_count += nodes.shape[1]
+        prim_count += prims.shape[1]
+        all_bounds.append(bounds)
+        all_nodes.append(nodes)
+        all_prims.append(prims)
+
+    if count == 0:
+        return prototypes, *build_bvh(spheres, rectangles, parabaloids)
+    return prototypes, np.concatenate(all_bounds, axis=1), np.concatenate(all_nodes, axis=1), np.concatenate(all_prims, axis=1)
+
+
+def build_light_bvh(lights: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+    '''
+    Lights with an influence radius (lights[3] > 0) in a BVH of the boxes of
+    their spheres of influence, so a shading point only visits the lights in
+    whose boxes it lies; prims [1] index the lights table. The lights without
+    a radius reach every point and are listed apart.
+
+    unbounded: int32 (1, U) - indices of the lights without a radius
+    bounds, nodes, prims as in build_bvh
+    '''
+    bounded = lights[3] > 0
+    empty = np.zeros((0, 0), dtype=np.float32)
+    bounds, nodes, prims = build_bvh(lights[:, bounded], empty, empty)
+    prims[1] = np.flatnonzero(bounded)[prims[1]]
+    unbounded = np.flatnonzero(~bounded).astype(np.int32)[None, :]
+    return unbounded, bounds, nodes, prims
@@ -1,3 +1,4 @@
+import copy
 from typing import Tuple
 from .common import Vector3D
 import numpy as np
@@ -8,6 +9,7 @@ class Camera:
     def __init__(self, resolution: Tuple[int, int], position: Vector3D, euler: Vector3D, fov: float = 45.):
         self.resolution = resolution
         self._position = position
+        self.euler = euler
         self.rotation = euler_rotation(euler[0], euler[1], euler[2])
         self.field_of_view = fov
 
@@ -15,6 +17,45 @@ class Camera:
     def position(self):
         return np.array(self._position)
 
+    def get_pixel_grid(self):
+        # the pixel (x, y) lies at (focal, y0 + x * dy, z0 + y * dz) before rotation
+        width, height = self.resolution
+        AR = int(width / height)
+        focal = 1 / np.tan(np.radians(self.field_of_view) / 2)
+        dy = (-AR - AR) / float(width - 1) if width != 1 else 1
+        dz = (-1 - 1) / float(height - 1) if height != 1 else 1
+        return focal, AR, dy, 1, dz
+
+    def generate_descriptor(self, tile_origin: Tuple[int, int] = (0, 0)):
+        '''
+        float64 (21,) array the kernels build primary rays from:
+        [0:3] position, [3:12] rotation (row major), [12] focal length,
+        [13:15] y0, dy and [15:17] z0, dz of the pixel grid,
+        [17:19] first pixel of the rendered tile, [19:21] image resolution
+        '''
+        data = np.zeros(21, dtype=np.float64)
+        data[0:3] = self.position
+        data[3:12] = self.rotation.ravel()
+        data[12:17] = self.get_pixel_grid()
+        data[17:19] = tile_origin
+        data[19:21] = self.resolution
+        return data
+
+    def get_preview(self, scale: int):
+        # the same view at 1/scale of the resolution
+        preview = copy.copy(self)
+        preview.resolution = (max(1, self.resolution[0] // scale), max(1, self.resolution[1] // scale))
+        return preview
+
+    def get_tiles(self, tile_size: Tuple[int, int]):
+        # (x0, y0, w, h) of the tiles covering the image, the last row and
+        # column may be smaller
+        width, height = self.resolution
+        tile_w, tile_h = tile_size
+        for x0 in range(0, width, tile_w):
+            for y0 in range(0, height, tile_h):
+                yield x0, y0, min(tile_w, width - x0), min(tile_h, height - y0)
+
     def generate_pixel_locations(self):
 
         width, height = self.resolution
@@ -0,0 +1,231 @@
+from __future__ import annotations
+import os
+import json
+import numpy as np
+from dataclasses import dataclass
+from .colors import *
+from .common import Color
+from .bvh import build_bvh
+
+'''
+Triangle meshes. A mesh is two shared buffers: vertices float32 (3, V), one
+row per coordinate, and triangles int32 (3, T), the vertex indices of the
+corners. Meshes go into a Prototype and are placed in the scene by
+instances, like the other prototype primitives.
+
+load_obj parses an OBJ file on whole byte arrays, without a Python object
+per face, and keeps a binary copy next to it (save_mesh): a small JSON
+header and .npy tables of the buffers and of the triangle BVH. Later loads
+memory-map those while the OBJ file is unchanged.
+'''
+
+FORMAT, VERSION = 'ray-tracing-mesh', 1
+TABLES = ('vertices', 'triangles', 'bvh_bounds', 'bvh_nodes', 'bvh_prims')
+
+SPACE, NEWLINE, SLASH, BACKSLASH, HASH = ord(' '), ord('\n'), ord('/'), ord('\\'), ord('#')
+
+
+@dataclass(eq=False)
+class Mesh:
+    vertices: np.ndarray
+    triangles: np.ndarray
+    color: Color = tuple(SILVER)
+
+    # (bounds, nodes, prims) of build_bvh over the triangles, made on first
+    # use (get_bvh) or loaded with the mesh
+    bvh: tuple = None
+
+    def get_bvh(self) -> tuple:
+        if self.bvh is None:
+            empty = np.zeros((0, 0), dtype=np.float32)
+            self.bvh = build_bvh(empty, empty, empty, triangles=self.triangles, vertices=self.vertices)
+        return self.bvh
+
+
+def pack_meshes(meshes: list) -> (np.ndarray, np.ndarray, np.ndarray):
+    # all meshes in one vertex table, float32 (3, V), triangles int32 (4, T)
+    # with indices into it and [3] the number of the mesh, colours float32 (3, M)
+    vertices = np.zeros((3, sum(m.vertices.shape[1] for m in meshes)), dtype=np.float32)
+    triangles = np.zeros((4, sum(m.triangles.shape[1] for m in meshes)), dtype=np.int32)
+    colors = np.zeros((3, len(meshes)), dtype=np.float32)
+
+    v = t = 0
+    for i, mesh in enumerate(meshes):
+        count = mesh.triangles.shape[1]
+        if count and (mesh.triangles.min() < 0 or mesh.triangles.max() >= mesh.vertices.shape[1]):
+            raise ValueError(f'mesh {i}: triangle vertex out of range, the mesh has {mesh.vertices.shape[1]}')
+        vertices[:, v:v + mesh.vertices.shape[1]] = mesh.vertices
+        triangles[0:3, t:t + count] = mesh.triangles + v
+        triangles[3, t:t + count] = i
+        colors[:, i] = mesh.color
+        v += mesh.vertices.shape[1]
+        t += count
+    return vertices, triangles, colors
+
+
+def get_lines(buf: np.ndarray, keyword: bytes) -> (np.ndarray, np.ndarray, np.ndarray):
+    # the bytes of all lines starting with keyword and a space (after the
+    # indentation), the keyword blanked, where every line starts in them and
+    # the mask of those lines
+    line_starts = np.concatenate([[0], np.flatnonzero(buf == NEWLINE) + 1])
+    line_ends = np.append(line_starts[1:], buf.size)
+    # past the leading spaces; every line ends with a newline, so the first
+    # other byte is in the line
+    nonblank = np.flatnonzero(buf != SPACE)
+    line_starts = nonblank[np.minimum(np.searchsorted(nonblank, line_starts), nonblank.size - 1)]
+    selected = np.ones(line_starts.size, dtype=bool)
+    for i, char in enumerate(keyword + b' '):
+        at = np.minimum(line_starts + i, buf.size - 1)
+        selected &= (buf[at] == char) & (line_starts + i < line_ends)
+
+    starts, lengths = line_starts[selected], (line_ends - line_starts)[selected]
+    offsets = np.cumsum(lengths) - lengths
+    data = buf[np.arange(lengths.sum()) + np.repeat(starts - offsets, lengths)]
+    for i in range(len(keyword)):
+        data[offsets + i] = SPACE
+    return data, offsets, selected
+
+
+def get_tokens(data: np.ndarray, offsets: np.ndarray) -> (np.ndarray, np.ndarray):
+    # number of whitespace separated tokens of every line and the index of
+    # every token in its line
+    blank = data <= SPACE
+    token_starts = np.flatnonzero(~blank & np.concatenate([[True], blank[:-1]]))
+    line = np.searchsorted(offsets, token_starts, side='right') - 1
+    counts = np.bincount(line, minlength=offsets.size)
+    first = np.cumsum(counts) - counts
+    return counts, np.arange(token_starts.size) - first[line]
+
+
+def parse_numbers(data: np.ndarray, count: int, dtype) -> np.ndarray:
+    values = np.fromstring(data.tobytes(), dtype=dtype, sep=' ') if data.size else np.zeros(0, dtype=dtype)
+    if values.size != count:
+        raise ValueError('OBJ: malformed numbers')
+    return values
+
+
+def parse_obj(data: bytes) -> (np.ndarray, np.ndarray):
+    '''
+    Vertices float32 (3, V) and triangles int32 (3, T) of the OBJ text data.
+    Only v and f lines are used: texture and normal indices of the faces are
+    dropped, polygons are split into triangle fans.
+    '''
+    # a newline at the end: every line has one
+    buf = np.empty(len(data) + 1, dtype=np.uint8)
+    buf[:-1] = np.frombuffer(data, dtype=np.uint8)
+    buf[-1] = NEWLINE
+    buf[(buf == ord('\t')) | (buf == ord('\r'))] = SPACE
+
+    # comments: from # to the end of the line, also after v x y z or f ...
+    hashes = buf == HASH
+    if hashes.any():
+        position = np.arange(buf.size, dtype=np.int64)
+        last_hash = np.maximum.accumulate(np.where(hashes, position, -1))
+        last_newline = np.maximum.accumulate(np.where(buf == NEWLINE, position, -1))
+        buf[last_hash > last_newline] = SPACE
+
+    # a backslash before the end of a line joins the next one to it
+    backslashes = np.flatnonzero(buf == BACKSLASH)
+    if backslashes.size:
+        nonblank = np.flatnonzero(buf != SPACE)
+        after = nonblank[np.searchsorted(nonblank, backslashes, side='right')]
+        if (buf[after] == NEWLINE).any():
+            raise ValueError('OBJ: line continuations (\\ at the end of a line) are not supported')
+
+    # v x y z [w]
+    vertex_data, vertex_offsets, vertex_lines = get_lines(buf, b'v')
+    counts, column = get_tokens(vertex_data, vertex_offsets)
+    if (counts < 3).any():
+        raise ValueError('OBJ: vertex with less than 3 coordinates')
+    values = parse_numbers(vertex_data, counts.sum(), np.float32)
+    vertices = np.ascontiguousarray(values[column < 3].reshape(-1, 3).T)
+
+    # f v1[/vt1[/vn1]] v2... - the part after the first / is blanked
+    face_data, face_offsets, face_lines = get_lines(buf, b'f')
+    separator = (face_data <= SPACE) | (face_data == SLASH)
+    last = np.maximum.accumulate(np.where(separator, np.arange(face_data.size, dtype=np.int64), -1))
+    face_data[(last >= 0) & (face_data[np.maximum(last, 0)] == SLASH)] = SPACE
+
+    counts, _ = get_tokens(face_data, face_offsets)
+    if (counts < 3).any():
+        raise ValueError('OBJ: face with less than 3 vertices')
+    corners = parse_numbers(face_data, counts.sum(), np.int64)
+
+    # 1 based, negative: relative to the vertices read before the face
+    vertices_before = np.cumsum(vertex_lines)[face_lines]
+    corners = np.where(corners < 0, np.repeat(vertices_before, counts) + corners, corners - 1)
+    if corners.size and (corners.min() < 0 or corners.max() >= vertices.shape[1]):
+        raise ValueError('OBJ: face vertex out of range')
+
+    # fan: (c0, c_i, c_i+1) for i = 1..n-2
+    first = np.cumsum(counts) - counts
+    fans = counts - 2
+    face = np.repeat(np.arange(counts.size), fans)
+    i = np.arange(fans.sum()) - np.repeat(np.cumsum(fans) - fans, fans) + 1
+    triangles = np.stack([corners[first[face]], corners[first[face] + i], corners[first[face] + i + 1]])
+    return vertices, triangles.astype(np.int32)
+
+
+def save_mesh(path: str, mesh: Mesh, source: dict = None):
+    # header at path (.json), tables next to it; source: stamp of the file
+    # the mesh was read from
+    stem = os.path.splitext(path)[0]
+    arrays = dict(zip(TABLES, (mesh.vertices, mesh.triangles, *mesh.get_bvh())))
+
+    tables = {}
+    for name in TABLES:
+        tables[name] = f'{os.path.basename(stem)}.{name}.npy'
+        np.save(f'{stem}.{name}.npy', np.ascontiguousarray(arrays[name]))
+
+    header = {'format': FORMAT, 'version': VERSION, 'color': np.asarray(mesh.color).tolist(), 'tables': tables}
+    if source is not None:
+        header['source'] = source
+    with open(path, 'w') as f:
+        json.dump(header, f, indent=2)
+
+
+def read_mesh_header(path: str) -> dict:
+    with open(path) as f:
+        header = json.load(f)
+    if header.get('format') != FORMAT or header.get('version') != VERSION:
+        raise ValueError(f'{path}: not a mesh file of version {VERSION}')
+    return header
+
+
+def load_mesh(path: str, mmap: bool = True, header: dict = None) -> Mesh:
+    # mmap: the tables are np.memmap in copy-on-write mode, as in load_scene
+    header = header or read_mesh_header(path)
+    folder = os.path.dirname(path)
+    tables = {name: np.load(os.path.join(folder, file), mmap_mode='c' if mmap else None)
+              for name, file in header['tables'].items()}
+    return Mesh(tables['vertices'], tables['triangles'], header['color'], tuple(tables[name] for name in TABLES[2:]))
+
+
+def get_stamp(path: str) -> dict:
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def load_obj(path: str, color: Color = tuple(SILVER), cache: bool = True) -> Mesh:
+    '''
+    Mesh of an OBJ file. cache: use the binary copy at path + '.mesh.json'
+    if it was made from the file as it is now, else parse the file, build
+    the BVH and write the copy.
+    '''
+    cache_path = f'{path}.mesh.json'
+    stamp = get_stamp(path)
+    if cache and os.path.exists(cache_path):
+        try:
+            header = read_mesh_header(cache_path)
+            if header.get('source') == stamp:
+                mesh = load_mesh(cache_path, header=header)
+                mesh.color = color
+                return mesh
+        except (OSError, ValueError):
+            pass
+
+    with open(path, 'rb') as f:
+        mesh = Mesh(*parse_obj(f.read()), color)
+    if cache:
+        save_mesh(cache_path, mesh, stamp)
+    return mesh
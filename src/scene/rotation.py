@@ -31,4 +31,27 @@ def euler_rotation(roll: float, pitch: float, yaw: float, is_radians: bool = Fal
         roll, pitch, yaw = np.deg2rad(roll), np.deg2rad(pitch), np.deg2rad(yaw)
 
     R = rotation_z(yaw) @ rotation_y(pitch) @ rotation_x(roll)
-    return R
\ No newline at end of file
+    return R
+
+
+def euler_rotations(angles: np.ndarray) -> np.ndarray:
+    # euler_rotation of every column of (3, N) angles in degrees, (N, 3, 3)
+    roll, pitch, yaw = np.deg2rad(angles)
+    n = angles.shape[1]
+
+    R_x = np.zeros((n, 3, 3))
+    R_x[:, 0, 0] = 1
+    R_x[:, 1, 1], R_x[:, 1, 2] = np.cos(roll), -np.sin(roll)
+    R_x[:, 2, 1], R_x[:, 2, 2] = np.sin(roll), np.cos(roll)
+
+    R_y = np.zeros((n, 3, 3))
+    R_y[:, 1, 1] = 1
+    R_y[:, 0, 0], R_y[:, 0, 2] = np.cos(pitch), -np.sin(pitch)
+    R_y[:, 2, 0], R_y[:, 2, 2] = np.sin(pitch), np.cos(pitch)
+
+    R_z = np.zeros((n, 3, 3))
+    R_z[:, 2, 2] = 1
+    R_z[:, 0, 0], R_z[:, 0, 1] = np.cos(yaw), -np.sin(yaw)
+    R_z[:, 1, 0], R_z[:, 1, 1] = np.sin(yaw), np.cos(yaw)
+
+    return R_z @ R_y @ R_x
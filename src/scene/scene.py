@@ -1,9 +1,11 @@
 from __future__ import annotations
 import numpy as np
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import List
 from .colors import *
 from .common import Vector3D, Color
+from .rotation import euler_rotations
+from .mesh import Mesh, pack_meshes
 
 @dataclass
 class Sphere:
@@ -11,7 +13,9 @@ class Sphere:
     radius: float
     color: Color
 
-    data_length: int = 7
+    # [7] radius^2, filled by precompute
+    data_length: int = 8
+    input_length: int = 7
 
     def to_array(self) -> np.ndarray:
         data = np.zeros(self.data_length, dtype=np.float32)
@@ -21,19 +25,39 @@ class Sphere:
 
         return data
 
+    @staticmethod
+    def from_array(data: np.ndarray) -> Sphere:
+        return Sphere(origin=data[0:3].tolist(), radius=float(data[3]), color=data[4:7].tolist())
+
+    @staticmethod
+    def precompute(data: np.ndarray) -> np.ndarray:
+        data[7] = data[3].astype(np.float64) ** 2
+        return data
+
 
 @dataclass
 class Light:
     origin: Vector3D
 
-    data_length: int = 3
+    # the light fades out over radius (get_light_falloff) and does not reach
+    # points further away; 0 - no falloff, it lights the whole scene
+    radius: float = 0.
+
+    # a (3, N) table of origins gets radius 0
+    data_length: int = 4
+    input_length: int = 3
 
     def to_array(self) -> np.ndarray:
         data = np.zeros(self.data_length, dtype=np.float32)
         data[0:3] = np.array(self.origin)
+        data[3] = self.radius
 
         return data
 
+    @staticmethod
+    def from_array(data: np.ndarray) -> Light:
+        return Light(origin=data[0:3].tolist(), radius=float(data[3]))
+
 @dataclass
 class Rectangle:
     origin: Vector3D
@@ -42,8 +66,11 @@ class Rectangle:
     color: Color
 
     normal_orientation : np.float32
-    
-    data_length: int = 13
+
+    # [13:16] unit normal, [16:19] (u x v) / |u x v|^2, [19] plane offset D = N . origin,
+    # filled by precompute
+    data_length: int = 20
+    input_length: int = 13
 
     def to_array(self) -> np.ndarray:
         data = np.zeros(self.data_length, dtype=np.float32)
@@ -54,6 +81,23 @@ class Rectangle:
         data[12] = np.array(self.normal_orientation)
         return data
 
+    @staticmethod
+    def from_array(data: np.ndarray) -> Rectangle:
+        return Rectangle(origin=data[0:3].tolist(), u_vect=data[3:6].tolist(), v_vect=data[6:9].tolist(),
+                         color=data[9:12].tolist(), normal_orientation=float(data[12]))
+
+    @staticmethod
+    def precompute(data: np.ndarray) -> np.ndarray:
+        O = data[0:3].astype(np.float64)
+        NN = np.cross(data[3:6].astype(np.float64), data[6:9].astype(np.float64), axis=0)
+        s = np.sum(NN * NN, axis=0)
+        N = NN / np.sqrt(s)
+
+        data[13:16] = N
+        data[16:19] = NN / s
+        data[19] = np.sum(N * O, axis=0)
+        return data
+
 
 @dataclass
 class Paraboloid:
@@ -64,8 +108,10 @@ class Paraboloid:
     orientation : np.float32
     h :np.float32
     n_orient: np.float32
-    
-    data_length: int = 11
+
+    # [11] k = (b/a)^2, [12] e = (a/b)^2, filled by precompute
+    data_length: int = 13
+    input_length: int = 11
 
     def to_array(self) -> np.ndarray:
         data = np.zeros(self.data_length, dtype=np.float32)
@@ -78,13 +124,28 @@ class Paraboloid:
         data[10] = np.array(self.n_orient)
 
         return data
+
+    @staticmethod
+    def from_array(data: np.ndarray) -> Paraboloid:
+        return Paraboloid(origin=data[0:3].tolist(), a=float(data[3]), b=float(data[4]), color=data[5:8].tolist(),
+                          orientation=float(data[8]), h=float(data[9]), n_orient=float(data[10]))
+
+    @staticmethod
+    def precompute(data: np.ndarray) -> np.ndarray:
+        a = data[3].astype(np.float64)
+        b = data[4].astype(np.float64)
+        data[11] = (b / a) ** 2
+        data[12] = (a / b) ** 2
+        return data
 @dataclass
 class Plane:
     origin: Vector3D
     normal: Vector3D
     color: Color
 
-    data_length: int = 9
+    # [9] plane offset D = normal . origin, filled by precompute
+    data_length: int = 10
+    input_length: int = 9
 
     def to_array(self) -> np.ndarray:
         data = np.zeros(self.data_length, dtype=np.float32)
@@ -94,64 +155,204 @@ class Plane:
 
         return data
 
+    @staticmethod
+    def from_array(data: np.ndarray) -> Plane:
+        return Plane(origin=data[0:3].tolist(), normal=data[3:6].tolist(), color=data[6:9].tolist())
+
+    @staticmethod
+    def precompute(data: np.ndarray) -> np.ndarray:
+        data[9] = np.sum(data[0:3].astype(np.float64) * data[3:6], axis=0)
+        return data
+
+
+@dataclass
+class Instance:
+    prototype: int
+    origin: Vector3D
+    euler: Vector3D = (0, 0, 0)
+    scale: float = 1.
+    color: Color = None
+
+    # a copy of Scene.prototypes[prototype], rotated by euler (degrees, as
+    # euler_rotation), scaled and moved to origin; color None keeps the
+    # colours of the prototype. [11:20] rows of the world to object
+    # rotation, filled by precompute
+    data_length: int = 20
+    input_length: int = 11
+
+    def to_array(self) -> np.ndarray:
+        data = np.zeros(self.data_length, dtype=np.float32)
+        data[0] = self.prototype
+        data[1:4] = np.array(self.origin)
+        data[4:7] = np.array(self.euler)
+        data[7] = self.scale
+        data[8:11] = -1 if self.color is None else np.array(self.color)
+
+        return data
+
+    @staticmethod
+    def from_array(data: np.ndarray) -> Instance:
+        color = None if data[8] < 0 else data[8:11].tolist()
+        return Instance(prototype=int(data[0]), origin=data[1:4].tolist(), euler=data[4:7].tolist(),
+                        scale=float(data[7]), color=color)
+
+    @staticmethod
+    def precompute(data: np.ndarray) -> np.ndarray:
+        # R^T of every instance, row after row
+        R = euler_rotations(data[4:7].astype(np.float64))
+        data[11:20] = R.transpose(2, 1, 0).reshape(9, -1)
+        return data
+
+
+@dataclass
+class Prototype:
+    # primitives in object space, shared by all instances of the prototype;
+    # planes are unbounded and can't be instanced
+    spheres: List[Sphere] = field(default_factory=list)
+    rectangles: List[Rectangle] = field(default_factory=list)
+    paraboloids: List[Paraboloid] = field(default_factory=list)
+    meshes: List[Mesh] = field(default_factory=list)
+
+
+def pack_prototypes(prototypes: List[Prototype]) -> tuple:
+    # the spheres, rectangles and paraboloids of all prototypes, one table per
+    # type, their meshes (vertices, triangles, colours of pack_meshes) and
+    # starts (4, P + 1): prototype p owns columns starts[:, p]..starts[:, p + 1]
+    # of the spheres, rectangles, paraboloids and triangles
+    starts = np.zeros((4, len(prototypes) + 1), dtype=np.int64)
+    for p, prototype in enumerate(prototypes):
+        starts[:, p + 1] = starts[:, p] + (len(prototype.spheres), len(prototype.rectangles), len(prototype.paraboloids),
+                                           sum(m.triangles.shape[1] for m in prototype.meshes))
+
+    spheres = pack(Sphere, [s for p in prototypes for s in p.spheres])
+    rectangles = pack(Rectangle, [r for p in prototypes for r in p.rectangles])
+    paraboloids = pack(Paraboloid, [q for p in prototypes for q in p.paraboloids])
+    return (spheres, rectangles, paraboloids, *pack_meshes([m for p in prototypes for m in p.meshes]), starts)
+
+
+def pack(cls, objects) -> np.ndarray:
+    # (data_length, N) table of the objects, a PrimitiveTable is one already
+    if isinstance(objects, PrimitiveTable):
+        return objects.data
+
+    data = np.zeros((cls.data_length, len(objects)), dtype=np.float32)
+    for i, o in enumerate(objects):
+        data[:, i] = o.to_array()
+
+    precompute = getattr(cls, 'precompute', None)
+    return data if precompute is None else precompute(data)
+
+
+def get_table(cls, data: np.ndarray) -> np.ndarray:
+    # table of the (input_length, N) inputs of cls, or of all its
+    # data_length rows - then a float32 array is used as it is
+    data = np.asanyarray(data)
+    if data.ndim != 2 or data.shape[0] not in (cls.input_length, cls.data_length):
+        raise ValueError(f'{cls.__name__}: expected ({cls.input_length}, N) or ({cls.data_length}, N) array, got {data.shape}')
+    if data.shape[0] == cls.data_length:
+        return data if data.dtype == np.float32 else data.astype(np.float32)
+
+    table = np.zeros((cls.data_length, data.shape[1]), dtype=np.float32)
+    table[:cls.input_length] = data
+    precompute = getattr(cls, 'precompute', None)
+    return table if precompute is None else precompute(table)
+
+
+class PrimitiveTable:
+    '''
+    Primitives of one type as a (data_length, N) float32 table, the layout of
+    generate_scene, instead of a list of objects - for scenes of 10^5..10^6
+    primitives (Scene.from_arrays, load_scene). Behaves like the list for
+    SceneBuffer: an item is an object made from its column, setting an item
+    packs the object back.
+    '''
+    def __init__(self, cls, data: np.ndarray):
+        self.cls = cls
+        self.data = data
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    def __getitem__(self, index):
+        return self.cls.from_array(self.data[:, index])
+
+    def __setitem__(self, index, obj):
+        self.data[:, index] = pack(self.cls, [obj])[:, 0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, obj):
+        self.data = np.concatenate([self.data, pack(self.cls, [obj])], axis=1)
+
+    def pop(self):
+        obj = self[len(self) - 1]
+        self.data = self.data[:, :-1]
+        return obj
+
 
 class Scene:
     def __init__(self, lights: List[Light], spheres: List[Sphere], planes: List[Plane], rectangles : List[Rectangle],
-                 paraboloids : List[Paraboloid]):
+                 paraboloids : List[Paraboloid], instances: List[Instance] = None, prototypes: List[Prototype] = None):
         self.lights = lights
         self.spheres = spheres
         self.planes = planes
         self.rectangles = rectangles
         self.paraboloids = paraboloids
-        
 
+        # copies of prototypes (groups of primitives) placed by instances,
+        # the primitives are stored once
+        self.instances = [] if instances is None else instances
+        self.prototypes = [] if prototypes is None else prototypes
 
-        
-     
+        # (bounds, nodes, prims) of build_bvh stored with the scene
+        # (load_scene), SceneBuffer then does not build it again
+        self.bvh = None
 
-        
     def get_spheres(self) -> np.ndarray:
-        data = np.zeros((Sphere.data_length, len(self.spheres)), dtype=np.float32)
-
-        for i, s in enumerate(self.spheres):
-            data[:, i] = s.to_array()
-
-        return data
+        return pack(Sphere, self.spheres)
 
     def get_reactangles(self) -> np.ndarray:
-        data = np.zeros((Rectangle.data_length, len(self.rectangles)), dtype=np.float32)
-        
-        for i,r in enumerate(self.rectangles):
-            data[:,i] = r.to_array() 
-        return data
-    
-    def get_parabaloids(self) -> np.ndarray:
-        data = np.zeros((Paraboloid.data_length, len(self.paraboloids)), dtype=np.float32)
-        
-        for i,p in enumerate(self.paraboloids):
-            data[:,i] = p.to_array() 
-        return data
-    
-    def get_planes(self) -> np.ndarray:
-        data = np.zeros((Plane.data_length, len(self.planes)), dtype=np.float32)
+        return pack(Rectangle, self.rectangles)
 
-        for i, p in enumerate(self.planes):
-            data[:, i] = p.to_array()
+    def get_parabaloids(self) -> np.ndarray:
+        return pack(Paraboloid, self.paraboloids)
 
-        return data
+    def get_planes(self) -> np.ndarray:
+        return pack(Plane, self.planes)
 
     def get_lights(self) -> np.ndarray:
-        data = np.zeros((Light.data_length, len(self.lights)), dtype=np.float32)
+        return pack(Light, self.lights)
 
-        for i, l in enumerate(self.lights):
-            data[:, i] = l.to_array()
-
-        return data
+    def get_instances(self) -> np.ndarray:
+        return pack(Instance, self.instances)
 
     def generate_scene(self) -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray,np.ndarray):
         return self.get_spheres(), self.get_lights(), self.get_planes(),self.get_reactangles(), self.get_parabaloids()
-             
-    
+
+    @staticmethod
+    def from_arrays(lights=None, spheres=None, planes=None, rectangles=None, paraboloids=None, instances=None,
+                    prototypes=None) -> Scene:
+        '''
+        Scene of column tables, e.g. of a procedural generator, without an
+        object per primitive. Every table is (input_length, N) - the fields
+        of to_array in the same rows (Sphere: origin, radius, color), plane
+        normals of unit length - or all data_length rows as generate_scene
+        returns them, then a float32 array (np.memmap too) is used without a
+        copy. A list of objects is taken as it is, None - no primitives.
+        prototypes is the list of Prototype of the instances table.
+        '''
+        def table(cls, data):
+            if data is None:
+                return []
+            if isinstance(data, list):
+                return data
+            return PrimitiveTable(cls, get_table(cls, data))
+
+        return Scene(table(Light, lights), table(Sphere, spheres), table(Plane, planes), table(Rectangle, rectangles),
+                     table(Paraboloid, paraboloids), table(Instance, instances), prototypes)
+
     @staticmethod
     def default_scene() -> Scene:
         lights = [
@@ -196,4 +397,50 @@ class Scene:
        # paraboloids = []
         #rectangles = []
 
-        return Scene(lights, spheres, planes,rectangles, paraboloids)
\ No newline at end of file
+        return Scene(lights, spheres, planes,rectangles, paraboloids)
+
+    @staticmethod
+    def random_scene(spheres: int, rectangles: int, paraboloids: int, lights: int, seed: int = 0,
+                     light_radius: float = 0.) -> Scene:
+        # parametric scene for benchmarks: primitives scattered over a square
+        # on the ground plane that grows with their number, so the density
+        # (and the number of objects a ray passes) stays about the same.
+        # get_extent() gives the half size of the square; light_radius - the
+        # influence radius of the lights, 0 - they light everything
+        rng = np.random.default_rng(seed)
+        palette = [RED, GREEN, BLUE, YELLOW, GREY, MAGENTA, AQUA, SILVER]
+        extent = Scene.get_extent(spheres + rectangles + paraboloids)
+
+        def position(z_min, z_max):
+            return [rng.uniform(-extent, extent), rng.uniform(-extent, extent), rng.uniform(z_min, z_max)]
+
+        def color():
+            return palette[rng.integers(len(palette))]
+
+        scene_spheres = [Sphere(origin=position(0.2, 1.5), radius=rng.uniform(0.05, 0.3), color=color())
+                         for _ in range(spheres)]
+
+        scene_rectangles = []
+        for _ in range(rectangles):
+            u = rng.normal(size=3)
+            v = np.cross(u, rng.normal(size=3))
+            u = u / np.linalg.norm(u) * rng.uniform(0.2, 0.8)
+            v = v / np.linalg.norm(v) * rng.uniform(0.2, 0.8)
+            scene_rectangles.append(Rectangle(origin=position(0.3, 1.5), u_vect=u.tolist(), v_vect=v.tolist(),
+                                              color=color(), normal_orientation=1))
+
+        scene_paraboloids = []
+        for _ in range(paraboloids):
+            a = rng.uniform(0.2, 0.5)
+            scene_paraboloids.append(Paraboloid(origin=position(0, 0), a=a, b=a, color=color(), orientation=1,
+                                                h=rng.uniform(0.3, 1), n_orient=1))
+
+        scene_lights = [Light([rng.uniform(-extent, extent), rng.uniform(-extent, extent), rng.uniform(3, 5)],
+                              light_radius) for _ in range(lights)]
+        planes = [Plane([0, 0, 0], [0, 0, 1], GREY)]
+
+        return Scene(scene_lights, scene_spheres, planes, scene_rectangles, scene_paraboloids)
+
+    @staticmethod
+    def get_extent(count: int) -> float:
+        return max(2., 0.5 * np.sqrt(count))
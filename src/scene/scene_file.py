@@ -0,0 +1,115 @@
+import os
+import json
+import numpy as np
+from .scene import Scene, Prototype, Light, Sphere, Rectangle, Paraboloid
+from .camera import Camera
+from .buffer import SceneBuffer
+from .mesh import save_mesh, load_mesh
+
+'''
+Scene file: a small JSON header with the camera, the lights and the render
+settings, and one .npy table per primitive type next to it, in the layout
+of Scene.generate_scene (all data_length rows, float32, (rows, N)), plus the
+BVH tables. The tables are memory-mapped on load and go to the renderer
+without any per object Python work. Instances have a table too, their
+prototypes are small and stored in the header, input rows per primitive;
+the meshes of a prototype are mesh files (save_mesh) next to the scene.
+
+    {
+      "format": "ray-tracing-scene", "version": 1,
+      "camera": {"resolution": [w, h], "position": [x, y, z], "euler": [a, b, c], "fov": 45.0},
+      "lights": [[x, y, z, radius], ...],
+      "prototypes": [{"spheres": [[...], ...], "rectangles": [...], "paraboloids": [...],
+                      "meshes": ["name.mesh0_0.json", ...]}, ...],
+      "render": {"amb": 0.1, "refl_depth": 10, "aa_mode": "adaptive", ...},
+      "tables": {"spheres": "name.spheres.npy", ..., "bvh_bounds": "name.bvh_bounds.npy", ...}
+    }
+'''
+
+FORMAT, VERSION = 'ray-tracing-scene', 1
+
+# keys of "render", the arguments of the renderers in main
+RENDER_SETTINGS = ('amb', 'lamb', 'refl', 'refl_depth', 'refl_cutoff', 'rr_depth', 'aliasing', 'aa_mode', 'aa',
+                   'light_samples')
+
+TABLES = ('spheres', 'planes', 'rectangles', 'paraboloids', 'instances')
+PROTOTYPE_TYPES = {'spheres': Sphere, 'rectangles': Rectangle, 'paraboloids': Paraboloid}
+BVH_TABLES = ('bvh_bounds', 'bvh_nodes', 'bvh_prims')
+
+
+def save_scene(path: str, scene: Scene, camera: Camera = None, settings: dict = None, bvh: bool = True):
+    '''
+    Writes the header to path (.json) and the tables next to it. settings:
+    any of RENDER_SETTINGS. bvh: store the BVH too, so loading does not
+    build it - that takes most of the time for large scenes.
+    '''
+    stem = os.path.splitext(path)[0]
+    arrays = dict(zip(('spheres', 'lights', 'planes', 'rectangles', 'paraboloids'), scene.generate_scene()))
+    arrays['instances'] = scene.get_instances()
+    if bvh:
+        arrays.update(zip(BVH_TABLES, scene.bvh or SceneBuffer(scene).get_views()[5:8]))
+
+    tables = {}
+    for name in TABLES + (BVH_TABLES if bvh else ()):
+        tables[name] = f'{os.path.basename(stem)}.{name}.npy'
+        np.save(f'{stem}.{name}.npy', np.ascontiguousarray(arrays[name]))
+
+    header = {'format': FORMAT, 'version': VERSION, 'lights': arrays['lights'].T.tolist(), 'tables': tables}
+    if scene.prototypes:
+        header['prototypes'] = [{kind: [o.to_array()[:cls.input_length].tolist() for o in getattr(p, kind)]
+                                 for kind, cls in PROTOTYPE_TYPES.items()} for p in scene.prototypes]
+        for p, prototype in enumerate(scene.prototypes):
+            for m, mesh in enumerate(prototype.meshes):
+                save_mesh(f'{stem}.mesh{p}_{m}.json', mesh)
+                header['prototypes'][p].setdefault('meshes', []).append(f'{os.path.basename(stem)}.mesh{p}_{m}.json')
+    if camera is not None:
+        header['camera'] = {'resolution': list(camera.resolution), 'position': np.asarray(camera.position).tolist(),
+                            'euler': np.asarray(camera.euler).tolist(), 'fov': camera.field_of_view}
+    if settings:
+        unknown = set(settings) - set(RENDER_SETTINGS)
+        if unknown:
+            raise ValueError(f'unknown render settings: {sorted(unknown)}')
+        header['render'] = {k: list(v) if isinstance(v, tuple) else v for k, v in settings.items()}
+
+    with open(path, 'w') as f:
+        json.dump(header, f, indent=2)
+
+
+def load_scene(path: str, mmap: bool = True) -> (Scene, Camera, dict):
+    '''
+    Returns (scene, camera or None, render settings). mmap: the tables are
+    np.memmap in copy-on-write mode - pages are read on first use, changes
+    (SceneBuffer.update) stay in memory and never reach the file.
+    '''
+    with open(path) as f:
+        header = json.load(f)
+    if header.get('format') != FORMAT or header.get('version') != VERSION:
+        raise ValueError(f'{path}: not a scene file of version {VERSION}')
+
+    folder = os.path.dirname(path)
+    tables = {name: np.load(os.path.join(folder, file), mmap_mode='c' if mmap else None)
+              for name, file in header['tables'].items()}
+
+    # [x, y, z] in files written before lights had a radius
+    lights = np.zeros((Light.data_length, len(header['lights'])), dtype=np.float32)
+    for i, row in enumerate(header['lights']):
+        lights[:len(row), i] = row
+    prototypes = [Prototype(**{kind: [cls.from_array(np.array(row, dtype=np.float32)) for row in p.get(kind, [])]
+                               for kind, cls in PROTOTYPE_TYPES.items()},
+                            meshes=[load_mesh(os.path.join(folder, file), mmap) for file in p.get('meshes', [])])
+                  for p in header.get('prototypes', [])]
+    scene = Scene.from_arrays(lights, *(tables.get(name) for name in TABLES), prototypes)
+
+    if all(name in tables for name in BVH_TABLES):
+        scene.bvh = tuple(tables[name] for name in BVH_TABLES)
+        bounded = len(scene.spheres) + len(scene.rectangles) + len(scene.paraboloids) + len(scene.instances)
+        if scene.bvh[2].shape[1] != bounded:
+            raise ValueError(f'{path}: the BVH does not match the primitive tables')
+
+    camera = None
+    if 'camera' in header:
+        c = header['camera']
+        camera = Camera(resolution=tuple(c['resolution']), position=c['position'], euler=c['euler'], fov=c['fov'])
+
+    render = {k: tuple(v) if isinstance(v, list) else v for k, v in header.get('render', {}).items()}
+    return scene, camera, render
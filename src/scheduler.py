@@ -0,0 +1,178 @@
+import os
+import sys
+import time
+import heapq
+import threading
+import numpy as np
+
+'''
+Dynamic tile scheduling. The cost of a pixel is very uneven: a sky pixel
+is one missed ray, a pixel between the reflective spheres runs the whole
+reflection loop with shadow rays at every bounce. A static split of the
+frame leaves threads idle. The CPU kernels split their grid into blocks
+and give every numba thread its own list of them, the most expensive first
+to the least loaded thread (assign_blocks); a low resolution pre-pass
+(estimate_cost_map) gives the costs, and orders the tiles of a tiled
+frame. The numpy backend runs the tiles in threads that take the next
+tile as soon as they finish one.
+'''
+
+BLOCK = 16
+
+
+def get_threads(threads=None, backend=None):
+    # Python threads for run_dynamic: the numpy backend runs a tile per
+    # thread (a thread per core by default); the numba kernels spread every
+    # tile over the numba threads themselves, so their tiles go one by one -
+    # this also works with the workqueue threading layer, which aborts when
+    # parallel kernels run in several threads at once
+    if backend == 'numpy':
+        return threads or os.cpu_count()
+    return 1
+
+
+def get_tile_index(camera, tile_size):
+    # index of every tile of camera.get_tiles(tile_size): x0 outer, y0 inner
+    width, height = camera.resolution
+    rows = -(-height // tile_size[1])
+    return lambda x, y: (x // tile_size[0]) * rows + y // tile_size[1]
+
+
+def estimate_cost_map(camera, start_tile, scale=8):
+    '''
+    Pre-pass: renders the frame at 1/scale of the resolution and returns the
+    estimated cost of its grid points, float64 (rows, columns) over the whole
+    image. The cost of a grid point is the number of its intersection tests
+    if start_tile is in the statistics mode, otherwise 1 + the number of its
+    reflections. Only the ratios are meaningful.
+    '''
+    preview = camera.get_preview(scale)
+    w, h = preview.resolution
+    _, bounces, _, tile_stats = start_tile(preview.generate_descriptor(), w, h)()
+    if tile_stats is not None:
+        return tile_stats['cost'].astype(np.float64)
+    return 1. + bounces.T
+
+
+def estimate_costs(camera, start_tile, tile_size, scale=8, cost_map=None):
+    # estimated cost of every tile of camera.get_tiles(tile_size), in the
+    # same order, from cost_map (estimate_cost_map, rendered if None)
+    cost = estimate_cost_map(camera, start_tile, scale) if cost_map is None else cost_map
+
+    # every grid point counts for the full resolution pixel under it
+    width, height = camera.resolution
+    y = ((np.arange(cost.shape[0]) + 0.5) * height / cost.shape[0]).astype(np.int64)
+    x = ((np.arange(cost.shape[1]) + 0.5) * width / cost.shape[1]).astype(np.int64)
+    tile_index = get_tile_index(camera, tile_size)
+
+    costs = np.zeros(len(list(camera.get_tiles(tile_size))), dtype=np.float64)
+    np.add.at(costs, tile_index(x[None, :], y[:, None]), cost)
+    return costs
+
+
+def get_block_costs(cost_map, view, w, h, grid_w, grid_h, block_w, block_h):
+    # cost of every block of a (grid_w, grid_h) kernel grid over the (w, h)
+    # tile of the camera descriptor view: cost_map at the centre of the
+    # block; block b is column b // rows, row b % rows
+    columns, rows = -(-grid_w // block_w), -(-grid_h // block_h)
+    width, height = view[19], view[20]
+    x = view[17] + (np.arange(columns) * block_w + block_w / 2) * w / grid_w
+    y = view[18] + (np.arange(rows) * block_h + block_h / 2) * h / grid_h
+    x = np.clip((x * cost_map.shape[1] / width).astype(np.int64), 0, cost_map.shape[1] - 1)
+    y = np.clip((y * cost_map.shape[0] / height).astype(np.int64), 0, cost_map.shape[0] - 1)
+    return cost_map[y[None, :], x[:, None]].ravel()
+
+
+def assign_blocks(costs, workers):
+    '''
+    Longest processing time first: every block, the most expensive first,
+    goes to the worker with the least estimated work so far. With equal
+    costs the blocks go round robin, neighbours to different workers.
+    Returns order int32 (blocks,) and starts int32 (workers + 1,): worker t
+    renders the blocks order[starts[t]:starts[t + 1]].
+    '''
+    by_cost = np.argsort(-costs, kind='stable')
+    owner = np.empty(costs.size, dtype=np.int64)
+    loads = [(0., t) for t in range(workers)]
+    for b, cost in zip(by_cost.tolist(), costs[by_cost].tolist()):
+        load, t = heapq.heappop(loads)
+        owner[b] = t
+        heapq.heappush(loads, (load + cost, t))
+
+    order = by_cost[np.argsort(owner[by_cost], kind='stable')].astype(np.int32)
+    starts = np.zeros(workers + 1, dtype=np.int32)
+    starts[1:] = np.cumsum(np.bincount(owner, minlength=workers))
+    return order, starts
+
+
+def schedule_blocks(grid_w, grid_h, workers, view=None, w=0, h=0, cost_map=None, columns=False):
+    '''
+    Blocks of a CPU kernel over a (grid_w, grid_h) grid for workers threads:
+    (order, starts, block_w, block_h) as the kernels take them. Blocks are
+    BLOCK x BLOCK grid points, whole BLOCK wide columns if columns (the
+    statistics mode counts hits per grid column without atomics). cost_map
+    (estimate_cost_map of the frame of view) weighs them, else all equal.
+    '''
+    block_w, block_h = BLOCK, (max(grid_h, 1) if columns else BLOCK)
+    count = -(-grid_w // block_w) * -(-grid_h // block_h)
+    if cost_map is None:
+        costs = np.ones(count, dtype=np.float64)
+    else:
+        costs = get_block_costs(cost_map, view, w, h, grid_w, grid_h, block_w, block_h)
+    return (*assign_blocks(costs, max(1, min(workers, count))), block_w, block_h)
+
+
+def order_tiles(tiles, costs=None):
+    # the most expensive first; without costs - as they are
+    tiles = list(tiles)
+    if costs is None:
+        return tiles
+    return [tiles[i] for i in np.argsort(-np.asarray(costs), kind='stable')]
+
+
+def run_dynamic(tasks, run, threads):
+    '''
+    Calls run(task) for every task in threads threads, each takes the next
+    task when it finishes one. run is called concurrently and must release
+    the GIL to gain anything (the numba kernels do). With several threads
+    each runs the kernels with one numba thread, with one - the calling
+    thread runs them with all. Returns (task, seconds) in the order the
+    tasks finished; the first exception stops the threads and is raised.
+    '''
+    # numba is only set up if the renderer has loaded it
+    numba = sys.modules.get('numba')
+
+    tasks = iter(tasks)
+    lock = threading.Lock()
+    timings, errors = [], []
+
+    def worker():
+        if threads > 1 and numba is not None:
+            numba.set_num_threads(1)
+        while not errors:
+            with lock:
+                task = next(tasks, None)
+            if task is None:
+                return
+            st = time.perf_counter()
+            try:
+                run(task)
+            except BaseException as error:
+                errors.append(error)
+                return
+            et = time.perf_counter()
+            with lock:
+                timings.append((task, et - st))
+
+    if threads > 1:
+        pool = [threading.Thread(target=worker, daemon=True) for _ in range(threads)]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+    else:
+        worker()
+
+    if errors:
+        raise errors[0]
+    return timings
@@ -1 +1 @@
-from .image import convert_array_to_image
+from .image import convert_array_to_image, save_image, ImageWriter, create_ppm, write_tile, cost_heatmap
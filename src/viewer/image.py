@@ -1,21 +1,98 @@
+import os
 import numpy as np
-from PIL import Image, ImageOps
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 from time import time
 
 
 def convert_array_to_image(x: np.ndarray) -> Image:
+    # x is the (h, w, 3) uint8 image the renderers write, PIL uses its memory as is
+    return Image.fromarray(np.ascontiguousarray(x), mode='RGB')
 
-    y = np.zeros(shape=(x.shape[1], x.shape[2], 3))
 
-    # Rearrange the coordinates:
-    for i in range(3):
-        y[:, :, i] = x[i, :, :]
+def get_ppm_header(width: int, height: int) -> bytes:
+    return f'P6\n{width} {height}\n255\n'.encode()
 
-    im = Image.fromarray(y.astype(np.uint8), mode='RGB')
-    im = ImageOps.mirror(im.rotate(270))
 
-    return im
+def write_ppm(x: np.ndarray, path: str):
+    # binary PPM: header and the pixel rows exactly as they are in memory
+    height, width, _ = x.shape
+    with open(path, 'wb') as f:
+        f.write(get_ppm_header(width, height))
+        f.write(memoryview(np.ascontiguousarray(x)))
+
+
+def save_image(x: np.ndarray, path: str, compress_level: int = 6):
+    # .ppm / .raw are written without encoding, anything else through PIL
+    # (compress_level 0..9 is used by PNG)
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.ppm':
+        write_ppm(x, path)
+    elif ext == '.raw':
+        np.ascontiguousarray(x).tofile(path)
+    else:
+        convert_array_to_image(x).save(path, compress_level=compress_level)
+
+
+class ImageWriter:
+    '''
+    Saves images in a background thread, so the next frame can be rendered
+    while the previous one is encoded. The array must not be changed until
+    its save is done (close() or the returned future).
+    '''
+    def __init__(self, compress_level: int = 6):
+        self.compress_level = compress_level
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = []
+
+    def save(self, x: np.ndarray, path: str):
+        future = self._executor.submit(save_image, x, path, self.compress_level)
+        # finished saves are dropped unless they failed, wait() raises those
+        self._pending = [f for f in self._pending if not f.done() or f.exception() is not None] + [future]
+        return future
+
+    def wait(self):
+        # waits for all saves, errors of the encoder are raised here
+        for future in self._pending:
+            future.result()
+        self._pending = []
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def create_ppm(path: str, width: int, height: int) -> np.memmap:
+    # binary PPM is a short text header followed by raw RGB rows, so the
+    # pixels can be memory mapped and written tile by tile
+    header = get_ppm_header(width, height)
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.truncate(len(header) + width * height * 3)
+
+    return np.memmap(path, dtype=np.uint8, mode='r+', offset=len(header), shape=(height, width, 3))
+
+
+def write_tile(image: np.ndarray, tile: np.ndarray, x0: int, y0: int):
+    # (h, w, 3) tile into the (height, width, 3) image
+    h, w, _ = tile.shape
+    image[y0:y0 + h, x0:x0 + w, :] = tile
+
+
+def cost_heatmap(cost: np.ndarray, percentile: float = 99.5) -> np.ndarray:
+    # (h, w) costs to a black - red - yellow - white (h, w, 3) uint8 image,
+    # scaled to the percentile so a few extreme pixels don't hide the rest
+    top = max(float(np.percentile(cost, percentile)), 1.)
+    t = np.clip(cost / top, 0, 1)
+    rgb = np.stack([np.clip(3 * t, 0, 1), np.clip(3 * t - 1, 0, 1), np.clip(3 * t - 2, 0, 1)], axis=-1)
+    return np.round(255 * rgb).astype(np.uint8)
 
 
 def timed(f):
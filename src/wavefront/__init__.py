@@ -0,0 +1 @@
+from .render import render_wavefront
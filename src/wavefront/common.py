@@ -0,0 +1,79 @@
+import numpy as np
+
+# Vectors are tuples of three arrays, so the formulas (and their floating
+# point evaluation order) are the same as in ray_tracing.common.
+
+MISS = -999.0
+
+
+def linear_comb(a, b, c1, c2):
+    return (c1 * a[0] + c2 * b[0], c1 * a[1] + c2 * b[1], c1 * a[2] + c2 * b[2])
+
+
+def vector_difference(fromm, to):
+    return (to[0] - fromm[0], to[1] - fromm[1], to[2] - fromm[2])
+
+
+def dot(a, b):
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+
+def normalize(vector):
+    (X, Y, Z) = vector
+    norm = np.sqrt(X * X + Y * Y + Z * Z)
+    return (X / norm, Y / norm, Z / norm)
+
+
+def cross_product(a, b):
+    return (a[1]*b[2] - a[2]*b[1], a[2]*b[0] - a[0]*b[2], a[0]*b[1] - a[1]*b[0])
+
+
+def matmul(A, x):
+    A0, A1, A2 = A
+    return (dot(A0, x), dot(A1, x), dot(A2, x))
+
+
+def negate(vector):
+    return (-vector[0], -vector[1], -vector[2])
+
+
+def select(mask, a, b):
+    return (np.where(mask, a[0], b[0]), np.where(mask, a[1], b[1]), np.where(mask, a[2], b[2]))
+
+
+def take(vector, idx):
+    return (vector[0][idx], vector[1][idx], vector[2][idx])
+
+
+def column(data, row, idx):
+    return (data[row, idx], data[row + 1, idx], data[row + 2, idx])
+
+
+def int_power(a, n: int):
+    # x ** n for an integer n computed by squaring, as numba does
+    r = np.ones_like(a)
+    while n:
+        if n & 1:
+            r = r * a
+        n >>= 1
+        if n:
+            a = a * a
+    return r
+
+
+def clip_color(color):
+    return np.clip(np.rint(color), 0, 255).astype(np.uint8)
+
+
+def random_from_vector(v, i):
+    s = np.sin(v[0] * 12.9898 + v[1] * 78.233 + v[2] * 37.719 + i * 4.1414) * 43758.5453
+    return s - np.floor(s)
+
+
+def get_light_falloff(distance, radius):
+    # ray_tracing.common.get_light_falloff for an array of distances
+    if radius <= 0:
+        return 1.0
+    x = distance / radius
+    f = np.maximum(0, 1 - x * x)
+    return f * f
@@ -0,0 +1,92 @@
+import numpy as np
+from .common import *
+
+# Batched versions of ray_tracing.intersections: the ray components are
+# (n, 1) arrays, the primitive rows (m,) slices of the scene arrays, and the
+# result is an (n, m) array of distances with MISS where there is no hit.
+
+
+def intersect_rays_parabaloids(ray_origin, ray_dir, parabaloids):
+    rx, ry, rz = ray_origin
+    x, y, z = ray_dir
+
+    xc = parabaloids[0]
+    yc = parabaloids[1]
+    zc = parabaloids[2]
+    p_orient = parabaloids[8]
+    h = parabaloids[9]
+    k = parabaloids[11]
+    e = parabaloids[12]
+
+    REVERS = p_orient
+
+    a = k*x**2 + e*y**2
+
+    b = 2*k * (rx * x - x*xc) + 2*e * (ry*y - y*yc) - z * REVERS
+
+    c = k *(rx**2 +xc**2 -2 * rx*xc) + e* (ry**2 +yc**2 -2 * ry*yc) -REVERS*(rz -zc)
+
+    discriminant = b * b - 4 * a * c
+    root = np.sqrt(np.maximum(discriminant, 0.0))
+    hit = discriminant >= 0.0
+
+    dist = np.full(discriminant.shape, MISS)
+    for numerator in (-b + root, -b - root):
+        t = numerator / (2*a)
+        z_hit = rz + t*z
+        below_h = np.where(p_orient == -1, z_hit >= h, z_hit <= h)
+        valid = hit & (numerator > 0.0) & below_h
+        dist = np.where(valid, t, dist)
+
+    return dist
+
+
+def intersect_rays_spheres(ray_origin, ray_dir, spheres):
+    R = normalize(ray_dir)
+
+    L = vector_difference((spheres[0], spheres[1], spheres[2]), ray_origin)
+
+    a = dot(R, R)
+    b = 2 * dot(L, R)
+    c = dot(L, L) - spheres[7]
+
+    discriminant = b * b - 4 * a * c
+    root = np.sqrt(np.maximum(discriminant, 0.0))
+    hit = discriminant >= 0.0
+
+    dist = np.full(discriminant.shape, MISS)
+    for numerator in (-b + root, -b - root):
+        dist = np.where(hit & (numerator > 0.0), numerator / (2 * a), dist)
+
+    return dist
+
+
+def intersect_rays_planes(ray_origin, ray_dir, planes):
+    EPS = 0.0001
+    plane_normal = (planes[3], planes[4], planes[5])
+
+    denom = dot(ray_dir, plane_normal)
+    dist = (planes[9] - dot(ray_origin, plane_normal)) / denom
+
+    return np.where((np.abs(denom) > EPS) & (dist > 0), dist, MISS)
+
+
+def intersect_rays_rectangles(ray_origin, ray_dir, rectangles):
+    EPS = 0.001
+    rect_origin = (rectangles[0], rectangles[1], rectangles[2])
+    u = (rectangles[3], rectangles[4], rectangles[5])
+    v = (rectangles[6], rectangles[7], rectangles[8])
+    N = (rectangles[13], rectangles[14], rectangles[15])
+    w = (rectangles[16], rectangles[17], rectangles[18])
+
+    denom = dot(N, ray_dir)
+    t = (rectangles[19] - dot(N, ray_origin)) / denom
+
+    intersection = linear_comb(ray_origin, ray_dir, 1, t)
+    hit_vector = vector_difference(intersection, rect_origin)
+
+    a = dot(w, cross_product(hit_vector, v))
+    b = dot(w, cross_product(u, hit_vector))
+
+    valid = (np.abs(denom) > EPS) & (0 < a) & (a < 1) & (0 < b) & (b < 1) & (t > 0)
+    return np.where(valid, t, MISS)
@@ -0,0 +1,80 @@
+import numpy as np
+from .common import *
+from .trace import get_scene_parts, get_inside_table, sample
+
+BATCH_SIZE = 2 ** 16   # rays traced together
+
+# sub-pixel offsets of ray_tracing.trace.get_subpixel_ray, diagonals first
+SUBPIXEL_DX = (-1, 1, -1, 1, -1, 1, 0, 0)
+SUBPIXEL_DY = (1, 1, -1, -1, 0, 0, 1, -1)
+
+
+def get_pixel_location(x, y, camera):
+    return (np.full(x.shape, camera[12]), (x + camera[17]) * camera[14] + camera[13], (y + camera[18]) * camera[16] + camera[15])
+
+
+def get_camera_ray(P, camera):
+    R0 = (camera[3], camera[4], camera[5])
+    R1 = (camera[6], camera[7], camera[8])
+    R2 = (camera[9], camera[10], camera[11])
+
+    return normalize(matmul((R0, R1, R2), P))
+
+
+def get_subpixel_ray(x, y, i, camera):
+    P = get_pixel_location(x, y, camera)
+    if i < 0:
+        return get_camera_ray(P, camera)
+
+    P_n = get_pixel_location(x + SUBPIXEL_DX[i], y + SUBPIXEL_DY[i], camera)
+    return get_camera_ray(linear_comb(P, P_n, 0.5, 0.5), camera)
+
+
+def render_wavefront(view, tile_size, scene_host, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, aliasing, CAMERA, batch_size=BATCH_SIZE):
+    '''
+    Renders the (w, h) tile of the camera descriptor view with NumPy only: all
+    rays of a batch are traced together, one bounce at a time. Matches
+    ray_tracing.render with fixed antialiasing.
+
+    Returns the uint8 (h, w, 3) image and the uint8 (w, h) reflection count
+    of the centre ray of every pixel.
+    '''
+    w, h = tile_size
+    spheres, lights, planes, rectangles, parabaloids = scene_host
+
+    scene = (spheres, lights, planes, rectangles, parabaloids,
+             get_scene_parts(spheres, planes, rectangles, parabaloids),
+             get_inside_table(parabaloids, lights))
+
+    # pixels in row-major order of the (h, w, 3) image
+    y, x = (c.ravel() for c in np.mgrid[0:h, 0:w])
+    color = np.zeros((3, w * h))
+    bounces = np.zeros(w * h, dtype=np.uint8)
+
+    # -1 is the centre ray; sub-pixel samples only for pixels off the image border
+    passes = [(-1, np.arange(w * h))]
+    if aliasing:
+        X = x + view[17]
+        Y = y + view[18]
+        inner = np.flatnonzero((X > 0) & (X < view[19] - 1) & (Y > 0) & (Y < view[20] - 1))
+        passes += [(i, inner) for i in range(8)]
+
+    with np.errstate(all='ignore'):
+        for i, pixels in passes:
+            for start in range(0, pixels.shape[0], batch_size):
+                batch = pixels[start:start + batch_size]
+                ray_dir = get_subpixel_ray(x[batch], y[batch], i, view)
+                ray_origin = tuple(np.full(batch.shape, c) for c in view[0:3])
+
+                RGB, depth = sample(ray_origin, ray_dir, scene, amb, lamb, refl, refl_depth, refl_cutoff, rr_depth, CAMERA)
+                if i < 0:
+                    color[:, batch] = RGB
+                    bounces[batch] = depth
+                else:
+                    color[:, batch] += RGB
+
+    if aliasing:
+        color[:, inner] /= 9
+
+    result = clip_color(color.T).reshape(h, w, 3)
+    return result, bounces.reshape(h, w).T
@@ -0,0 +1,218 @@
+import numpy as np
+from .common import *
+from .intersections import *
+
+# Wavefront version of ray_tracing.trace: every step handles all live rays of
+# a bounce at once. Rays that escape are compacted away before the next
+# bounce and the rest are sorted by the object they hit.
+
+BLOCK_SIZE = 2 ** 22   # elements of one (rays, primitives) distance block
+BIAS = 0.002
+SPEC_COEFF = 0.6
+SPEC_POWER = 30
+
+
+def get_scene_parts(spheres, planes, rectangles, parabaloids):
+    # same type codes and tie order as ray_tracing.trace.get_intersection
+    return ((0, spheres, intersect_rays_spheres),
+            (1, planes, intersect_rays_planes),
+            (2, rectangles, intersect_rays_rectangles),
+            (3, parabaloids, intersect_rays_parabaloids))
+
+
+def iterate_blocks(ray_count, data):
+    block = max(1, BLOCK_SIZE // max(ray_count, 1))
+    for start in range(0, data.shape[1], block):
+        yield start, data[:, start:start + block]
+
+
+def get_intersection(ray_origin, ray_dir, parts):
+    n = ray_origin[0].shape[0]
+    intersect_dist = np.full(n, 999.0)
+    obj_index = np.full(n, -999, dtype=np.int64)
+    obj_type = np.full(n, 404, dtype=np.int64)
+
+    O = tuple(c[:, None] for c in ray_origin)
+    D = tuple(c[:, None] for c in ray_dir)
+    rays = np.arange(n)
+
+    for p_type, data, intersect in parts:
+        for start, block in iterate_blocks(n, data):
+            dist = intersect(O, D, block)
+            dist = np.where(dist > 0, dist, np.inf)
+
+            # argmin keeps the lowest index among equal distances
+            j = np.argmin(dist, axis=1)
+            d = dist[rays, j]
+            closer = d < intersect_dist
+
+            intersect_dist = np.where(closer, d, intersect_dist)
+            obj_index = np.where(closer, start + j, obj_index)
+            obj_type = np.where(closer, p_type, obj_type)
+
+    return intersect_dist, obj_index, obj_type
+
+
+def get_inside_table(parabaloids, lights):
+    # is_ligth_inside_parabaloid for every (parabaloid, light), in float32
+    x_p, y_p, z_p = (parabaloids[i][:, None] for i in range(3))
+    a = parabaloids[3][:, None]
+    b = parabaloids[4][:, None]
+    p_orient = parabaloids[8][:, None]
+    x_l, y_l, z_l = (lights[i][None, :] for i in range(3))
+
+    return (((z_l > z_p) & (p_orient == 1)) | ((z_l < z_p) & (p_orient == -1))) & \
+           ((x_p**2 / a**2)+(y_p**2 / b**2) >= (x_l**2 / a**2)+(y_l**2 / b**2))
+
+
+def occluded(ray_origin, ray_dir, t_max, parts, inside, light_index, inside_parabaloid):
+    # any hit closer than t_max blocks the light
+    n = ray_origin[0].shape[0]
+    blocked = np.zeros(n, dtype=bool)
+
+    O = tuple(c[:, None] for c in ray_origin)
+    D = tuple(c[:, None] for c in ray_dir)
+    t = t_max[:, None]
+
+    for p_type, data, intersect in parts:
+        for start, block in iterate_blocks(n, data):
+            dist = intersect(O, D, block)
+            hit = (t > dist) & (dist > 0)
+
+            if p_type == 3:
+                # the inner side of a parabaloid is lit by a light inside it
+                lit_inside = inside[start:start + block.shape[1], light_index][None, :]
+                hit &= ~(inside_parabaloid[:, None] & lit_inside)
+
+            blocked |= hit.any(axis=1)
+
+    return blocked
+
+
+def get_object_properties(P, obj_index, obj_type, spheres, planes, rectangles, parabaloids):
+    n = P[0].shape[0]
+    RGB_obj = np.zeros((3, n))
+    N = np.zeros((3, n))
+
+    m = obj_type == 0
+    idx = obj_index[m]
+    RGB_obj[:, m] = spheres[4:7, idx]
+    N[:, m] = normalize(vector_difference(column(spheres, 0, idx), take(P, m)))
+
+    m = obj_type == 1
+    idx = obj_index[m]
+    RGB_obj[:, m] = planes[6:9, idx]
+    N[:, m] = planes[3:6, idx]
+
+    m = obj_type == 2
+    idx = obj_index[m]
+    RGB_obj[:, m] = rectangles[9:12, idx]
+    N[:, m] = rectangles[13:16, idx]
+
+    m = obj_type == 3
+    idx = obj_index[m]
+    RGB_obj[:, m] = parabaloids[5:8, idx]
+    P_m = take(P, m)
+    orient = parabaloids[8, idx].astype(np.float64)
+    N[:, m] = normalize((2*parabaloids[11, idx].astype(np.float64)*(P_m[0] - parabaloids[0, idx]),
+                         2*parabaloids[12, idx].astype(np.float64)*(P_m[1] - parabaloids[1, idx]),
+                         -1 * orient))
+
+    return tuple(RGB_obj), tuple(N)
+
+
+def trace(ray_origin, ray_dir, scene, ambient_int, lambert_int, CAMERA, prev_rgb, prev_type):
+    '''
+    One bounce for a batch of rays, same as ray_tracing.trace.trace.
+
+    Returns the colour, the reflected ray (P, R) and prev_type of every ray,
+    the first hit (distance, index, type) and a mask of rays that hit something.
+    '''
+    spheres, lights, planes, rectangles, parabaloids, parts, inside = scene
+
+    intersect_dist, obj_index, obj_type = get_intersection(ray_origin, ray_dir, parts)
+    alive = obj_type != 404
+
+    # escaped rays keep the colour of the first hit if they left a parabaloid
+    missed = np.where(prev_type == 3, 1.0, 0.0)
+    RGB = tuple(np.where(alive, 0.0, missed * c) for c in prev_rgb)
+
+    P = linear_comb(ray_origin, ray_dir, 1.0, intersect_dist)
+    RGB_obj, N = get_object_properties(P, np.where(alive, obj_index, 0), obj_type,
+                                       spheres, planes, rectangles, parabaloids)
+    prev_type = np.where(obj_type == 3, 3, prev_type)
+
+    facing = dot(N, ray_dir) > 0
+    N = select(facing, negate(N), N)
+    flag = facing & (obj_type == 3)
+
+    RGB = select(alive, linear_comb(RGB, RGB_obj, 1.0, ambient_int), RGB)
+    P = linear_comb(P, N, 1.0, BIAS)
+
+    for light_index in range(lights.shape[1]):
+        light = column(lights, 0, light_index)
+        P_L = vector_difference(P, light)
+        L = normalize(P_L)
+        V = normalize(vector_difference(P, CAMERA))
+        H = normalize(linear_comb(L, V, 1, 1))
+
+        light_dist = np.sqrt(dot(P_L, P_L))
+
+        I_d = lambert_int * np.maximum(0, dot(L, N))
+        I_s = SPEC_COEFF * int_power(np.maximum(0, dot(H, N)), SPEC_POWER)
+
+        intensity = (I_d + I_s) * get_light_falloff(light_dist, lights[3, light_index])
+
+        # shadow rays only where the light adds something
+        lit = alive & (intensity > 0)
+        lit[lit] = ~occluded(take(P, lit), take(L, lit), light_dist[lit], parts, inside, light_index, flag[lit])
+
+        RGB = select(lit, linear_comb(RGB, RGB_obj, 1.0, intensity), RGB)
+
+    k = dot(ray_dir, N)
+    R = linear_comb(ray_dir, N, 1.0, -2.0 * k)
+    P = linear_comb(P, R, 1.0, BIAS)
+
+    return RGB, P, R, prev_type, (intersect_dist, obj_index, obj_type), alive
+
+
+def sample(ray_origin, ray_dir, scene, ambient_int, lambert_int, reflection_int, refl_depth, refl_cutoff, rr_depth, CAMERA):
+    # colour and number of reflections of every ray, same as ray_tracing.trace.sample_hit
+    n = ray_origin[0].shape[0]
+    prev_type = np.zeros(n, dtype=np.int64)
+    RGB, P, R, prev_type, hit, alive = trace(ray_origin, ray_dir, scene, ambient_int, lambert_int, CAMERA,
+                                             (0.0, 0.0, 0.0), prev_type)
+    _, obj_index, obj_type = hit
+    RGB = np.array(RGB)
+    prev_rgb = RGB.copy()
+    depth = np.zeros(n, dtype=np.uint8)
+
+    ids = np.arange(n)
+    rr_scale = np.ones(n)
+
+    for i in range(refl_depth):
+        # compact the live rays, sorted by the object they hit
+        keep = np.flatnonzero(alive)
+        keep = keep[np.lexsort((obj_index[keep], obj_type[keep]))]
+        if keep.shape[0] == 0:
+            break
+
+        weight = float(int_power(np.float64(reflection_int), i + 1))
+        if weight < refl_cutoff:
+            break
+
+        ids, P, R, prev_type, rr_scale = ids[keep], take(P, keep), take(R, keep), prev_type[keep], rr_scale[keep]
+
+        if rr_depth > 0 and i >= rr_depth:
+            survive = random_from_vector(P, i) < reflection_int
+            ids, P, R, prev_type, rr_scale = ids[survive], take(P, survive), take(R, survive), prev_type[survive], rr_scale[survive]
+            rr_scale = rr_scale / reflection_int
+
+        RGB_refl, P, R, prev_type, hit, alive = trace(P, R, scene, ambient_int, lambert_int, CAMERA,
+                                                      tuple(prev_rgb[:, ids]), prev_type)
+        _, obj_index, obj_type = hit
+
+        RGB[:, ids] = linear_comb(tuple(RGB[:, ids]), RGB_refl, 1.0, weight * rr_scale)
+        depth[ids] = i + 1
+
+    return RGB, depth
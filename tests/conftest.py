@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the sources run from src (python main.py), the tests import them the same way
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+W, H = 64, 48
+AA = (8, 16, 0.05)
+
+
+@pytest.fixture(scope='module')
+def renders():
+    # the default scene in every antialiasing mode, (image, stats) of each
+    import main
+    from scene import Scene, SceneBuffer, Camera
+    camera = Camera(resolution=(W, H), position=(-5, 2, 3), euler=[0, -30, -40])
+    buffer = SceneBuffer(Scene.default_scene())
+
+    def render(aa_mode):
+        start_tile, _ = main.RENDERERS['cpu'](buffer, 0.1, 0.55, 0.4, 10, 1 / 512, 0, aa_mode != 'none', aa_mode, AA)
+        return main.render_frame(camera, start_tile, 10)
+
+    return {aa_mode: render(aa_mode) for aa_mode in ('none', 'fixed', 'adaptive', 'lattice')}
+
+
+def test_adaptive_pixels(renders):
+    # a pixel is either the single ray (a flat area) or the full supersampled
+    # one, with fewer extra rays than fixed antialiasing
+    none, fixed, (adaptive, stats) = renders['none'][0], renders['fixed'][0], renders['adaptive']
+    single = (adaptive == none).all(axis=2)
+    supersampled = (adaptive == fixed).all(axis=2)
+    assert (single | supersampled).all()
+    assert single.any() and (supersampled & ~single).any()
+    assert 0 < stats['extra_rays'] < renders['fixed'][1]['extra_rays']
+
+
+def test_lattice_interior(renders):
+    # the shared sub-samples are the ones of fixed antialiasing; only the
+    # border pixels, whose lattice is clamped to the image, differ
+    fixed, lattice = renders['fixed'][0], renders['lattice'][0]
+    assert np.array_equal(lattice[1:-1, 1:-1], fixed[1:-1, 1:-1])
@@ -0,0 +1,52 @@
+import numpy as np
+import main
+from scene import Scene, Camera, SceneBuffer, Light
+
+SETTINGS = (0.1, 0.55, 0.4, 3, 0., 0, False, 'fixed', (8, 16, 0.05))
+
+
+def render(buffer, start_tile=None):
+    camera = Camera(resolution=(24, 24), position=(-12, 0, 8), euler=[0, -35, 0])
+    if start_tile is None:
+        start_tile, _ = main.RENDERERS['cpu'](buffer, *SETTINGS)
+    result, _ = main.render_frame(camera, start_tile, SETTINGS[3])
+    return result
+
+
+def test_remove_last_light():
+    scene = Scene.random_scene(20, 5, 2, 1, 3)
+    scene.lights[0] = Light([2, -3, 6])
+    scene.lights.append(Light([-4, 4, 5]))
+
+    buffer = SceneBuffer(scene)
+    start_tile, update_scene = main.RENDERERS['cpu'](buffer, *SETTINGS)
+    two_lights = render(buffer, start_tile)
+
+    buffer.remove('lights', 1)
+    changes = update_scene()
+    assert {19, 20, 21, 22} <= set(changes)
+
+    one_light = render(buffer, start_tile)
+    assert not np.array_equal(one_light, two_lights)
+    assert np.array_equal(one_light, render(SceneBuffer(scene)))
+
+
+def test_packed_table_refit():
+    # the packed columns of changed primitives are packed again in place,
+    # and the frame is the one of a buffer built from the changed scene
+    from scene.bvh import pack_primitives
+    scene = Scene.random_scene(20, 8, 4, 1, 5)
+    buffer = SceneBuffer(scene)
+    start_tile, update_scene = main.RENDERERS['cpu'](buffer, *SETTINGS)
+    render(buffer, start_tile)
+
+    buffer.update('spheres', 3, origin=[0.5, 0.5, 1.], radius=0.4)
+    buffer.update('rectangles', 1, u_vect=[0, 0.6, 0])
+    buffer.update('paraboloids', 0, a=0.3, b=0.6)
+    changes = update_scene()
+    # refitted, not built again: only the changed columns are uploaded
+    assert changes[5] is not None and changes[23] is not None
+
+    views = buffer.get_views()
+    assert np.array_equal(views[23], pack_primitives(views[7], views[0], views[3], views[4]))
+    assert np.array_equal(render(buffer, start_tile), render(SceneBuffer(scene)))
@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+
+def run(code):
+    return subprocess.run([sys.executable, '-W', 'always', '-c', textwrap.dedent(code)], cwd=SRC,
+                          capture_output=True, text=True, check=True)
+
+
+def test_kernels_use_package_locator():
+    run('''
+        from numba.core import caching
+        from ray_tracing.cache import PackageCacheLocator
+        from ray_tracing.cpu import render_cpu
+        from ray_tracing.culling import cull_bvh
+        assert isinstance(render_cpu._cache._impl.locator, PackageCacheLocator)
+        # numba's own list of locators is left as it is
+        assert PackageCacheLocator not in caching.CacheImpl._locator_classes
+    ''')
+
+
+def test_uncachable_function_has_no_cache():
+    # outside the package the locator does not apply: no disk cache at all,
+    # not numba's default one
+    out = run('''
+        from numba import njit
+        from numba.core.caching import NullCache
+        from ray_tracing.cache import cached
+
+        @cached
+        @njit
+        def f(x):
+            return x + 1
+
+        assert isinstance(f._cache, NullCache) and f(1) == 2
+    ''')
+    assert 'without a disk cache' in out.stderr
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+
+def test_descriptor_grid():
+    # the kernels' pixel grid is the one of generate_pixel_locations
+    from scene import Camera
+    camera = Camera(resolution=(64, 48), position=(-5, 2, 3), euler=[0, -30, -40])
+    view = camera.generate_descriptor((16, 8))
+    assert view.shape == (21,) and view.dtype == np.float64
+    assert np.array_equal(view[0:3], camera.position)
+    assert np.array_equal(view[3:12], camera.rotation.ravel())
+    assert view[17:19].tolist() == [16, 8] and view[19:21].tolist() == [64, 48]
+
+    focal, y0, dy, z0, dz = view[12:17]
+    x, y = np.mgrid[0:64, 0:48]
+    grid = np.array([np.full(x.shape, focal), y0 + x * dy, z0 + y * dz])
+    assert np.allclose(grid, camera.generate_pixel_locations())
+
+
+@pytest.mark.parametrize('aa_mode', ['none', 'fixed'])
+def test_tile_origin(aa_mode):
+    # a tile rendered from its descriptor is the same part of the frame
+    import main
+    from scene import Scene, SceneBuffer, Camera
+    camera = Camera(resolution=(48, 40), position=(-5, 2, 3), euler=[0, -30, -40])
+    start_tile, _ = main.RENDERERS['cpu'](SceneBuffer(Scene.default_scene()), 0.1, 0.55, 0.4, 10, 1 / 512, 0,
+                                          aa_mode != 'none', aa_mode, (8, 16, 0.05))
+    frame, _ = main.render_frame(camera, start_tile, 10)
+    tile = start_tile(camera.generate_descriptor((16, 8)), 24, 20)()[0]
+    assert np.array_equal(tile, frame[8:28, 16:40])
@@ -0,0 +1,33 @@
+import threading
+from multiprocessing import Pipe
+import numpy as np
+import main
+from scene import Scene, SceneBuffer, Camera
+from farm import RenderFarm
+from farm.worker import serve
+
+SETTINGS = (0.1, 0.55, 0.4, 3, 0., 0, False, 'fixed', (8, 16, 0.05))
+
+
+def add_thread_worker(farm, backend=None):
+    # a worker in a thread of this process, backend overrides the farm's
+    parent_conn, child_conn = Pipe()
+    threading.Thread(target=serve, args=(child_conn, backend), daemon=True).start()
+    farm._add_worker(parent_conn)
+
+
+def test_failed_setup_drops_worker():
+    scene = Scene.default_scene()
+    camera = Camera(resolution=(48, 32), position=(-5, 2, 3), euler=[0, -30, -40])
+    start_tile, _ = main.RENDERERS['cpu'](SceneBuffer(scene), *SETTINGS)
+    reference, _ = main.render_frame(camera, start_tile, SETTINGS[3])
+
+    with RenderFarm(scene, SETTINGS, 'cpu') as farm:
+        add_thread_worker(farm, 'no such backend')
+        add_thread_worker(farm)
+        image = main.allocate_image(48, 32)
+        stats = farm.render(camera, (16, 16), image)
+
+    assert np.array_equal(image, reference)
+    assert stats['failed_workers'] == 1
+    assert len(stats['workers']) == 1
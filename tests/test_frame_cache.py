@@ -0,0 +1,49 @@
+import numpy as np
+import main
+from scene import Scene, SceneBuffer, Camera
+from frame_cache import FrameCache
+
+SETTINGS = (0.1, 0.55, 0.4, 3, 0., 0, False, 'fixed', (8, 16, 0.05))
+
+
+def test_wrap_numpy_renderer(tmp_path):
+    buffer = SceneBuffer(Scene.default_scene())
+    camera = Camera(resolution=(24, 16), position=(-5, 2, 3), euler=[0, -30, -40])
+    cache = FrameCache(str(tmp_path))
+    start_tile, _ = cache.wrap(*main.RENDERERS['numpy'](buffer, *SETTINGS), buffer, SETTINGS, 'numpy')
+
+    first, _ = main.render_frame(camera, start_tile, SETTINGS[3])
+    second, _ = main.render_frame(camera, start_tile, SETTINGS[3])
+    assert np.array_equal(first, second)
+    assert cache.get_stats()['hits'] == 1
+    assert cache.get_stats()['misses'] == 1
+
+
+def test_round_trip(tmp_path):
+    cache = FrameCache(str(tmp_path))
+    stats = {'rays': {'primary': 12}, 'hits': {'spheres': np.arange(3)}, 'depth': np.array([4, 1]),
+             'cost': np.ones((2, 3), dtype=np.int64)}
+    result = (np.zeros((2, 3, 3), dtype=np.uint8), np.ones((3, 2), dtype=np.uint8), np.int64(5), stats)
+    cache.put('entry', result)
+
+    image, bounces, extra_rays, cached_stats = FrameCache(str(tmp_path)).get('entry')
+    assert np.array_equal(image, result[0]) and image.dtype == np.uint8
+    assert np.array_equal(bounces, result[1])
+    assert extra_rays == 5
+    assert cached_stats['rays'] == {'primary': 12}
+    assert np.array_equal(cached_stats['hits']['spheres'], np.arange(3))
+    assert np.array_equal(cached_stats['cost'], stats['cost'])
+
+
+def test_bad_entry_is_a_miss(tmp_path):
+    import pickle
+    cache = FrameCache(str(tmp_path))
+    cache.put('truncated', (np.zeros((4, 4, 3), dtype=np.uint8), np.zeros((4, 4), dtype=np.uint8), 0, None))
+    path = tmp_path / 'truncated.npz'
+    path.write_bytes(path.read_bytes()[:100])
+    (tmp_path / 'foreign.npz').write_bytes(pickle.dumps(object()))
+
+    cache = FrameCache(str(tmp_path))
+    assert cache.get('truncated') is None and cache.get('foreign') is None
+    assert cache.get_stats()['misses'] == 2
+    assert not path.exists() and not (tmp_path / 'foreign.npz').exists()
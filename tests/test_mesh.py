@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from scene.mesh import parse_obj
+
+QUAD = b'v 0 0 0\nv 1 0 0\nv 1 1 0\nv 0 1 0\nf 1 2 3 4\n'
+
+
+def test_parse_obj():
+    vertices, triangles = parse_obj(QUAD)
+    assert vertices.shape == (3, 4)
+    assert np.array_equal(triangles, [[0, 0], [1, 2], [2, 3]])
+
+
+@pytest.mark.parametrize('indent', [b' ', b'  ', b'\t', b' \t '])
+def test_parse_obj_indented(indent):
+    data = b''.join(indent + line + b'\n' for line in QUAD.splitlines())
+    for a, b in zip(parse_obj(data), parse_obj(QUAD)):
+        assert np.array_equal(a, b)
+
+
+def test_parse_obj_indented_faces():
+    data = b'o quad\nv 0 0 0\nv 1 0 0\nv 1 1 0\n  v 0 1 0\n\tf 1/1/1 2/2/1 3/3/1\r\n    f -4 -2 -1\n'
+    vertices, triangles = parse_obj(data)
+    assert vertices.shape == (3, 4)
+    assert np.array_equal(triangles, [[0, 0], [1, 2], [2, 3]])
+
+
+def test_parse_obj_line_continuation():
+    with pytest.raises(ValueError, match='continuation'):
+        parse_obj(b'v 0 0 0\nv 1 0 0\nv 1 1 0\nf 1 2 \\\n 3\n')
+
+
+def test_parse_obj_comments():
+    data = (b'# exported\nv 0 0 0 # origin\nv 1 0 0\t# x\nv 1 1 0#no space\nv 0 1 0\n'
+            b'f 1 2 3 4 # the quad\n# f 1 2 3\n')
+    for a, b in zip(parse_obj(data), parse_obj(QUAD)):
+        assert np.array_equal(a, b)
+
+
+def test_parse_obj_continuation_in_comment():
+    # a backslash inside a comment does not continue the line
+    for a, b in zip(parse_obj(QUAD + b'# C:\\\\models\\\\\n'), parse_obj(QUAD)):
+        assert np.array_equal(a, b)
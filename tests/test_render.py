@@ -0,0 +1,116 @@
+import numpy as np
+import pytest
+
+SETTINGS = (0.1, 0.55, 0.4, 10, 1 / 512, 0)
+AA = (8, 16, 0.05)
+
+
+def get_camera(w=48, h=40):
+    from scene import Camera
+    return Camera(resolution=(w, h), position=(-5, 2, 3), euler=[0, -30, -40])
+
+
+def render(scene, backend='cpu', aa_mode='none', light_samples=0):
+    import main
+    from scene import SceneBuffer
+    start_tile, _ = main.RENDERERS[backend](SceneBuffer(scene), *SETTINGS, aa_mode != 'none', aa_mode, AA,
+                                            light_samples)
+    return main.render_frame(get_camera(), start_tile, SETTINGS[3])
+
+
+@pytest.mark.parametrize('aa_mode', ['none', 'fixed'])
+def test_numpy_equals_cpu(aa_mode):
+    from scene import Scene
+    image, stats = render(Scene.default_scene(), 'cpu', aa_mode)
+    wavefront, wavefront_stats = render(Scene.default_scene(), 'numpy', aa_mode)
+    assert np.array_equal(wavefront, image)
+    assert np.array_equal(wavefront_stats['bounces'], stats['bounces'])
+    assert wavefront_stats['extra_rays'] == stats['extra_rays']
+
+
+@pytest.mark.parametrize('aa_mode', ['none', 'fixed', 'adaptive', 'lattice'])
+def test_tiled_equals_frame(aa_mode, tmp_path):
+    import main
+    from scene import Scene, SceneBuffer
+    from viewer import create_ppm
+    camera = get_camera()
+    start_tile, _ = main.RENDERERS['cpu'](SceneBuffer(Scene.default_scene()), *SETTINGS, aa_mode != 'none', aa_mode, AA)
+    frame, frame_stats = main.render_frame(camera, start_tile, SETTINGS[3])
+
+    image = create_ppm(str(tmp_path / 'img.ppm'), 48, 40)
+    stats = main.render_tiled(camera, start_tile, SETTINGS[3], (16, 16), image)
+    image.flush()
+    assert np.array_equal(image, frame)
+    # the lattice sub-samples on the tile borders are counted by both tiles
+    if aa_mode != 'lattice':
+        assert np.array_equal(stats['bounces'], frame_stats['bounces'])
+        assert stats['extra_rays'] == frame_stats['extra_rays']
+
+    data = (tmp_path / 'img.ppm').read_bytes()
+    assert np.array_equal(np.frombuffer(data[-48 * 40 * 3:], dtype=np.uint8).reshape(40, 48, 3), frame)
+
+
+def test_culled_equals_unculled():
+    # every culling tile given the whole BVH renders the same image
+    import main
+    from scene import Scene, SceneBuffer, get_scene_handle
+    from ray_tracing import render_cpu, cull_bvh
+    from ray_tracing.culling import CULL_TILE
+    from scheduler import schedule_blocks
+    camera = get_camera()
+    buffer = SceneBuffer(Scene.random_scene(200, 50, 20, 3, seed=2))
+    start_tile, _ = main.RENDERERS['cpu'](buffer, *SETTINGS, False, 'none', AA)
+    culled, stats = main.render_frame(camera, start_tile, SETTINGS[3])
+
+    view, w, h = camera.generate_descriptor(), 48, 40
+    views = buffer.get_views()
+    tiles = cull_bvh(view, w, h, views[5], views[6])[2]
+    assert (tiles[1] < views[6].shape[1]).all()
+
+    tiles = np.zeros_like(tiles)
+    tiles[1] = views[6].shape[1]
+    result, bounces = main.allocate_image(w, h), main.allocate_bounces(w, h, False, 'none')
+    render_cpu(view, result, bounces, get_scene_handle(views), *SETTINGS, False, main.get_view_position(view),
+               views[5], views[6], tiles, (), *schedule_blocks(w, h, 1))
+    assert np.array_equal(result, culled)
+    assert np.array_equal(main.bounce_histogram(bounces, SETTINGS[3]), stats['bounces'])
+
+
+def moved_scene(offset):
+    # the default scene with its bounded primitives moved by offset
+    from scene import Scene
+    scene = Scene.default_scene()
+    for obj in [*scene.spheres, *scene.rectangles, *scene.paraboloids]:
+        obj.origin = (np.array(obj.origin) + offset).tolist()
+    return scene
+
+
+@pytest.mark.parametrize('offset', [(0, 0, 0), (0.5, -0.25, 0)])
+def test_instance_equals_primitives(offset):
+    # a prototype of the default scene's primitives placed by one instance
+    from scene import Scene, Prototype, Instance
+    prototype = moved_scene((0, 0, 0))
+    scene = Scene(prototype.lights, [], prototype.planes, [], [], [Instance(0, list(offset))],
+                  [Prototype(prototype.spheres, prototype.rectangles, prototype.paraboloids)])
+    image, stats = render(moved_scene(offset))
+    instanced, instanced_stats = render(scene)
+    assert np.array_equal(instanced, image)
+    assert np.array_equal(instanced_stats['bounces'], stats['bounces'])
+
+
+def test_bounded_lights():
+    # a light whose radius reaches none of the primitives changes nothing
+    from scene import Scene, Light
+    image, _ = render(Scene.default_scene())
+    scene = Scene.default_scene()
+    scene.lights.append(Light([50, 50, 4], 1.))
+    assert np.array_equal(render(scene)[0], image)
+
+
+def test_light_samples():
+    # sampling as many lights as there are is the exact sum, fewer differ
+    from scene import Scene
+    scene = Scene.random_scene(30, 10, 5, 6, seed=1, light_radius=10.)
+    exact, _ = render(scene)
+    assert np.array_equal(render(scene, light_samples=6)[0], exact)
+    assert not np.array_equal(render(scene, light_samples=1)[0], exact)
@@ -0,0 +1,36 @@
+import numpy as np
+
+
+def test_precomputed_rows():
+    # the rows filled at build time are what the intersection tests would
+    # compute from the fields of every primitive
+    from scene import Scene
+    scene = Scene.random_scene(20, 20, 10, 2, seed=3)
+    spheres, _, planes, rectangles, paraboloids = scene.generate_scene()
+
+    for s, column in zip(scene.spheres, spheres.T):
+        assert np.isclose(column[7], s.radius ** 2)
+
+    for r, column in zip(scene.rectangles, rectangles.T):
+        n = np.cross(r.u_vect, r.v_vect)
+        assert np.allclose(column[13:16], n / np.linalg.norm(n), atol=1e-6)
+        assert np.allclose(column[16:19], n / n.dot(n), atol=1e-6)
+        assert np.isclose(column[19], np.dot(n / np.linalg.norm(n), r.origin), atol=1e-5)
+
+    for q, column in zip(scene.paraboloids, paraboloids.T):
+        assert np.isclose(column[11], (q.b / q.a) ** 2) and np.isclose(column[12], (q.a / q.b) ** 2)
+
+    for p, column in zip(scene.planes, planes.T):
+        assert np.isclose(column[9], np.dot(p.normal, p.origin))
+
+
+def test_update_precomputes():
+    # a changed primitive gets its rows again in the buffer
+    from scene import Scene, SceneBuffer
+    buffer = SceneBuffer(Scene.default_scene())
+    buffer.update('spheres', 0, radius=0.5)
+    buffer.update('rectangles', 0, u_vect=[0, 2, 0], v_vect=[0, 0, 4])
+    buffer.commit()
+    spheres, _, _, rectangles = buffer.get_views()[:4]
+    assert np.isclose(spheres[7, 0], 0.25)
+    assert np.allclose(rectangles[13:16, 0], [1, 0, 0]) and np.allclose(rectangles[16:19, 0], [1 / 8, 0, 0])
@@ -0,0 +1,53 @@
+import os
+import subprocess
+import sys
+import textwrap
+import numpy as np
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+
+def test_numpy_scheduled_without_numba():
+    # a fresh interpreter: numba must not be imported by the numpy path
+    code = textwrap.dedent('''
+        import sys
+        import main
+        from scene import Scene, SceneBuffer, Camera
+        buffer = SceneBuffer(Scene.default_scene())
+        start_tile, _ = main.RENDERERS['numpy'](buffer, 0.1, 0.55, 0.4, 3, 0., 0, False, 'fixed', (8, 16, 0.05))
+        camera = Camera(resolution=(32, 24), position=(-5, 2, 3), euler=[0, -30, -40])
+        image = main.allocate_image(32, 24)
+        stats = main.render_scheduled(camera, start_tile, 3, (16, 16), image, backend='numpy')
+        assert len(stats['tile_times']) == 4
+        assert 'numba' not in sys.modules
+    ''')
+    subprocess.run([sys.executable, '-c', code], cwd=SRC, check=True)
+
+
+def test_assign_blocks():
+    from scheduler import assign_blocks
+    costs = np.array([1., 9., 1., 1., 8., 1., 1., 1.])
+    order, starts = assign_blocks(costs, 3)
+    assert sorted(order.tolist()) == list(range(8))
+    loads = [costs[order[starts[t]:starts[t + 1]]].sum() for t in range(3)]
+    assert max(loads) == 9.
+    # equal costs: round robin
+    order, starts = assign_blocks(np.ones(6), 3)
+    assert order.tolist() == [0, 3, 1, 4, 2, 5] and starts.tolist() == [0, 2, 4, 6]
+
+
+@pytest.mark.parametrize('aa_mode', ['none', 'fixed', 'adaptive', 'lattice'])
+def test_scheduled_equals_frame(aa_mode):
+    import main
+    from scene import Scene, SceneBuffer, Camera
+    camera = Camera(resolution=(48, 40), position=(-5, 2, 3), euler=[0, -30, -40])
+    start_tile, _ = main.RENDERERS['cpu'](SceneBuffer(Scene.default_scene()), 0.1, 0.55, 0.4, 10, 1 / 512, 0,
+                                          aa_mode != 'none', aa_mode, (8, 16, 0.05))
+    frame, frame_stats = main.render_frame(camera, start_tile, 10)
+
+    image = main.allocate_image(48, 40)
+    stats = main.render_scheduled(camera, start_tile, 10, (48, 40), image, cost_preview=4, backend='cpu')
+    assert np.array_equal(image, frame)
+    assert np.array_equal(stats['bounces'], frame_stats['bounces'])
+    assert stats['extra_rays'] == frame_stats['extra_rays']